@@ -3,7 +3,9 @@
 #include <DNSServer.h>
 #include <HTTPClient.h>
 #include <ArduinoJson.h>
+#include <Preferences.h>
 #include <map>
+#include <vector>
 
 // ============================================
 // Configuration
@@ -48,6 +50,48 @@ std::map<String, String> userFiles;  // SessionID → Uploaded filename (NEW!)
 std::map<String, int> userFileIDs;  // SessionID → File ID from Orange Pi
 String uploadedFileName = "";  // Current uploaded file name
 
+// ============================================
+// Credit Sync - Batched, idempotent coin events
+// ============================================
+// Claimed credits are queued with a sequence number and sent to
+// /api/credits/batch in one request. The server ignores sequence numbers it
+// has already applied, so retrying after a timeout never double-credits.
+//
+// The outbox lives in RAM and is written to flash only when a sync fails,
+// so events the server hasn't confirmed survive a reboot. A power cut in
+// the ~300 ms between a coin and its first sync attempt still loses it.
+struct CoinEvent {
+  uint32_t seq;
+  String sessionID;
+  int amount;
+};
+
+Preferences prefs;
+std::vector<CoinEvent> coinOutbox;
+uint32_t coinSeq = 0;             // Last sequence number used
+uint32_t coinSeqReserved = 0;     // Highest number reserved in flash (see nextCoinSeq)
+bool coinOutboxSaved = false;     // Flash copy of the outbox exists
+bool coinOutboxChanged = false;   // Outbox differs from its flash copy
+String deviceID = "";
+unsigned long lastCoinQueuedTime = 0;
+unsigned long nextCoinFlushTime = 0;
+const unsigned long COIN_BATCH_DELAY = 300;    // Wait this long after the last event to coalesce bursts
+const unsigned long COIN_RETRY_DELAY = 2000;   // Back-off after a failed sync
+const size_t COIN_BATCH_MAX = 20;              // Events per request
+const uint32_t COIN_SEQ_BLOCK = 100;           // Sequence numbers reserved per flash write
+const size_t COIN_OUTBOX_SAVE_MAX = 40;        // Events kept across a reboot (NVS strings hold ~4 KB)
+
+// ============================================
+// Orange Pi Connection - one keep-alive connection
+// ============================================
+// All API calls share one HTTPClient with reuse on, so the TCP connection
+// to the Orange Pi stays open between requests instead of a new handshake
+// for every coin sync or print. /print answers in the compact text format
+// ("Accept: text/x-pisoprint"): one line of comma-separated fields.
+WiFiClient flaskClient;
+HTTPClient flaskHttp;
+const char* COMPACT_ACCEPT = "text/x-pisoprint";
+
 
 // Buzzer state machine
 enum BuzzerState {
@@ -177,6 +221,13 @@ void setup() {
   // Coin acceptor interrupt (FALLING edge for NO mode)
   attachInterrupt(digitalPinToInterrupt(COIN_PIN), coinInserted, FALLING);
 
+  // Coin event sequence numbers survive reboots so the server never mistakes
+  // a new event for a retry: continue after the last reserved block
+  prefs.begin("pisoprint", false);
+  coinSeq = prefs.getUInt("coin_seq", 0);
+  coinSeqReserved = coinSeq;
+  loadCoinOutbox();
+
   // Wi-Fi AP+STA Mode (Dual mode: Hotspot + Connect to router)
   WiFi.mode(WIFI_AP_STA);  // Enable both AP and Station modes
   
@@ -186,6 +237,9 @@ void setup() {
   Serial.print("🔗 Hotspot IP: ");
   Serial.println(WiFi.softAPIP());
   
+  deviceID = makeDeviceID();
+  Serial.println("🆔 Device: " + deviceID);
+  
   // Connect to router (where Orange Pi is)
   Serial.print("🔌 Connecting to router: ");
   Serial.println(STA_SSID);
@@ -253,6 +307,7 @@ void loop() {
   server.handleClient();
   updateBuzzer();
   checkCoinType();
+  flushCreditEvents();
 }
 
 // ============================================
@@ -786,10 +841,7 @@ void handleUploadResponse() {
   userFiles[sessionID] = uploadedFileName;
   
   // Send filename to Orange Pi for page counting
-  HTTPClient http;
-  http.setTimeout(10000);
-  http.begin(String(FLASK_SERVER) + "/api/check_pages");
-  http.addHeader("Content-Type", "application/json");
+  beginFlask("/api/check_pages", 10000);
   
   StaticJsonDocument<200> doc;
   doc["filename"] = uploadedFileName;
@@ -799,10 +851,10 @@ void handleUploadResponse() {
   serializeJson(doc, requestBody);
   
   Serial.println("📡 Requesting page count from Orange Pi...");
-  int httpCode = http.POST(requestBody);
+  int httpCode = flaskHttp.POST(requestBody);
   
   if (httpCode == 200) {
-    String response = http.getString();
+    String response = flaskHttp.getString();
     Serial.println("✅ Page count received: " + response);
     server.send(200, "application/json", response);
   } else {
@@ -813,7 +865,7 @@ void handleUploadResponse() {
     server.send(200, "application/json", "{\"success\":true,\"pages\":1,\"warning\":\"Using default page count\"}");
   }
   
-  http.end();
+  flaskHttp.end();
 }
 
 // NEW: Proxy upload handlers - STREAMING MODE (unlimited file size)
@@ -1157,10 +1209,13 @@ void handlePrint() {
   Serial.print("   Credits: ₱");
   Serial.println(userCredits[sessionID]);
   
-  HTTPClient http;
-  http.setTimeout(10000);
-  http.begin(String(FLASK_SERVER) + "/print");
-  http.addHeader("Content-Type", "application/json");
+  // The server only knows coins it has received: send any still queued
+  if (!flushCreditEventsNow()) {
+    Serial.println("⚠️  Some coins not synced yet, printing may report insufficient credits");
+  }
+  
+  beginFlask("/print", 10000);
+  flaskHttp.addHeader("Accept", COMPACT_ACCEPT);
   
   StaticJsonDocument<300> doc;
   doc["session_id"] = sessionID;
@@ -1170,22 +1225,25 @@ void handlePrint() {
   String requestBody;
   serializeJson(doc, requestBody);
   
-  int httpCode = http.POST(requestBody);
+  int httpCode = flaskHttp.POST(requestBody);
   
   Serial.print("   HTTP Response Code: ");
   Serial.println(httpCode);
   
   if (httpCode > 0) {
-    String response = http.getString();
+    // ok,error,cost,remaining_credits,job_id,queue_position,pages,sheets,file_id
+    String response = flaskHttp.getString();
     Serial.print("   Response: ");
     Serial.println(response);
     
-    StaticJsonDocument<200> responseDoc;
-    deserializeJson(responseDoc, response);
+    String remaining = csvField(response, 3);
     
-    if (responseDoc["success"]) {
-      int pagesDeducted = responseDoc["pages"];
-      userCredits[sessionID] -= pagesDeducted;
+    if (csvField(response, 0) == "1") {
+      int pagesDeducted = csvField(response, 2).toInt();
+      // The server's balance is authoritative (it reserves credits atomically),
+      // plus coins it hasn't received yet
+      userCredits[sessionID] = remaining.length() ? remaining.toInt() + pendingCoinCredits(sessionID)
+                                                  : userCredits[sessionID] - pagesDeducted;
       
       Serial.println("\n🖨️  PRINTING...");
       Serial.print("   Pages: ");
@@ -1204,7 +1262,20 @@ void handlePrint() {
       
       server.send(200, "application/json", "{\"success\":true,\"message\":\"Printing...\"}");
     } else {
-      String errorMsg = String(responseDoc["message"].as<const char*>());
+      String errorCode = csvField(response, 1);
+      String errorMsg = "Print failed (" + errorCode + ")";
+      if (errorCode == "insufficient_credits") {
+        errorMsg = "Insufficient credits. Need ₱" + csvField(response, 2) + ", have ₱" + remaining;
+      } else if (errorCode == "no_file") {
+        errorMsg = "No file uploaded yet";
+      } else if (errorCode == "no_printer") {
+        errorMsg = "No printer available";
+      } else if (errorCode == "not_ready") {
+        errorMsg = "Document is still being converted, try again in a moment";
+      }
+      if (remaining.length()) {
+        userCredits[sessionID] = remaining.toInt() + pendingCoinCredits(sessionID);
+      }
       Serial.print("❌ Print failed: ");
       Serial.println(errorMsg);
       server.send(200, "application/json", "{\"success\":false,\"message\":\"" + errorMsg + "\"}");
@@ -1231,34 +1302,195 @@ void handlePrint() {
     }
   }
   
-  http.end();
+  flaskHttp.end();
 }
 
 String generateSessionID() {
-  randomSeed(analogRead(0) + micros());
-  return "USER_" + String(random(100000, 999999));
+  // Ask the server for a unique ID; offline, fall back to 64 random bits
+  if (WiFi.status() == WL_CONNECTED && beginFlask("/api/session", 2000)) {
+    flaskHttp.addHeader("Accept", COMPACT_ACCEPT);
+    int httpCode = flaskHttp.POST("{}");
+    String response = httpCode == 201 ? flaskHttp.getString() : "";
+    flaskHttp.end();
+    
+    String sessionID = csvField(response, 2);  // ok,error,session_id,credits
+    if (csvField(response, 0) == "1" && sessionID.length() > 0) {
+      return sessionID;
+    }
+  }
+  char id[22];
+  snprintf(id, sizeof(id), "USER_%08lx%08lx", (unsigned long)esp_random(), (unsigned long)esp_random());
+  return String(id);
+}
+
+bool beginFlask(const char* path, uint16_t timeout) {
+  // Reconnects only if the server closed the kept-alive connection
+  flaskHttp.setReuse(true);
+  flaskHttp.setTimeout(timeout);
+  if (!flaskHttp.begin(flaskClient, String(FLASK_SERVER) + path)) {
+    return false;
+  }
+  flaskHttp.addHeader("Content-Type", "application/json");
+  return true;
+}
+
+String csvField(const String& line, int index) {
+  // Field number index of a compact "a,b,c" response line
+  int start = 0;
+  for (int i = 0; i < index; i++) {
+    start = line.indexOf(',', start);
+    if (start < 0) return "";
+    start++;
+  }
+  int end = line.indexOf(',', start);
+  if (end < 0) end = line.length();
+  String field = line.substring(start, end);
+  field.trim();
+  return field;
+}
+
+String makeDeviceID() {
+  // The server dedupes coins by (device_id, seq). coin_seq restarts at 0 when
+  // flash is erased or reflashed, so the ID includes a random install ID that
+  // is created and lost together with it; old and new numbers never collide.
+  // Called after Wi-Fi is up: esp_random() needs the radio for real entropy.
+  String installID = prefs.getString("install_id", "");
+  if (installID.length() == 0) {
+    char id[9];
+    snprintf(id, sizeof(id), "%08lx", (unsigned long)esp_random());
+    installID = id;
+    prefs.putString("install_id", installID);
+  }
+  // Factory MAC from eFuse: valid before Wi-Fi init, unlike WiFi.macAddress() on some cores
+  uint64_t mac = ESP.getEfuseMac();
+  char macHex[13];
+  snprintf(macHex, sizeof(macHex), "%02X%02X%02X%02X%02X%02X",
+           (uint8_t)mac, (uint8_t)(mac >> 8), (uint8_t)(mac >> 16),
+           (uint8_t)(mac >> 24), (uint8_t)(mac >> 32), (uint8_t)(mac >> 40));
+  return "esp32-" + String(macHex) + "-" + installID;
+}
+
+uint32_t nextCoinSeq() {
+  // Reserve numbers in blocks so flash is written once per COIN_SEQ_BLOCK coins;
+  // numbers left unused by a reboot are simply skipped
+  coinSeq++;
+  if (coinSeq > coinSeqReserved) {
+    coinSeqReserved = coinSeq + COIN_SEQ_BLOCK - 1;
+    prefs.putUInt("coin_seq", coinSeqReserved);
+  }
+  return coinSeq;
 }
 
 void sendCreditsToServer(String sessionID, int amount) {
-  HTTPClient http;
-  http.setTimeout(5000);
-  http.begin(String(FLASK_SERVER) + "/api/credits");
-  http.addHeader("Content-Type", "application/json");
+  // Queue the event; flushCreditEvents() sends it with any others nearby
+  coinOutbox.push_back({nextCoinSeq(), sessionID, amount});
+  coinOutboxChanged = true;
+  lastCoinQueuedTime = millis();
+}
+
+int pendingCoinCredits(const String& sessionID) {
+  // Credits already given to this session locally but not yet confirmed by the server
+  int total = 0;
+  for (const CoinEvent& event : coinOutbox) {
+    if (event.sessionID == sessionID) total += event.amount;
+  }
+  return total;
+}
+
+void flushCreditEvents() {
+  unsigned long now = millis();
+  if (coinOutbox.empty() || now - lastCoinQueuedTime < COIN_BATCH_DELAY) return;
+  if ((long)(now - nextCoinFlushTime) < 0 || WiFi.status() != WL_CONNECTED) return;
   
-  StaticJsonDocument<200> doc;
-  doc["session_id"] = sessionID;
-  doc["amount"] = amount;
+  if (!sendCoinBatch()) {
+    nextCoinFlushTime = now + COIN_RETRY_DELAY;
+  }
+}
+
+bool flushCreditEventsNow() {
+  // Send everything queued right away (before /print, so the server's balance
+  // includes the last coins); returns false if events are still pending
+  if (WiFi.status() != WL_CONNECTED) return coinOutbox.empty();
+  while (!coinOutbox.empty()) {
+    if (!sendCoinBatch()) {
+      nextCoinFlushTime = millis() + COIN_RETRY_DELAY;
+      return false;
+    }
+  }
+  return true;
+}
+
+bool sendCoinBatch() {
+  size_t count = min(coinOutbox.size(), COIN_BATCH_MAX);
+  
+  DynamicJsonDocument doc(256 + count * 96);
+  doc["device_id"] = deviceID;
+  JsonArray events = doc.createNestedArray("events");
+  for (size_t i = 0; i < count; i++) {
+    JsonObject event = events.createNestedObject();
+    event["seq"] = coinOutbox[i].seq;
+    event["session_id"] = coinOutbox[i].sessionID;
+    event["amount"] = coinOutbox[i].amount;
+  }
   
   String requestBody;
   serializeJson(doc, requestBody);
   
-  int httpCode = http.POST(requestBody);
+  beginFlask("/api/credits/batch", 5000);
+  int httpCode = flaskHttp.POST(requestBody);
+  flaskHttp.end();  // Keeps the connection open for the next request
   
   Serial.print("📡 Sync to server: ");
   Serial.print(httpCode == 200 ? "OK" : "FAILED");
-  Serial.print(" (Session: ");
-  Serial.print(sessionID);
-  Serial.println(")");
+  Serial.print(" (");
+  Serial.print(count);
+  Serial.println(" event(s))");
   
-  http.end();
+  if (httpCode == 200) {
+    // Every event in the batch is settled (applied, duplicate or invalid)
+    coinOutbox.erase(coinOutbox.begin(), coinOutbox.begin() + count);
+    coinOutboxChanged = true;
+    if (coinOutboxSaved) saveCoinOutbox();
+    return true;
+  }
+  // Keep the events and retry later with the same sequence numbers;
+  // until then they must survive a reboot
+  saveCoinOutbox();
+  return false;
+}
+
+void saveCoinOutbox() {
+  // Written only when the outbox changed, not on every retry during an outage
+  if (!coinOutboxChanged) return;
+  coinOutboxChanged = false;
+  if (coinOutbox.empty()) {
+    prefs.remove("coin_outbox");
+    coinOutboxSaved = false;
+    return;
+  }
+  size_t count = min(coinOutbox.size(), COIN_OUTBOX_SAVE_MAX);
+  DynamicJsonDocument doc(128 + count * 128);
+  for (size_t i = 0; i < count; i++) {
+    JsonArray event = doc.createNestedArray();
+    event.add(coinOutbox[i].seq);
+    event.add(coinOutbox[i].sessionID);
+    event.add(coinOutbox[i].amount);
+  }
+  String saved;
+  serializeJson(doc, saved);
+  prefs.putString("coin_outbox", saved);
+  coinOutboxSaved = true;
+}
+
+void loadCoinOutbox() {
+  String saved = prefs.getString("coin_outbox", "");
+  if (saved.length() == 0) return;
+  DynamicJsonDocument doc(128 + COIN_OUTBOX_SAVE_MAX * 128);
+  if (deserializeJson(doc, saved)) return;
+  for (JsonArray event : doc.as<JsonArray>()) {
+    coinOutbox.push_back({event[0].as<uint32_t>(), event[1].as<String>(), event[2].as<int>()});
+  }
+  coinOutboxSaved = true;
+  Serial.print("📦 Coin events waiting from before reboot: ");
+  Serial.println(coinOutbox.size());
 }
\ No newline at end of file
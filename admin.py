@@ -1,26 +1,24 @@
 """
 PisoPrint Admin Dashboard
 Simple web interface to manage files, database, and view statistics
+
+Mounted on the main server (app.py) as a blueprint at /admin, so it shares
+the kiosk's connection pool, schema and stats cache instead of running as
+a second process.
 """
-from flask import Flask, render_template_string, jsonify, request, send_file
-import sqlite3
+from flask import Blueprint, Response, jsonify, request
+import hashlib
 import os
 from datetime import datetime
-import shutil
-
-app = Flask(__name__)
 
-# Configuration
-DATABASE = 'pisoprint.db'
-UPLOAD_FOLDER = 'uploads'
+from reports import parse_report_range, peak_hours, query_usage
 
-def get_db():
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
-    return db
+# Rows per page for the JSON endpoints
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
-# Admin Dashboard HTML Template
-ADMIN_TEMPLATE = """
+# Admin dashboard page: a static shell, the data comes from /admin/api/*
+ADMIN_PAGE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -186,6 +184,10 @@ ADMIN_TEMPLATE = """
             color: #721c24;
         }
         #message { display: none; }
+        .more {
+            text-align: center;
+            margin-top: 10px;
+        }
     </style>
 </head>
 <body>
@@ -199,19 +201,19 @@ ADMIN_TEMPLATE = """
         <div class="stats">
             <div class="stat-card">
                 <h3>📄 Total Files</h3>
-                <div class="value" id="totalFiles">{{ stats.total_files }}</div>
+                <div class="value" id="totalFiles">–</div>
             </div>
             <div class="stat-card">
                 <h3>💾 Disk Usage</h3>
-                <div class="value" id="diskUsage">{{ stats.disk_usage_mb }} MB</div>
+                <div class="value" id="diskUsage">–</div>
             </div>
             <div class="stat-card">
                 <h3>👥 Total Users</h3>
-                <div class="value" id="totalUsers">{{ stats.total_users }}</div>
+                <div class="value" id="totalUsers">–</div>
             </div>
             <div class="stat-card">
                 <h3>💰 Total Revenue</h3>
-                <div class="value" id="totalRevenue">₱{{ stats.total_revenue }}</div>
+                <div class="value" id="totalRevenue">–</div>
             </div>
         </div>
         
@@ -225,18 +227,24 @@ ADMIN_TEMPLATE = """
                 <button class="btn btn-danger" onclick="deleteOldFiles()">
                     🗑️ Delete Files Older Than 7 Days
                 </button>
+                <button class="btn btn-primary" onclick="archiveNow()">
+                    📦 Archive Old Months
+                </button>
+                <button class="btn btn-primary" onclick="runMaintenance()">
+                    🛠️ Run Maintenance &amp; Backup
+                </button>
                 <button class="btn btn-danger" onclick="if(confirm('⚠️ This will delete ALL files and records! Continue?')) clearAllData()">
                     💣 Clear All Data
                 </button>
-                <button class="btn btn-success" onclick="location.reload()">
-                    🔄 Refresh Stats
+                <button class="btn btn-success" onclick="refresh()">
+                    🔄 Refresh
                 </button>
             </div>
         </div>
         
         <!-- Recent Files -->
         <div class="section">
-            <h2>📁 Recent Files (Last 20)</h2>
+            <h2>📁 Recent Files</h2>
             <table>
                 <thead>
                     <tr>
@@ -250,28 +258,36 @@ ADMIN_TEMPLATE = """
                         <th>Actions</th>
                     </tr>
                 </thead>
-                <tbody>
-                    {% for file in files %}
+                <tbody id="fileRows"></tbody>
+            </table>
+            <div class="more">
+                <button class="btn btn-primary" id="moreFiles" onclick="loadFiles()">Load more</button>
+            </div>
+        </div>
+        
+        <!-- Revenue -->
+        <div class="section">
+            <h2>💰 Revenue</h2>
+            <div class="actions">
+                <select id="reportPeriod" onchange="loadReport()">
+                    <option value="day">Daily (last 30 days)</option>
+                    <option value="month">Monthly (last 12 months)</option>
+                    <option value="hour">Hourly (last 2 days)</option>
+                </select>
+            </div>
+            <table>
+                <thead>
                     <tr>
-                        <td>{{ file.file_id }}</td>
-                        <td>{{ file.filename }}</td>
-                        <td>{{ file.session_id }}</td>
-                        <td>{{ (file.file_size / 1024) | round(1) }} KB</td>
-                        <td>{{ file.pages }}</td>
-                        <td>
-                            {% if file.file_exists %}
-                            <span class="badge badge-success">✅ Exists</span>
-                            {% else %}
-                            <span class="badge badge-danger">❌ Missing</span>
-                            {% endif %}
-                        </td>
-                        <td>{{ file.created_at }}</td>
-                        <td>
-                            <button class="btn btn-danger" onclick="deleteFile({{ file.file_id }})">Delete</button>
-                        </td>
+                        <th>Period</th>
+                        <th>Jobs</th>
+                        <th>Pages</th>
+                        <th>Revenue</th>
+                        <th>Refunds</th>
+                        <th>Net</th>
+                        <th>Coins In</th>
                     </tr>
-                    {% endfor %}
-                </tbody>
+                </thead>
+                <tbody id="reportRows"></tbody>
             </table>
         </div>
         
@@ -288,22 +304,21 @@ ADMIN_TEMPLATE = """
                         <th>Last Active</th>
                     </tr>
                 </thead>
-                <tbody>
-                    {% for user in users %}
-                    <tr>
-                        <td>{{ user.user_id }}</td>
-                        <td>{{ user.session_id }}</td>
-                        <td>₱{{ user.credits }}</td>
-                        <td>{{ user.file_count }}</td>
-                        <td>{{ user.last_active }}</td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
+                <tbody id="userRows"></tbody>
             </table>
+            <div class="more">
+                <button class="btn btn-primary" id="moreUsers" onclick="loadUsers()">Load more</button>
+            </div>
         </div>
     </div>
     
     <script>
+        // Tables are filled page by page from the JSON API; actions update
+        // only what changed instead of reloading the whole dashboard.
+        let oldestFileId = null;   // Cursor for "Load more" (older files)
+        let newestFileId = 0;      // Refresh fetches only files newer than this
+        let oldestUserId = null;
+        
         function showMessage(msg, type) {
             const el = document.getElementById('message');
             el.textContent = msg;
@@ -312,211 +327,484 @@ ADMIN_TEMPLATE = """
             setTimeout(() => { el.style.display = 'none'; }, 5000);
         }
         
-        function cleanOrphanedRecords() {
-            if (!confirm('Remove database records for missing files?')) return;
-            
-            fetch('/admin/clean-orphaned', { method: 'POST' })
+        function getJSON(url) {
+            return fetch(url).then(r => r.json()).then(data => {
+                if (!data.success) throw new Error(data.message || 'Request failed');
+                return data;
+            });
+        }
+        
+        function cell(row, text) {
+            const td = document.createElement('td');
+            td.textContent = text;
+            row.appendChild(td);
+            return td;
+        }
+        
+        function fileRow(file) {
+            const row = document.createElement('tr');
+            row.id = 'file-' + file.file_id;
+            cell(row, file.file_id);
+            cell(row, file.filename);
+            cell(row, file.session_id);
+            cell(row, (file.file_size / 1024).toFixed(1) + ' KB');
+            cell(row, file.pages);
+            const badge = document.createElement('span');
+            badge.className = 'badge ' + (file.file_exists ? 'badge-success' : 'badge-danger');
+            badge.textContent = file.file_exists ? '✅ Exists' : '❌ Missing';
+            cell(row, '').appendChild(badge);
+            cell(row, file.created_at);
+            const button = document.createElement('button');
+            button.className = 'btn btn-danger';
+            button.textContent = 'Delete';
+            button.onclick = () => deleteFile(file.file_id);
+            cell(row, '').appendChild(button);
+            return row;
+        }
+        
+        function userRow(user) {
+            const row = document.createElement('tr');
+            cell(row, user.user_id);
+            cell(row, user.session_id);
+            cell(row, '₱' + user.credits);
+            cell(row, user.file_count);
+            cell(row, user.last_active || '');
+            return row;
+        }
+        
+        function loadStats() {
+            return getJSON('/admin/api/stats').then(data => {
+                const stats = data.stats;
+                document.getElementById('totalFiles').textContent = stats.total_files;
+                document.getElementById('diskUsage').textContent = stats.disk_usage_mb + ' MB';
+                document.getElementById('totalUsers').textContent = stats.total_users;
+                document.getElementById('totalRevenue').textContent = '₱' + stats.total_revenue;
+            });
+        }
+        
+        function loadFiles() {
+            let url = '/admin/api/files';
+            if (oldestFileId !== null) url += '?before=' + oldestFileId;
+            return getJSON(url).then(data => {
+                const body = document.getElementById('fileRows');
+                data.files.forEach(file => body.appendChild(fileRow(file)));
+                if (data.files.length) {
+                    oldestFileId = data.files[data.files.length - 1].file_id;
+                    newestFileId = Math.max(newestFileId, data.files[0].file_id);
+                }
+                document.getElementById('moreFiles').style.display = data.next_before ? '' : 'none';
+            });
+        }
+        
+        function loadNewFiles() {
+            // Prepend uploads that arrived since the last load
+            return getJSON('/admin/api/files?after=' + newestFileId).then(data => {
+                const body = document.getElementById('fileRows');
+                data.files.slice().reverse().forEach(file => {
+                    body.insertBefore(fileRow(file), body.firstChild);
+                    newestFileId = Math.max(newestFileId, file.file_id);
+                });
+            });
+        }
+        
+        function loadUsers() {
+            let url = '/admin/api/users';
+            if (oldestUserId !== null) url += '?before=' + oldestUserId;
+            return getJSON(url).then(data => {
+                const body = document.getElementById('userRows');
+                data.users.forEach(user => body.appendChild(userRow(user)));
+                if (data.users.length) oldestUserId = data.users[data.users.length - 1].user_id;
+                document.getElementById('moreUsers').style.display = data.next_before ? '' : 'none';
+            });
+        }
+        
+        function reloadTables() {
+            oldestFileId = null;
+            newestFileId = 0;
+            oldestUserId = null;
+            document.getElementById('fileRows').replaceChildren();
+            document.getElementById('userRows').replaceChildren();
+            return Promise.all([loadFiles(), loadUsers()]);
+        }
+        
+        function refresh() {
+            Promise.all([loadStats(), loadNewFiles()])
+                .catch(err => showMessage('Error: ' + err.message, 'error'));
+        }
+        
+        function runAction(url, method) {
+            return fetch(url, { method: method })
                 .then(r => r.json())
                 .then(data => {
-                    showMessage(data.message, 'success');
-                    setTimeout(() => location.reload(), 2000);
+                    showMessage(data.message, data.success ? 'success' : 'error');
+                    return data;
                 })
                 .catch(err => {
                     showMessage('Error: ' + err, 'error');
                 });
         }
         
+        function cleanOrphanedRecords() {
+            if (!confirm('Remove database records for missing files?')) return;
+            runAction('/admin/clean-orphaned', 'POST').then(() => Promise.all([loadStats(), reloadTables()]));
+        }
+        
         function deleteOldFiles() {
             if (!confirm('Delete files older than 7 days?')) return;
-            
-            fetch('/admin/delete-old', { method: 'POST' })
-                .then(r => r.json())
-                .then(data => {
-                    showMessage(data.message, 'success');
-                    setTimeout(() => location.reload(), 2000);
-                })
-                .catch(err => {
-                    showMessage('Error: ' + err, 'error');
-                });
+            runAction('/admin/delete-old', 'POST').then(() => Promise.all([loadStats(), reloadTables()]));
+        }
+        
+        function archiveNow() {
+            runAction('/admin/archive', 'POST').then(() => loadStats());
+        }
+        
+        function runMaintenance() {
+            if (!confirm('Run database maintenance and a backup now? Printing may be slower meanwhile.')) return;
+            runAction('/admin/maintenance', 'POST').then(() => loadStats());
         }
         
         function clearAllData() {
-            fetch('/admin/clear-all', { method: 'POST' })
-                .then(r => r.json())
-                .then(data => {
-                    showMessage(data.message, 'success');
-                    setTimeout(() => location.reload(), 2000);
-                })
-                .catch(err => {
-                    showMessage('Error: ' + err, 'error');
-                });
+            runAction('/admin/clear-all', 'POST').then(() => Promise.all([loadStats(), reloadTables()]));
         }
         
         function deleteFile(fileId) {
             if (!confirm('Delete this file?')) return;
-            
-            fetch('/admin/delete-file/' + fileId, { method: 'DELETE' })
-                .then(r => r.json())
-                .then(data => {
-                    showMessage(data.message, 'success');
-                    setTimeout(() => location.reload(), 1000);
-                })
-                .catch(err => {
-                    showMessage('Error: ' + err, 'error');
+            runAction('/admin/delete-file/' + fileId, 'DELETE').then(data => {
+                if (!data || !data.success) return;
+                const row = document.getElementById('file-' + fileId);
+                if (row) row.remove();
+                loadStats();
+            });
+        }
+        
+        function loadReport() {
+            const period = document.getElementById('reportPeriod').value;
+            const days = { day: 30, month: 365, hour: 2 }[period];
+            const start = new Date(Date.now() - (days - 1) * 86400000).toISOString().slice(0, 10);
+            return getJSON('/admin/api/reports?period=' + period + '&start=' + start).then(data => {
+                const body = document.getElementById('reportRows');
+                body.replaceChildren();
+                data.rows.slice().reverse().forEach(item => {
+                    const row = document.createElement('tr');
+                    cell(row, item.bucket);
+                    cell(row, item.jobs);
+                    cell(row, item.pages);
+                    cell(row, '₱' + item.revenue);
+                    cell(row, '₱' + item.refunds);
+                    cell(row, '₱' + item.net_revenue);
+                    cell(row, '₱' + item.coins);
+                    body.appendChild(row);
                 });
+            });
         }
+        
+        Promise.all([loadStats(), loadFiles(), loadUsers(), loadReport()])
+            .catch(err => showMessage('Error: ' + err.message, 'error'));
     </script>
 </body>
 </html>
 """
 
-@app.route('/admin')
-def admin_dashboard():
-    """Admin dashboard page"""
-    db = get_db()
-    
-    # Get statistics
-    stats = {}
-    stats['total_files'] = db.execute('SELECT COUNT(*) as count FROM files').fetchone()['count']
-    stats['total_users'] = db.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
-    
-    # Calculate disk usage
-    disk_usage = 0
-    if os.path.exists(UPLOAD_FOLDER):
-        for file in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, file)
-            if os.path.isfile(filepath):
-                disk_usage += os.path.getsize(filepath)
-    stats['disk_usage_mb'] = round(disk_usage / 1024 / 1024, 2)
-    
-    # Calculate total revenue
-    result = db.execute('SELECT SUM(pages) as total FROM files').fetchone()
-    stats['total_revenue'] = result['total'] if result['total'] else 0
-    
-    # Get recent files
-    files = []
-    for row in db.execute('SELECT * FROM files ORDER BY file_id DESC LIMIT 20').fetchall():
-        file_dict = dict(row)
-        # Check if file exists
-        file_dict['file_exists'] = os.path.exists(row['file_path']) if row['file_path'] else False
-        files.append(file_dict)
-    
-    # Get users with activity
-    users = db.execute('''
-        SELECT u.*, COUNT(f.file_id) as file_count, MAX(f.created_at) as last_active
-        FROM users u
-        LEFT JOIN files f ON u.session_id = f.session_id
-        GROUP BY u.user_id
-        ORDER BY last_active DESC
-        LIMIT 10
-    ''').fetchall()
-    
-    db.close()
-    
-    return render_template_string(ADMIN_TEMPLATE, stats=stats, files=files, users=[dict(u) for u in users])
+# The page never changes while the server runs, so it's encoded and hashed once
+ADMIN_PAGE_BYTES = ADMIN_PAGE.encode('utf-8')
+ADMIN_PAGE_ETAG = hashlib.sha1(ADMIN_PAGE_BYTES).hexdigest()
 
-@app.route('/admin/clean-orphaned', methods=['POST'])
-def clean_orphaned():
-    """Remove database records for files that don't exist"""
-    db = get_db()
+def page_args():
+    """Keyset pagination arguments: (limit, before_id, after_id)"""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, request.args.get('before', type=int), request.args.get('after', type=int)
+
+def no_store(response):
+    """Data responses must not be cached (the shell page is)"""
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def create_admin_blueprint(get_db, get_report_db, file_store, stats_cache, archiver, maintenance,
+                           on_data_changed=None):
+    """Admin routes bound to the server's database, file store and stats cache.
     
-    # Get all files
-    files = db.execute('SELECT file_id, file_path FROM files').fetchall()
-    deleted_count = 0
+    Tables are read through get_report_db() (read-only snapshot
+    connections); only the cleanup actions use get_db(). on_data_changed()
+    is called after actions that delete files or users, so the server can
+    drop cached rows.
+    """
+    admin = Blueprint('admin', __name__, url_prefix='/admin')
     
-    for file in files:
-        if not os.path.exists(file['file_path']):
-            db.execute('DELETE FROM files WHERE file_id = ?', (file['file_id'],))
-            deleted_count += 1
+    def data_changed():
+        stats_cache.invalidate()
+        if on_data_changed:
+            on_data_changed()
     
-    db.commit()
-    db.close()
+    @admin.route('')
+    def admin_dashboard():
+        """Admin dashboard page (static, revalidated with its ETag)"""
+        response = Response(ADMIN_PAGE_BYTES, mimetype='text/html')
+        response.set_etag(ADMIN_PAGE_ETAG)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     
-    return jsonify({
-        'success': True,
-        'message': f'✅ Cleaned {deleted_count} orphaned records'
-    })
-
-@app.route('/admin/delete-old', methods=['POST'])
-def delete_old_files():
-    """Delete files older than 7 days"""
-    db = get_db()
+    @admin.route('/api/stats')
+    def api_stats():
+        """Dashboard totals (cached for a few seconds, shared with /api/status)"""
+        return no_store(jsonify({'success': True, 'stats': stats_cache.get()}))
     
-    # Get files older than 7 days
-    seven_days_ago = datetime.now().timestamp() - (7 * 24 * 60 * 60)
+    @admin.route('/api/files')
+    def api_files():
+        """Files newest first, one page at a time.
+        
+        ?before=<id> continues with older files, ?after=<id> returns only
+        files uploaded since (for refreshing the top of the table).
+        """
+        limit, before, after = page_args()
+        
+        where, params = [], []
+        if before is not None:
+            where.append('id < ?')
+            params.append(before)
+        if after is not None:
+            where.append('id > ?')
+            params.append(after)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+        
+        db = get_report_db()
+        rows = db.execute(f'''
+            SELECT id as file_id, session_id, filename, file_path, file_size, pages, uploaded_at as created_at
+            FROM files
+            {where_sql}
+            ORDER BY id DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+        db.close()
+        
+        files = []
+        for row in rows[:limit]:
+            file_dict = dict(row)
+            # Check if file exists
+            file_dict['file_exists'] = os.path.exists(row['file_path']) if row['file_path'] else False
+            del file_dict['file_path']
+            files.append(file_dict)
+        
+        return no_store(jsonify({
+            'success': True,
+            'files': files,
+            'next_before': files[-1]['file_id'] if len(rows) > limit else None
+        }))
     
-    files = db.execute('''
-        SELECT file_id, file_path 
-        FROM files 
-        WHERE strftime('%s', created_at) < ?
-    ''', (seven_days_ago,)).fetchall()
+    @admin.route('/api/users')
+    def api_users():
+        """Users newest first, one page at a time (?before=<id> for older)"""
+        limit, before, _ = page_args()
+        
+        db = get_report_db()
+        # Per-user totals only for the rows on this page (uses idx_files_session)
+        rows = db.execute('''
+            SELECT u.id as user_id, u.session_id, u.credits,
+                   (SELECT COUNT(*) FROM files f WHERE f.session_id = u.session_id) as file_count,
+                   (SELECT MAX(f.uploaded_at) FROM files f WHERE f.session_id = u.session_id) as last_active
+            FROM users u
+            WHERE ? IS NULL OR u.id < ?
+            ORDER BY u.id DESC
+            LIMIT ?
+        ''', (before, before, limit + 1)).fetchall()
+        db.close()
+        
+        users = [dict(row) for row in rows[:limit]]
+        
+        return no_store(jsonify({
+            'success': True,
+            'users': users,
+            'next_before': users[-1]['user_id'] if len(rows) > limit else None
+        }))
     
-    deleted_count = 0
-    for file in files:
-        # Delete physical file
-        if os.path.exists(file['file_path']):
-            os.remove(file['file_path'])
-        
-        # Delete database record
-        db.execute('DELETE FROM files WHERE file_id = ?', (file['file_id'],))
-        deleted_count += 1
+    @admin.route('/api/reports')
+    def api_reports():
+        """Revenue and usage per hour/day/month from the rollup tables.
+        
+        ?period=hour|day|month (default day), ?start= and ?end= as
+        YYYY-MM-DD or YYYY-MM, inclusive (default: the last 30 days).
+        """
+        try:
+            period = request.args.get('period', 'day')
+            start, end = parse_report_range(period, request.args.get('start'), request.args.get('end'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        
+        db = get_report_db()
+        rows = query_usage(db, period, start, end)
+        db.close()
+        
+        totals = {key: sum(row[key] for row in rows)
+                  for key in ('jobs', 'pages', 'revenue', 'refunds', 'net_revenue', 'coins')}
+        
+        return no_store(jsonify({
+            'success': True,
+            'period': period,
+            'start': start,
+            'end': end,
+            'rows': rows,
+            'totals': totals
+        }))
     
-    db.commit()
-    db.close()
+    @admin.route('/api/reports/peak-hours')
+    def api_peak_hours():
+        """Jobs and revenue by hour of day over a date range (default 30 days)"""
+        try:
+            start, end = parse_report_range('hour', request.args.get('start'), request.args.get('end'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        
+        db = get_report_db()
+        hours = peak_hours(db, start, end)
+        db.close()
+        
+        return no_store(jsonify({'success': True, 'start': start, 'end': end, 'hours': hours}))
     
-    return jsonify({
-        'success': True,
-        'message': f'✅ Deleted {deleted_count} old files'
-    })
-
-@app.route('/admin/clear-all', methods=['POST'])
-def clear_all():
-    """Clear all files and database records"""
-    db = get_db()
+    @admin.route('/api/archives')
+    def api_archives():
+        """Monthly archives of old jobs and transactions"""
+        return no_store(jsonify({'success': True, 'archives': archiver.list_archives()}))
     
-    # Delete all physical files
-    if os.path.exists(UPLOAD_FOLDER):
-        for file in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, file)
-            if os.path.isfile(filepath):
-                os.remove(filepath)
+    @admin.route('/archive', methods=['POST'])
+    def archive_now():
+        """Archive closed months now instead of waiting for the daily run"""
+        pending = archiver.backfill_pending()
+        if pending:
+            return jsonify({
+                'success': False,
+                'message': f'Reports are still being rebuilt from {", ".join(pending)}; archive later'
+            }), 409
+        moved = archiver.run()
+        data_changed()
+        
+        return jsonify({
+            'success': True,
+            'archived': moved,
+            'message': f'✅ Archived {sum(moved.values())} rows from {len(moved)} month(s)'
+        })
     
-    # Clear database
-    db.execute('DELETE FROM files')
-    db.execute('DELETE FROM users')
-    db.execute("DELETE FROM sqlite_sequence WHERE name IN ('files', 'users')")
-    db.commit()
-    db.close()
+    @admin.route('/api/maintenance')
+    def api_maintenance():
+        """Database maintenance tasks and when they last ran"""
+        return no_store(jsonify({'success': True, 'tasks': maintenance.status()}))
     
-    return jsonify({
-        'success': True,
-        'message': '✅ All data cleared!'
-    })
-
-@app.route('/admin/delete-file/<int:file_id>', methods=['DELETE'])
-def delete_file(file_id):
-    """Delete a specific file"""
-    db = get_db()
+    @admin.route('/maintenance', methods=['POST'])
+    def run_maintenance():
+        """Run every maintenance task now, even if the kiosk is busy"""
+        results = maintenance.run_due(force=True)
+        data_changed()
+        
+        return jsonify({
+            'success': bool(results),
+            'results': results,
+            'message': '✅ Maintenance finished' if results else 'Maintenance is already running'
+        })
     
-    # Get file info
-    file = db.execute('SELECT file_path FROM files WHERE file_id = ?', (file_id,)).fetchone()
+    @admin.route('/clean-orphaned', methods=['POST'])
+    def clean_orphaned():
+        """Remove database records for files that don't exist"""
+        db = get_db()
+        
+        # Get all files
+        files = db.execute('SELECT id, file_path FROM files').fetchall()
+        deleted_count = 0
+        
+        for file in files:
+            if not os.path.exists(file['file_path']):
+                db.execute('DELETE FROM files WHERE id = ?', (file['id'],))
+                deleted_count += 1
+        
+        db.commit()
+        db.close()
+        data_changed()
+        
+        return jsonify({
+            'success': True,
+            'message': f'✅ Cleaned {deleted_count} orphaned records'
+        })
     
-    if file:
-        # Delete physical file
-        if os.path.exists(file['file_path']):
-            os.remove(file['file_path'])
+    @admin.route('/delete-old', methods=['POST'])
+    def delete_old_files():
+        """Delete files older than 7 days"""
+        db = get_db()
+        
+        # Get files older than 7 days
+        seven_days_ago = datetime.now().timestamp() - (7 * 24 * 60 * 60)
+        
+        files = db.execute('''
+            SELECT id, file_path 
+            FROM files 
+            WHERE CAST(strftime('%s', uploaded_at) AS INTEGER) < ?
+        ''', (int(seven_days_ago),)).fetchall()
+        
+        deleted_count = 0
+        for file in files:
+            # Delete physical file (and any converted PDF next to it)
+            file_store.delete(file['file_path'])
+            
+            # Delete database record
+            db.execute('DELETE FROM files WHERE id = ?', (file['id'],))
+            deleted_count += 1
         
-        # Delete database record
-        db.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
         db.commit()
+        db.close()
+        data_changed()
+        
+        return jsonify({
+            'success': True,
+            'message': f'✅ Deleted {deleted_count} old files'
+        })
     
-    db.close()
+    @admin.route('/clear-all', methods=['POST'])
+    def clear_all():
+        """Clear all files and database records"""
+        db = get_db()
+        
+        # Delete all physical files listed in the index
+        for file in db.execute('SELECT file_path FROM files').fetchall():
+            file_store.delete(file['file_path'])
+        
+        # Clear database
+        db.execute('DELETE FROM files')
+        db.execute('DELETE FROM users')
+        db.execute("DELETE FROM sqlite_sequence WHERE name IN ('files', 'users')")
+        db.commit()
+        db.close()
+        data_changed()
+        
+        return jsonify({
+            'success': True,
+            'message': '✅ All data cleared!'
+        })
+    
+    @admin.route('/delete-file/<int:file_id>', methods=['DELETE'])
+    def delete_file(file_id):
+        """Delete a specific file"""
+        db = get_db()
+        
+        # Get file info
+        file = db.execute('SELECT file_path FROM files WHERE id = ?', (file_id,)).fetchone()
+        
+        if file:
+            # Delete physical file (and any converted PDF next to it)
+            file_store.delete(file['file_path'])
+            
+            # Delete database record
+            db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+            db.commit()
+        
+        db.close()
+        data_changed()
+        
+        return jsonify({
+            'success': True,
+            'message': f'✅ File {file_id} deleted'
+        })
     
-    return jsonify({
-        'success': True,
-        'message': f'✅ File {file_id} deleted'
-    })
+    return admin
 
 if __name__ == '__main__':
-    # Run on port 5001 (different from main app)
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # The dashboard is part of the main server now: start that instead
+    from app import main
+    print("ℹ️  The admin dashboard is served by app.py at http://0.0.0.0:5000/admin")
+    main()
@@ -7,7 +7,7 @@ Handles file uploads, printing, and credit management
 
 # Import required modules with error handling
 try:
-    from flask import Flask, request, jsonify, send_from_directory
+    from flask import Flask, Request, request, jsonify, send_from_directory, g, Response
     from flask_cors import CORS
     from werkzeug.utils import secure_filename
 except ImportError as e:
@@ -17,12 +17,38 @@ except ImportError as e:
     print(f"\nDetails: {e}")
     exit(1)
 
-import sqlite3
 import os
+import atexit
 import hashlib
+import signal
+import sys
 from datetime import datetime
 import logging
 import subprocess
+import json
+import math
+import threading
+import time
+import uuid
+
+import metrics
+from log_config import setup_logging
+from db import ConnectionPool, StatsCache, collect_stats, enable_wal, init_schema
+from admin import create_admin_blueprint
+from reports import RollupBackfill
+from archive import Archiver
+import maintenance
+from maintenance import MaintenanceScheduler, RequestRateMeter
+from events import EventBus, TooManySubscribers, parse_last_event_id
+from session_cache import SessionCache
+from sessions import SESSION_ID_PATTERN, ActivityTracker, SessionStore, new_session_id
+from credits import CreditLedger, InsufficientCredits
+from artifacts import ArtifactPipeline, STATUS_PENDING, STATUS_READY, STATUS_FAILED
+from print_scheduler import PrintScheduler, format_page_ranges
+from storage import FileStore
+import filetypes
+from filetypes import SniffingFile, UnsupportedContent
+from tracing import tracer
 
 # Optional imports - gracefully handle if not available
 try:
@@ -54,98 +80,136 @@ except ImportError:
     PIL_AVAILABLE = False
     print("⚠️  Warning: Pillow not available - image support limited")
 
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+    print("⚠️  Warning: msgpack not available - compact responses are text only")
+
 # ============================================
 # Configuration
 # ============================================
+class UploadRequest(Request):
+    """Request that streams multipart file parts straight into the file store.
+
+    Werkzeug normally spools file parts in memory or /tmp, and file.save()
+    then copies them again. Here each part is written once, to a hidden temp
+    file in the file store, and renamed into its shard directory (see
+    store_uploaded_file). The multipart parser reads in fixed-size blocks,
+    so memory per upload stays bounded. If the whole request fits the
+    staging budget, the parts are written to the RAM tier. Each part's
+    first bytes are checked as they arrive (see filetypes.SniffingFile).
+    """
+
+    staging_reserved = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.staging_reserved is None:
+            self.staging_reserved = 0
+            if total_content_length and file_store.reserve_staging(total_content_length):
+                self.staging_reserved = total_content_length
+        stream = file_store.temp_file(staged=self.staging_reserved > 0)
+        self.upload_temp_files = getattr(self, 'upload_temp_files', []) + [stream.name]
+        extension = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+        return SniffingFile(stream, extension)
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 CORS(app)
 
-UPLOAD_FOLDER = '/home/pisoprint/uploads'
-DATABASE = '/home/pisoprint/pisoprint.db'
+# Paths can be overridden from the environment (development, benchmarks)
+UPLOAD_FOLDER = os.environ.get('PISOPRINT_UPLOAD_FOLDER', '/home/pisoprint/uploads')
+DATABASE = os.environ.get('PISOPRINT_DATABASE', '/home/pisoprint/pisoprint.db')
+ARCHIVE_FOLDER = os.environ.get('PISOPRINT_ARCHIVE_FOLDER', '/home/pisoprint/archive')
+BACKUP_FOLDER = os.environ.get('PISOPRINT_BACKUP_FOLDER', '/home/pisoprint/backups')
+STAGING_FOLDER = os.environ.get('PISOPRINT_STAGING_FOLDER', '/dev/shm/pisoprint')  # tmpfs; empty disables
 ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'jpg', 'jpeg', 'png', 'txt'}
-PRICE_PER_PAGE = 1  # ₱1 per page
+PRICE_PER_PAGE = 1  # ₱1 per printed side
 DEFAULT_PRINTER = 'PisoPrinter'  # Change to your CUPS printer name
+MAX_COPIES = 20  # Upper limit for copies in a single print request
+PRINT_SCHEDULER_POLICY = 'sjf'  # 'sjf' (shortest job first) or 'round_robin'
+PRINT_CHUNK_PAGES = 20  # Large jobs are released to CUPS in chunks of this many pages
+ARTIFACT_WORKERS = 1  # Background threads preparing uploads (soffice is heavy on the Pi)
+ARTIFACT_RENDERING = True  # Pre-render uploads through the printer's CUPS filter chain
+ARTIFACT_RENDER_TIMEOUT = 120  # Seconds allowed for one cupsfilter run
+CONVERSION_WAIT_SECONDS = 4  # How long /print waits for a Word file's PDF (the ESP32 gives up after 10 s)
+CUPS_PPD_DIR = '/etc/cups/ppd'
+CUPS_FINAL_STATES = {7: 'canceled', 8: 'aborted', 9: 'completed'}  # IPP job-state values
+MAX_COIN_BATCH = 100  # Coin events accepted in one /api/credits/batch request
+UPLOAD_PROGRESS_STEP = 64 * 1024  # Bytes between 'upload' progress events
+EVENT_STREAM_LIMIT = 10  # Open /api/events streams; each holds one of gunicorn's 16 threads
+SESSION_CACHE_SIZE = 1024  # User rows kept in memory
+SESSION_CACHE_TTL = 60  # Seconds before a cached user row is re-read from SQLite
+SESSION_IDLE_SECONDS = 24 * 3600  # Zero-balance sessions idle this long are purged
+SESSION_PURGE_BATCH = 500  # Sessions deleted per transaction when purging
+ACTIVITY_FLUSH_SECONDS = 5  # last_activity touches are written in one batch this often
+DB_POOL_SIZE = 4  # Idle SQLite connections kept open for reuse
+REPORT_POOL_SIZE = 2  # Idle read-only connections for dashboards and history
+STATS_CACHE_TTL = 10  # Seconds /api/status and the admin dashboard reuse their totals
+ARCHIVE_KEEP_MONTHS = 2  # Full months of jobs/transactions kept live before archiving
+MAINTENANCE_IDLE_REQUESTS = 5  # Maintenance runs only with at most this many requests in the last minute
+MAINTENANCE_INTERVALS = {  # Seconds between runs of each maintenance task
+    'checkpoint': 10 * 60,
+    'optimize': 3600,
+    'analyze': 24 * 3600,
+    'sessions': 3600,
+    'staging': 10 * 60,
+    'archive': 24 * 3600,
+    'vacuum': 24 * 3600,
+    'backup': 24 * 3600,
+}
+BACKUP_KEEP = 3  # Daily backups kept in BACKUP_FOLDER
+STAGING_BUDGET = 64 * 1024 * 1024  # RAM for uploads and conversions not yet printed (0 disables)
+STAGING_MAX_AGE = 2 * 3600  # Never-printed uploads still in RAM after this long are deleted
+
+# Uploads are stored as <UPLOAD_FOLDER>/ab/cd/<id>.<ext> (see storage.py),
+# staged in RAM under STAGING_FOLDER until they are printed
+file_store = FileStore(UPLOAD_FOLDER, staging_root=STAGING_FOLDER, staging_budget=STAGING_BUDGET)
+file_store.sweep_temp_files()
+
+# Progress events pushed to clients per session (GET /api/events)
+event_bus = EventBus(max_subscribers=EVENT_STREAM_LIMIT)
 
-# Ensure upload folder exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Read cache for user rows; credit changes are committed first (see session_cache.py)
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL,
+                             on_lookup=lambda result: metrics.cache_lookups.inc('session', result))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+# Logging: records go through a queue and are written as JSON lines by a
+# background thread, so request threads never block on journald/SD card I/O
+LOG_LEVEL = 'INFO'
+LOG_JSON = True
+LOG_MODULE_LEVELS = {'werkzeug': 'WARNING'}  # Per-logger levels, e.g. {'pisoprint.db': 'DEBUG'}
+LOG_SAMPLE_RATES = {'pisoprint.upload': 1}   # Keep 1 in N INFO/DEBUG records per logger
+
+setup_logging(LOG_LEVEL, LOG_JSON, LOG_MODULE_LEVELS, LOG_SAMPLE_RATES)
+logger = logging.getLogger('pisoprint')
+upload_logger = logger.getChild('upload')
+db_logger = logger.getChild('db')
 
 # ============================================
 # Database Setup
 # ============================================
+# Tables, indexes and migrations live in db.py, shared with the admin dashboard
+db_pool = ConnectionPool(DATABASE, size=DB_POOL_SIZE, factory=metrics.InstrumentedConnection)
+# Heavy reads (stats, admin tables, history) read WAL snapshots on their own connections
+report_pool = ConnectionPool(DATABASE, size=REPORT_POOL_SIZE, factory=metrics.InstrumentedConnection,
+                             read_only=True)
+
 def init_db():
     """Initialize SQLite database with tables"""
     logger.info("Initializing database...")
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT UNIQUE NOT NULL,
-            credits INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Files table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            original_name TEXT NOT NULL,
-            file_path TEXT NOT NULL,
-            file_size INTEGER,
-            pages INTEGER,
-            file_type TEXT,
-            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES users(session_id)
-        )
-    ''')
-    
-    # Transactions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            type TEXT NOT NULL,
-            amount INTEGER NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES users(session_id)
-        )
-    ''')
-    
-    # Print jobs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS print_jobs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            file_id INTEGER NOT NULL,
-            pages INTEGER NOT NULL,
-            cost INTEGER NOT NULL,
-            status TEXT DEFAULT 'printing',
-            printed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES users(session_id),
-            FOREIGN KEY (file_id) REFERENCES files(id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    conn = db_pool.connect()
+    try:
+        enable_wal(conn)
+        init_schema(conn)
+    finally:
+        conn.close()
     logger.info("Database initialized successfully")
 
 # Initialize database on startup
@@ -158,47 +222,176 @@ if CUPS_AVAILABLE:
     try:
         conn_cups = cups.Connection()
         printers = conn_cups.getPrinters()
-        logger.info(f"CUPS connected. Available printers: {list(printers.keys())}")
+        logger.info("CUPS connected. Available printers: %s", list(printers.keys()))
     except Exception as e:
-        logger.error(f"CUPS connection failed: {e}")
+        logger.error("CUPS connection failed: %s", e)
         conn_cups = None
 else:
     conn_cups = None
     logger.warning("CUPS not available - printer functionality disabled")
 
+# One pycups connection is shared by request threads and the print scheduler,
+# and it is not thread-safe: every call on conn_cups goes through this lock
+cups_lock = threading.Lock()
+
 # ============================================
 # Helper Functions
 # ============================================
+def elapsed_ms(started):
+    """Milliseconds since a time.perf_counter() value, for log records"""
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def start_request_trace(name, session_id):
+    """Start a pipeline trace for this request (finished in after_request)"""
+    trace = tracer.start_trace(name, session_id=session_id)
+    g.trace = trace
+    g.trace_id = trace.trace_id
+    return trace
+
+# Compact responses for the ESP32: "Accept: text/x-pisoprint" returns one
+# line of comma-separated fields in a fixed order instead of JSON, and
+# "Accept: application/x-msgpack" the same fields as a MessagePack array.
+# The first field is 1 (success) or 0, the second a short error code.
+COMPACT_TEXT = 'text/x-pisoprint'
+COMPACT_MSGPACK = 'application/x-msgpack'
+
+def compact_format():
+    """Compact response type the client asked for, or None for JSON"""
+    accept = request.headers.get('Accept', '')
+    if COMPACT_MSGPACK in accept and MSGPACK_AVAILABLE:
+        return COMPACT_MSGPACK
+    if COMPACT_TEXT in accept or request.args.get('compact') == '1':
+        return COMPACT_TEXT
+    return None
+
+def api_response(payload, fields, status=200):
+    """JSON response, or the given payload fields in compact form"""
+    fmt = compact_format()
+    if fmt is None:
+        return jsonify(payload), status
+    
+    values = [1 if payload.get('success') else 0, payload.get('error', '')]
+    values += [payload.get(field) for field in fields]
+    
+    if fmt == COMPACT_MSGPACK:
+        body = msgpack.packb(values)
+    else:
+        # Commas and newlines would shift the fields, so they're dropped from text values
+        body = ','.join('' if value is None else str(value).replace(',', ' ').replace('\n', ' ')
+                        for value in values) + '\n'
+    return Response(body, status=status, mimetype=fmt)
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+def store_uploaded_file(file, extension):
+    """Move a streamed multipart upload into the file store without copying it.
 
-def get_or_create_user(session_id):
-    """Get user or create if doesn't exist"""
-    db = get_db()
-    cursor = db.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE session_id = ?', (session_id,))
-    user = cursor.fetchone()
+    Returns (storage_id, filepath).
+    """
+    stream = file.stream
+    temp_path = getattr(stream, 'name', None)
+
+    if isinstance(temp_path, str) and temp_path in getattr(request, 'upload_temp_files', ()):
+        stream.close()
+        return file_store.commit(temp_path, extension)
+
+    storage_id, filepath, _ = file_store.write_stream(stream.read, extension)
+    return storage_id, filepath
+
+def detect_upload_type(file, extension):
+    """Type of a multipart upload by content; raises UnsupportedContent"""
+    stream = file.stream
+    if isinstance(stream, SniffingFile):
+        return stream.finish()
+    head = filetypes.read_head(stream.read)
+    stream.seek(0)
+    return filetypes.check(head, extension)
+
+def upload_progress_reporter(session_id, total_bytes):
+    """Progress callback for FileStore.write_stream that publishes 'upload' events"""
+    next_report = [0]
     
-    if not user:
-        cursor.execute(
-            'INSERT INTO users (session_id, credits) VALUES (?, 0)',
-            (session_id,)
-        )
-        db.commit()
-        cursor.execute('SELECT * FROM users WHERE session_id = ?', (session_id,))
-        user = cursor.fetchone()
-        logger.info(f"Created new user: {session_id}")
+    def report(received):
+        if received >= next_report[0]:
+            next_report[0] = received + UPLOAD_PROGRESS_STEP
+            event_bus.publish(session_id, 'upload', {
+                'state': 'receiving',
+                'bytes': received,
+                'total': total_bytes
+            })
     
-    db.close()
-    return dict(user)
+    return report
+
+def get_db():
+    """Get a pooled database connection (statements are timed for /metrics).
+
+    close() returns it to the pool; uncommitted changes are rolled back.
+    """
+    return db_pool.connect()
+
+def get_report_db():
+    """Get a read-only connection for reports; it never blocks kiosk writes"""
+    return report_pool.connect()
+
+def load_stats():
+    """Fresh dashboard totals for stats_cache"""
+    db = get_report_db()
+    try:
+        return collect_stats(db)
+    finally:
+        db.close()
+
+stats_cache = StatsCache(load_stats, STATS_CACHE_TTL)
+
+# Rows from before the rollup triggers existed are added in the background
+rollup_backfill = RollupBackfill(get_db)
+
+# Closed months move to gzipped monthly archives (see archive.py)
+archiver = Archiver(get_db, ARCHIVE_FOLDER, ARCHIVE_KEEP_MONTHS)
+
+# User rows: read-only lookups, explicit creation, idle purge (see sessions.py)
+activity_tracker = ActivityTracker(get_db, ACTIVITY_FLUSH_SECONDS)
+session_store = SessionStore(get_db, session_cache, activity_tracker)
+
+# ============================================
+# Database Maintenance (runs while the kiosk is idle)
+# ============================================
+request_meter = RequestRateMeter()
+maintenance_scheduler = MaintenanceScheduler(get_db, request_meter, MAINTENANCE_IDLE_REQUESTS)
+
+def with_db(task):
+    """Maintenance task fn(should_stop) running task(db, should_stop) on a pooled connection"""
+    def run(should_stop):
+        db = get_db()
+        try:
+            return task(db, should_stop)
+        finally:
+            db.close()
+    return run
+
+# Order matters: archive frees pages that vacuum returns, backup copies the compacted file
+maintenance_scheduler.add('checkpoint', MAINTENANCE_INTERVALS['checkpoint'],
+                          with_db(lambda db, should_stop: maintenance.checkpoint(db)))
+maintenance_scheduler.add('optimize', MAINTENANCE_INTERVALS['optimize'],
+                          with_db(lambda db, should_stop: maintenance.refresh_statistics(db)))
+maintenance_scheduler.add('analyze', MAINTENANCE_INTERVALS['analyze'],
+                          with_db(lambda db, should_stop: maintenance.refresh_statistics(db, full=True)))
+maintenance_scheduler.add('sessions', MAINTENANCE_INTERVALS['sessions'],
+                          lambda should_stop: session_store.purge_idle(SESSION_IDLE_SECONDS, SESSION_PURGE_BATCH,
+                                                                       should_stop))
+maintenance_scheduler.add('staging', MAINTENANCE_INTERVALS['staging'],
+                          lambda should_stop: expire_staged_files(should_stop))
+maintenance_scheduler.add('archive', MAINTENANCE_INTERVALS['archive'], archiver.run)
+maintenance_scheduler.add('vacuum', MAINTENANCE_INTERVALS['vacuum'], with_db(maintenance.incremental_vacuum))
+maintenance_scheduler.add('backup', MAINTENANCE_INTERVALS['backup'],
+                          with_db(lambda db, should_stop: maintenance.backup(db, BACKUP_FOLDER, should_stop,
+                                                                             keep=BACKUP_KEEP)))
+
+# Admin dashboard at /admin, in this process (admin actions can delete users)
+app.register_blueprint(create_admin_blueprint(get_db, get_report_db, file_store, stats_cache, archiver,
+                                              maintenance_scheduler, on_data_changed=session_cache.invalidate))
 
 def count_pdf_pages(filepath):
     """Count pages in PDF file"""
@@ -211,7 +404,7 @@ def count_pdf_pages(filepath):
             pdf_reader = PyPDF2.PdfReader(file)
             return len(pdf_reader.pages)
     except Exception as e:
-        logger.error(f"PDF page count error: {e}")
+        logger.error("PDF page count error: %s", e)
         return 1
 
 def count_docx_pages(filepath):
@@ -227,7 +420,7 @@ def count_docx_pages(filepath):
         estimated_pages = max(1, round(total_words / 500))
         return estimated_pages
     except Exception as e:
-        logger.error(f"DOCX page count error: {e}")
+        logger.error("DOCX page count error: %s", e)
         return 1
 
 def count_image_pages(filepath):
@@ -237,15 +430,16 @@ def count_image_pages(filepath):
 def count_txt_pages(filepath):
     """Estimate pages in TXT file"""
     try:
-        with open(filepath, 'r', encoding='utf-8') as file:
+        with open(filepath, 'r', encoding='utf-8', errors='replace') as file:
             lines = file.readlines()
             # Rough estimate: 50 lines per page
             estimated_pages = max(1, round(len(lines) / 50))
             return estimated_pages
     except Exception as e:
-        logger.error(f"TXT page count error: {e}")
+        logger.error("TXT page count error: %s", e)
         return 1
 
+@metrics.timed('count_file_pages')
 def count_file_pages(filepath, extension):
     """Count pages based on file type"""
     extension = extension.lower()
@@ -261,6 +455,7 @@ def count_file_pages(filepath, extension):
     else:
         return 1
 
+@metrics.timed('convert_docx_to_pdf')
 def convert_docx_to_pdf(docx_path):
     """Convert DOCX to PDF using LibreOffice"""
     try:
@@ -280,13 +475,13 @@ def convert_docx_to_pdf(docx_path):
             pdf_path = os.path.splitext(docx_path)[0] + '.pdf'
             
             if os.path.exists(pdf_path):
-                logger.info(f"✅ Converted DOCX to PDF: {pdf_path}")
+                logger.info("Converted DOCX to PDF: %s", pdf_path)
                 return pdf_path
             else:
-                logger.error(f"PDF not created: {pdf_path}")
+                logger.error("PDF not created: %s", pdf_path)
                 return None
         else:
-            logger.error(f"LibreOffice conversion failed: {result.stderr}")
+            logger.error("LibreOffice conversion failed: %s", result.stderr)
             return None
             
     except subprocess.TimeoutExpired:
@@ -296,7 +491,7 @@ def convert_docx_to_pdf(docx_path):
         logger.error("LibreOffice (soffice) not found. Install: sudo apt install libreoffice-writer")
         return None
     except Exception as e:
-        logger.error(f"DOCX conversion error: {e}")
+        logger.error("DOCX conversion error: %s", e)
         return None
 
 def log_transaction(session_id, trans_type, amount, description):
@@ -309,24 +504,14 @@ def log_transaction(session_id, trans_type, amount, description):
     )
     db.commit()
     db.close()
-    logger.info(f"Transaction logged: {session_id} - {trans_type} - ₱{amount}")
-
-def update_user_activity(session_id):
-    """Update user's last activity timestamp"""
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute(
-        'UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE session_id = ?',
-        (session_id,)
-    )
-    db.commit()
-    db.close()
+    db_logger.debug("Transaction logged: %s - %s - %s", session_id, trans_type, amount)
 
 def get_printer_name():
     """Get the default printer name from CUPS"""
     try:
         if conn_cups:
-            printers = conn_cups.getPrinters()
+            with cups_lock:
+                printers = conn_cups.getPrinters()
             if printers:
                 # Return first available printer or DEFAULT_PRINTER if exists
                 if DEFAULT_PRINTER in printers:
@@ -334,9 +519,419 @@ def get_printer_name():
                 return list(printers.keys())[0]
         return None
     except Exception as e:
-        logger.error(f"Error getting printer: {e}")
+        logger.error("Error getting printer: %s", e)
         return None
 
+# ============================================
+# Print Options
+# ============================================
+# ESP32/kiosk duplex value -> CUPS "sides" option
+DUPLEX_MODES = {
+    'none': 'one-sided',
+    'long': 'two-sided-long-edge',
+    'short': 'two-sided-short-edge'
+}
+NUMBER_UP_VALUES = (1, 2, 4, 6, 9, 16)
+
+def parse_page_ranges(spec, total_pages):
+    """Parse a page range string like '1-3,5' into a sorted list of page numbers"""
+    pages = set()
+
+    for part in str(spec).replace(' ', '').split(','):
+        if not part:
+            continue
+
+        if '-' in part:
+            start, _, end = part.partition('-')
+            start = int(start) if start else 1
+            end = int(end) if end else total_pages
+        else:
+            start = end = int(part)
+
+        if start < 1 or end > total_pages or start > end:
+            raise ValueError(f'Invalid page range "{part}" (document has {total_pages} page(s))')
+
+        pages.update(range(start, end + 1))
+
+    if not pages:
+        raise ValueError('Page range selects no pages')
+
+    return sorted(pages)
+
+def build_print_options(data, total_pages):
+    """Validate print options from a /print request.
+
+    Returns (cups_options, summary, selected_pages). Cost is charged per
+    printed side, so the number of selected pages, number-up, duplex and
+    copies all feed into the effective sheet count.
+    """
+    page_range = data.get('page_range')
+    copies = int(data.get('copies', 1))
+    duplex = str(data.get('duplex', 'none')).lower()
+    number_up = int(data.get('number_up', 1))
+
+    if copies < 1 or copies > MAX_COPIES:
+        raise ValueError(f'Copies must be between 1 and {MAX_COPIES}')
+    if duplex not in DUPLEX_MODES:
+        raise ValueError(f'Duplex must be one of: {", ".join(DUPLEX_MODES)}')
+    if number_up not in NUMBER_UP_VALUES:
+        raise ValueError(f'Number-up must be one of: {", ".join(map(str, NUMBER_UP_VALUES))}')
+
+    if page_range:
+        selected_pages = parse_page_ranges(page_range, total_pages)
+    else:
+        selected_pages = list(range(1, total_pages + 1))
+
+    # Printed sides per copy, then physical sheets per copy
+    sides = math.ceil(len(selected_pages) / number_up)
+    sheets = math.ceil(sides / 2) if duplex != 'none' else sides
+
+    cups_options = {}
+    if page_range and len(selected_pages) < total_pages:
+        cups_options['page-ranges'] = format_page_ranges(selected_pages)
+    if copies > 1:
+        cups_options['copies'] = str(copies)
+        cups_options['collate'] = 'true'
+    if duplex != 'none':
+        cups_options['sides'] = DUPLEX_MODES[duplex]
+    if number_up > 1:
+        cups_options['number-up'] = str(number_up)
+
+    summary = {
+        'selected_pages': len(selected_pages),
+        'copies': copies,
+        'duplex': duplex,
+        'number_up': number_up,
+        'sides': sides * copies,
+        'sheets': sheets * copies,
+        'cost': sides * copies * PRICE_PER_PAGE
+    }
+
+    return cups_options, summary, selected_pages
+
+def is_default_layout(summary, total_pages):
+    """True when a print request matches how artifacts are pre-rendered"""
+    return (summary['selected_pages'] == total_pages
+            and summary['number_up'] == 1
+            and summary['duplex'] == 'none')
+
+# ============================================
+# Print Artifacts
+# ============================================
+# After upload, a background worker converts DOCX to PDF and (when the
+# printer's PPD is readable) runs the CUPS filter chain once, storing the
+# printer-native output next to the upload as <id>.prn. /print then sends
+# that file raw, so nothing is converted or rasterized while the user waits.
+# Until then /print sends the PDF; only a Word file's conversion is waited for.
+def printer_ppd_path():
+    """The printer's PPD if pre-rendering is enabled and it is readable"""
+    ppd_path = os.path.join(CUPS_PPD_DIR, f'{DEFAULT_PRINTER}.ppd')
+    if ARTIFACT_RENDERING and os.access(ppd_path, os.R_OK):
+        return ppd_path
+    return None
+
+@metrics.timed('render_print_artifact')
+def render_print_artifact(source_path):
+    """Render a document to the printer's native format with cupsfilter"""
+    ppd_path = printer_ppd_path()
+    if not ppd_path:
+        return None
+    
+    artifact_path = os.path.splitext(source_path)[0] + '.prn'
+    temp_path = artifact_path + '.part'
+    
+    try:
+        with open(temp_path, 'wb') as output:
+            result = subprocess.run([
+                'cupsfilter',
+                '-p', ppd_path,
+                '-m', f'printer/{DEFAULT_PRINTER}',
+                source_path
+            ], stdout=output, stderr=subprocess.PIPE, timeout=ARTIFACT_RENDER_TIMEOUT)
+        
+        if result.returncode != 0 or os.path.getsize(temp_path) == 0:
+            logger.warning("cupsfilter failed for %s: %s", source_path,
+                           result.stderr.decode('utf-8', 'replace').strip()[-300:])
+            os.remove(temp_path)
+            return None
+        
+        os.replace(temp_path, artifact_path)
+        return artifact_path
+    
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning("Could not pre-render %s: %s", source_path, e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+def convert_upload(job):
+    """Background step 1: make the upload printable (convert DOCX once)"""
+    if job.file_type not in ('doc', 'docx'):
+        return {'status': STATUS_READY, 'print_path': job.filepath, 'pages': None}
+    
+    event_bus.publish(job.session_id, 'conversion', {'file_id': job.file_id, 'state': 'converting'})
+    pdf_path = convert_docx_to_pdf(job.filepath)
+    if not pdf_path or not os.path.exists(pdf_path):
+        return {'status': STATUS_FAILED}
+    return {
+        'status': STATUS_READY,
+        'print_path': pdf_path,
+        'pages': count_pdf_pages(pdf_path) if PYPDF2_AVAILABLE else None
+    }
+
+def save_converted_upload(job, result):
+    """Store the printable file right away, so /print can use it while rendering runs"""
+    db = get_db()
+    try:
+        db.execute('UPDATE files SET print_path = ?, pages = COALESCE(?, pages) WHERE id = ?',
+                   (result['print_path'], result.get('pages'), job.file_id))
+        db.commit()
+    finally:
+        db.close()
+
+def render_upload(job):
+    """Background step 2 (optional): pre-render for the printer"""
+    if printer_ppd_path():
+        event_bus.publish(job.session_id, 'conversion', {'file_id': job.file_id, 'state': 'rendering'})
+    db = get_db()
+    try:
+        # Current path: a print may have moved the file from RAM to the SD card meanwhile
+        record = db.execute('SELECT print_path FROM files WHERE id = ?', (job.file_id,)).fetchone()
+    finally:
+        db.close()
+    if record is None or not record['print_path']:
+        return {'artifact_path': None}
+    return {'artifact_path': render_print_artifact(record['print_path'])}
+
+def save_print_artifacts(job, result):
+    """Record a finished pipeline run in the files table (print_path is saved after conversion)"""
+    db = get_db()
+    db.execute('UPDATE files SET artifact_status = ?, artifact_path = ? WHERE id = ?',
+               (result['status'], result.get('artifact_path'), job.file_id))
+    db.commit()
+    db.close()
+    logger.info("File %s prepared: %s (pre-rendered: %s)", job.file_id, result['status'],
+                bool(result.get('artifact_path')))
+    event_bus.publish(job.session_id, 'conversion', {
+        'file_id': job.file_id,
+        'state': result['status'],
+        'pages': result.get('pages'),
+        'pre_rendered': bool(result.get('artifact_path'))
+    })
+
+artifact_pipeline = ArtifactPipeline(convert_upload, render_upload, save_converted_upload, save_print_artifacts,
+                                     workers=ARTIFACT_WORKERS)
+
+# ============================================
+# Print Scheduler
+# ============================================
+def submit_print_chunk(job, options):
+    """Send one chunk of a queued job to the printer, return the CUPS job ID"""
+    printer_name = get_printer_name()
+    if not printer_name:
+        raise Exception('No printer available')
+
+    trace = job.context
+    if trace is not None and not job.submitted:
+        # Time spent waiting in the scheduler queue before the first chunk
+        wait_ms = (time.monotonic() - job.enqueued_at) * 1000
+        tracer.record(trace, 'queue_wait', trace.elapsed_ms() - wait_ms, wait_ms)
+
+    if not os.path.exists(job.filepath):
+        # Moved from the RAM tier to the SD card since the job was queued
+        job.filepath = file_store.persist(job.filepath)
+    
+    with tracer.span('printFile', trace=trace):
+        if conn_cups:
+            with metrics.function_latency.time('printFile'), cups_lock:
+                return conn_cups.printFile(printer_name, job.filepath, job.title, options)
+
+        # Fallback: use command line
+        lp_command = ['lp', '-d', printer_name]
+        for option, value in options.items():
+            lp_command += ['-o', f'{option}={value}']
+        subprocess.run(lp_command + [job.filepath], check=True)
+        return 0
+
+def count_pending_cups_jobs(cups_job_ids):
+    """How many of the given CUPS jobs haven't finished yet"""
+    with cups_lock:
+        pending = conn_cups.getJobs(which_jobs='not-completed')
+    return sum(1 for job_id in cups_job_ids if job_id in pending)
+
+def get_cups_job_state(cups_job_id):
+    """Map a CUPS job's IPP state to pending/completed/canceled/aborted"""
+    try:
+        with cups_lock:
+            attributes = conn_cups.getJobAttributes(cups_job_id, requested_attributes=['job-state'])
+    except Exception as e:
+        # Job history purged: it left the queue long ago, so it was printed
+        logger.warning("No state for CUPS job %s (%s), assuming completed", cups_job_id, e)
+        return 'completed'
+    return CUPS_FINAL_STATES.get(attributes.get('job-state'), 'pending')
+
+def update_print_job_status(job, status):
+    """Record scheduler progress in the print_jobs table"""
+    db = get_db()
+    db.execute('UPDATE print_jobs SET status = ? WHERE id = ?', (status, job.job_id))
+    db.commit()
+    db.close()
+    event_bus.publish(job.session_id, 'print', {
+        'job_id': job.job_id,
+        'status': status,
+        'cups_job_ids': list(job.submitted)
+    })
+
+def finish_print_job(job, printed_pages, planned_pages):
+    """Settle a job's credit reservation once CUPS is done with it"""
+    settlement = credit_ledger.settle(job.job_id, printed_pages, planned_pages)
+    
+    if printed_pages >= planned_pages:
+        status = 'completed'
+    else:
+        status = 'partial' if printed_pages > 0 else 'failed'
+    update_print_job_status(job, status)
+    
+    if printed_pages > 0:
+        # Printed files are kept: move them out of the RAM tier
+        try:
+            persist_job_file(job.job_id)
+        except Exception as e:
+            logger.error("Could not persist file of print job %s: %s", job.job_id, e)
+    
+    if settlement and settlement[1]:
+        session_id, refund, balance = settlement
+        session_cache.invalidate(session_id)
+        event_bus.publish(session_id, 'credits', {'credits': balance, 'change': refund})
+
+def persist_file(file_id):
+    """Move an upload and its converted/pre-rendered copies from RAM to the SD card"""
+    db = get_db()
+    try:
+        record = db.execute('SELECT file_path, print_path, artifact_path FROM files WHERE id = ?',
+                            (file_id,)).fetchone()
+        if record is None or not any(file_store.is_staged(path) for path in record):
+            return False
+        paths = [file_store.persist(path) if path else None for path in record]
+        db.execute('UPDATE files SET file_path = ?, print_path = ?, artifact_path = ? WHERE id = ?',
+                   (*paths, file_id))
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+def persist_job_file(job_id):
+    """persist_file() for the upload a print job printed"""
+    db = get_db()
+    row = db.execute('SELECT file_id FROM print_jobs WHERE id = ?', (job_id,)).fetchone()
+    db.close()
+    if row and row['file_id']:
+        persist_file(row['file_id'])
+
+def expire_staged_files(should_stop):
+    """Maintenance task: clear uploads left in RAM past STAGING_MAX_AGE.
+
+    Files that printed (their persist after printing failed) go to the SD
+    card; files never printed are deleted with their converted and
+    pre-rendered copies, so abandoned uploads never touch the SD card.
+    Files with a job still queued or printing are left alone.
+    """
+    if not file_store.staging_root:
+        return 0
+    prefix = os.path.join(file_store.staging_root, '')
+    db = get_db()
+    rows = db.execute('''
+        SELECT id, file_path,
+               EXISTS (SELECT 1 FROM print_jobs
+                       WHERE file_id = files.id AND status IN ('completed', 'partial')) AS printed
+        FROM files
+        WHERE uploaded_at < datetime('now', :age)
+          AND (instr(file_path, :prefix) = 1 OR instr(print_path, :prefix) = 1 OR instr(artifact_path, :prefix) = 1)
+          AND NOT EXISTS (SELECT 1 FROM print_jobs
+                          WHERE file_id = files.id AND status IN ('queued', 'printing', 'submitted'))
+    ''', {'age': f'-{STAGING_MAX_AGE} seconds', 'prefix': prefix}).fetchall()
+    db.close()
+    
+    for row in rows:
+        should_stop()
+        if row['printed']:
+            persist_file(row['id'])
+            continue
+        file_store.delete(row['file_path'])  # Also removes <id>.pdf / <id>.prn
+        db = get_db()
+        try:
+            db.execute('DELETE FROM files WHERE id = ?', (row['id'],))
+            db.commit()
+        finally:
+            db.close()
+    
+    deleted = sum(1 for row in rows if not row['printed'])
+    if deleted:
+        logger.info("Deleted %d never-printed upload(s) from staging", deleted)
+    return len(rows)
+
+def settle_open_reservations():
+    """After a restart, settle reservations whose jobs were lost with the in-memory queue"""
+    for reservation in credit_ledger.open_reservations():
+        if reservation['job_status'] in (None, 'queued', 'failed'):
+            # Never reached the printer: refund in full
+            credit_ledger.settle(reservation['job_id'], 0, 1)
+        else:
+            logger.warning("Print job %s was %s at shutdown, keeping its %d credit(s)",
+                           reservation['job_id'], reservation['job_status'], reservation['amount'])
+            credit_ledger.settle(reservation['job_id'], 1, 1)
+
+credit_ledger = CreditLedger(get_db)
+
+print_scheduler = PrintScheduler(
+    submit_print_chunk,
+    busy_fn=count_pending_cups_jobs if conn_cups else None,
+    on_state_change=update_print_job_status,
+    policy=PRINT_SCHEDULER_POLICY,
+    chunk_pages=PRINT_CHUNK_PAGES,
+    job_state_fn=get_cups_job_state if conn_cups else None,
+    on_finished=finish_print_job
+)
+
+# ============================================
+# Request Metrics
+# ============================================
+@app.before_request
+def start_request_timer():
+    """Remember when the request started and tag it with an ID for logs"""
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:12]
+    request_meter.hit()  # Maintenance waits for quiet periods
+
+@app.teardown_request
+def remove_upload_temp_files(error=None):
+    """Delete multipart temp files that were never moved into place"""
+    file_store.release_staging(getattr(request, 'staging_reserved', None) or 0)
+    for temp_path in getattr(request, 'upload_temp_files', ()):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            upload_logger.warning("Could not remove upload temp file %s: %s", temp_path, e)
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request and record its latency by route"""
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_latency.observe(time.perf_counter() - start, request.method, route)
+        metrics.http_requests.inc(request.method, route, response.status_code)
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    trace = g.get('trace')
+    if trace is not None:
+        tracer.finish(trace, 'ok' if response.status_code < 400 else 'error',
+                      http_status=response.status_code)
+        response.headers['X-Trace-ID'] = trace.trace_id
+    return response
+
 # ============================================
 # API Routes
 # ============================================
@@ -352,9 +947,15 @@ def index():
             'upload': '/upload (POST)',
             'print': '/print (POST)',
             'credits': '/api/credits (POST)',
+            'credits_batch': '/api/credits/batch (POST)',
+            'session': '/api/session (POST)',
             'check_credits': '/api/check_credits (GET)',
             'status': '/api/status (GET)',
-            'history': '/api/history (GET)'
+            'queue': '/api/queue (GET)',
+            'events': '/api/events?session_id=... (GET, text/event-stream)',
+            'history': '/api/history (GET)',
+            'metrics': '/metrics (GET)',
+            'traces': '/api/traces (GET)'
         }
     })
 
@@ -364,7 +965,7 @@ def upload_file():
     try:
         # Check if file is in request
         if 'file' not in request.files:
-            logger.warning("No file in upload request")
+            upload_logger.warning("No file in upload request")
             return jsonify({
                 'success': False,
                 'error': 'No file provided'
@@ -373,61 +974,90 @@ def upload_file():
         file = request.files['file']
         
         if file.filename == '':
-            logger.warning("Empty filename in upload")
+            upload_logger.warning("Empty filename in upload")
             return jsonify({
                 'success': False,
                 'error': 'No file selected'
             }), 400
         
         if not allowed_file(file.filename):
-            logger.warning(f"Invalid file type: {file.filename}")
+            upload_logger.warning("Invalid file type: %s", file.filename)
             return jsonify({
                 'success': False,
                 'error': 'File type not allowed'
             }), 400
         
         # Get session ID from form data or create new one
-        session_id = request.form.get('session_id', f"USER_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+        session_id = request.form.get('session_id') or new_session_id()
+        g.session_id = session_id
+        start_request_trace('upload', session_id)
         
         # Secure filename and save
         original_filename = file.filename
         filename = secure_filename(file.filename)
         
-        # Add timestamp to avoid conflicts
+        # Display name keeps a timestamp; the stored file gets a unique ID
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         name, ext = os.path.splitext(filename)
         filename = f"{name}_{timestamp}{ext}"
         
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Stored, counted and converted as what the content is, not what the name says
+        try:
+            file_ext = detect_upload_type(file, ext[1:].lower())
+        except UnsupportedContent as e:
+            upload_logger.warning("Rejected upload %s: %s", original_filename, e)
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 415
+        
+        with tracer.span('receive'):
+            storage_id, filepath = store_uploaded_file(file, file_ext)
         
         file_size = os.path.getsize(filepath)
-        file_ext = ext[1:] if ext else 'unknown'
+        metrics.upload_bytes.inc('/upload', amount=file_size)
         
         # Count pages
-        pages = count_file_pages(filepath, file_ext)
+        with tracer.span('count_file_pages'):
+            pages = count_file_pages(filepath, file_ext)
         cost = pages * PRICE_PER_PAGE
         
         # Save to database
-        db = get_db()
-        cursor = db.cursor()
-        
-        # Ensure user exists
-        get_or_create_user(session_id)
-        
-        cursor.execute('''
-            INSERT INTO files (session_id, filename, original_name, file_path, file_size, pages, file_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (session_id, filename, original_filename, filepath, file_size, pages, file_ext))
+        with tracer.span('db_insert'):
+            db = get_db()
+            cursor = db.cursor()
+            
+            # Ensure user exists
+            session_store.ensure(db, session_id)
+            
+            cursor.execute('''
+                INSERT INTO files (session_id, filename, original_name, file_path, file_size, pages, file_type,
+                                   storage_id, artifact_status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (session_id, filename, original_filename, filepath, file_size, pages, file_ext,
+                  storage_id, STATUS_PENDING))
+            
+            db.commit()
+            file_id = cursor.lastrowid
+            db.close()
         
-        db.commit()
-        file_id = cursor.lastrowid
-        db.close()
+        # Convert / pre-render in the background so /print has nothing left to do
+        artifact_pipeline.submit(file_id, filepath, file_ext, session_id)
+        event_bus.publish(session_id, 'upload', {
+            'state': 'complete',
+            'file_id': file_id,
+            'filename': filename,
+            'bytes': file_size,
+            'pages': pages,
+            'cost': cost
+        })
         
-        logger.info(f"File uploaded: {original_filename} ({pages} pages) - Session: {session_id}")
+        upload_logger.info("File uploaded: %s (%d pages)", original_filename, pages,
+                           extra={'file_size': file_size, 'duration_ms': elapsed_ms(g.request_start)})
         
         return jsonify({
             'success': True,
+            'session_id': session_id,
             'file_id': file_id,
             'filename': filename,
             'pages': pages,
@@ -436,7 +1066,7 @@ def upload_file():
         })
         
     except Exception as e:
-        logger.error(f"Upload error: {e}")
+        upload_logger.error("Upload error: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -448,96 +1078,113 @@ def upload_stream():
     try:
         # Get headers from ESP32
         filename = request.headers.get('X-Filename', 'unknown_file.pdf')
-        session_id = request.headers.get('X-Session-ID', f"USER_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+        session_id = request.headers.get('X-Session-ID') or new_session_id()
+        g.session_id = session_id
+        start_request_trace('upload_stream', session_id)
         
-        logger.info(f"Streaming upload started: {filename} - Session: {session_id}")
+        upload_logger.debug("Streaming upload started: %s", filename)
         
         # Secure filename
         original_filename = filename
         filename = secure_filename(filename)
         
-        # Add timestamp to avoid conflicts
+        # Display name keeps a timestamp; the stored file gets a unique ID
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         name, ext = os.path.splitext(filename)
         filename = f"{name}_{timestamp}{ext}"
         
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Stream to disk chunk-by-chunk (NO BUFFERING!)
-        bytes_written = 0
-        logger.info("Writing chunks to disk...")
-        
-        with open(filepath, 'wb') as f:
-            while True:
-                chunk = request.stream.read(8192)  # 8KB chunks
-                if not chunk:
-                    break
-                f.write(chunk)
-                bytes_written += len(chunk)
-                
-                # Progress log every 100KB
-                if bytes_written % 102400 == 0:
-                    logger.info(f"  Written: {bytes_written // 1024} KB")
-        
-        logger.info(f"Streaming complete: {bytes_written} bytes ({bytes_written // 1024} KB)")
+        # Check the first few KB before storing anything; the type comes
+        # from the content (X-Filename defaults to .pdf)
+        head = filetypes.read_head(request.stream.read)
+        try:
+            file_ext = filetypes.check(head, ext[1:].lower())
+        except UnsupportedContent as e:
+            upload_logger.warning("Rejected streaming upload %s after %d bytes: %s", original_filename, len(head), e)
+            response = jsonify({
+                'success': False,
+                'error': str(e)
+            })
+            response.headers['Connection'] = 'close'  # The rest of the body is never read
+            return response, 415
         
-        # Verify file was created
-        if not os.path.exists(filepath):
-            raise Exception("File not created after streaming")
+        # Stream to a temp file chunk-by-chunk (NO BUFFERING!), then rename into place
+        with tracer.span('receive'):
+            storage_id, filepath, bytes_written = file_store.write_stream(
+                filetypes.prepend(head, request.stream.read), file_ext, size_hint=request.content_length,
+                progress=upload_progress_reporter(session_id, request.content_length))
         
-        file_size = os.path.getsize(filepath)
-        file_ext = ext[1:] if ext else 'unknown'
+        upload_logger.debug("Streaming complete: %d bytes", bytes_written)
+        metrics.upload_bytes.inc('/upload_stream', amount=bytes_written)
         
-        logger.info(f"File size on disk: {file_size} bytes")
+        file_size = bytes_written
         
         # ✅ DOCX to PDF conversion (if needed)
         if file_ext.lower() in ['doc', 'docx']:
-            logger.info(f"DOCX file detected, converting to PDF...")
-            pdf_path = convert_docx_to_pdf(filepath)
+            upload_logger.debug("DOCX file detected, converting to PDF")
+            event_bus.publish(session_id, 'conversion', {'state': 'converting'})
+            with tracer.span('convert_docx_to_pdf'):
+                pdf_path = convert_docx_to_pdf(filepath)
             
             if pdf_path and os.path.exists(pdf_path):
                 # Success! Update to use PDF
-                logger.info(f"✅ Conversion successful: {pdf_path}")
+                upload_logger.debug("Conversion successful: %s", pdf_path)
                 
                 # Delete original DOCX
                 os.remove(filepath)
                 
                 # Update variables to PDF
                 filepath = pdf_path
-                filename = os.path.basename(pdf_path)
+                filename = os.path.splitext(filename)[0] + '.pdf'
                 file_ext = 'pdf'
                 file_size = os.path.getsize(filepath)
                 
-                logger.info(f"Now using converted PDF: {filename} ({file_size} bytes)")
+                upload_logger.debug("Now using converted PDF: %s (%d bytes)", filename, file_size)
             else:
                 # Conversion failed, keep DOCX but warn
-                logger.warning(f"⚠️  DOCX to PDF conversion failed, keeping original DOCX")
-                logger.warning(f"   Make sure LibreOffice is installed: sudo apt install libreoffice-writer")
+                upload_logger.warning("DOCX to PDF conversion failed, keeping original DOCX. "
+                                      "Make sure LibreOffice is installed: sudo apt install libreoffice-writer")
         
         # Count pages
-        pages = count_file_pages(filepath, file_ext)
+        with tracer.span('count_file_pages'):
+            pages = count_file_pages(filepath, file_ext)
         cost = pages * PRICE_PER_PAGE
         
         # Save to database
-        db = get_db()
-        cursor = db.cursor()
-        
-        # Ensure user exists
-        get_or_create_user(session_id)
-        
-        cursor.execute('''
-            INSERT INTO files (session_id, filename, original_name, file_path, file_size, pages, file_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (session_id, filename, original_filename, filepath, file_size, pages, file_ext))
+        with tracer.span('db_insert'):
+            db = get_db()
+            cursor = db.cursor()
+            
+            # Ensure user exists
+            session_store.ensure(db, session_id)
+            
+            cursor.execute('''
+                INSERT INTO files (session_id, filename, original_name, file_path, file_size, pages, file_type,
+                                   storage_id, artifact_status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (session_id, filename, original_filename, filepath, file_size, pages, file_ext,
+                  storage_id, STATUS_PENDING))
+            
+            db.commit()
+            file_id = cursor.lastrowid
+            db.close()
         
-        db.commit()
-        file_id = cursor.lastrowid
-        db.close()
+        # Convert / pre-render in the background so /print has nothing left to do
+        artifact_pipeline.submit(file_id, filepath, file_ext, session_id)
+        event_bus.publish(session_id, 'upload', {
+            'state': 'complete',
+            'file_id': file_id,
+            'filename': filename,
+            'bytes': file_size,
+            'pages': pages,
+            'cost': cost
+        })
         
-        logger.info(f"Streaming upload complete: {original_filename} ({pages} pages) - File ID: {file_id}")
+        upload_logger.info("Streaming upload complete: %s (%d pages) - File ID: %d", original_filename, pages, file_id,
+                           extra={'file_size': file_size, 'duration_ms': elapsed_ms(g.request_start)})
         
         return jsonify({
             'success': True,
+            'session_id': session_id,
             'file_id': file_id,
             'filename': filename,
             'pages': pages,
@@ -546,165 +1193,297 @@ def upload_stream():
         })
         
     except Exception as e:
-        logger.error(f"Streaming upload error: {e}")
+        upload_logger.error("Streaming upload error: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+# Compact field order: ok, error, then these
+PRINT_FIELDS = ('cost', 'remaining_credits', 'job_id', 'queue_position', 'pages', 'sheets', 'file_id')
+
 @app.route('/print', methods=['POST'])
 def print_file():
-    """Handle print request from ESP32"""
+    """Quote, reserve credits and queue a print job in one call (ESP32)"""
     try:
         data = request.get_json()
         session_id = data.get('session_id')
-        user_credits = data.get('credits', 0)
+        g.session_id = session_id
+        device_credits = data.get('credits')  # ESP32's own count, only logged
         filename = data.get('filename', '')  # Get filename from ESP32
+        file_id = data.get('file_id')
+        quote_only = bool(data.get('quote_only'))
+        max_cost = data.get('max_cost')
         
         if not session_id:
-            return jsonify({
+            return api_response({
                 'success': False,
+                'error': 'no_session',
                 'message': 'No session ID provided'
-            }), 400
-        
-        logger.info(f"Print request: Session={session_id}, Credits={user_credits}, File={filename}")
-        
-        # Get user from database
-        user = get_or_create_user(session_id)
-        db_credits = user['credits']
-        
-        # Get the latest uploaded file for this session
-        db = get_db()
-        cursor = db.cursor()
-        
-        if filename:
-            # Use the specific filename if provided
-            cursor.execute('''
-                SELECT * FROM files 
-                WHERE session_id = ? AND filename = ?
-                ORDER BY uploaded_at DESC 
-                LIMIT 1
-            ''', (session_id, filename))
-        else:
-            # Fall back to latest file
-            cursor.execute('''
-                SELECT * FROM files 
-                WHERE session_id = ? 
-                ORDER BY uploaded_at DESC 
-                LIMIT 1
-            ''', (session_id,))
-        
-        file_record = cursor.fetchone()
+            }, PRINT_FIELDS, 400)
+        
+        logger.info("Print request: device credits=%s, file_id=%s, file=%s", device_credits, file_id, filename)
+        start_request_trace('print', session_id)
+        
+        with tracer.span('db_lookup'):
+            # Get user from database (an unknown session has no credits)
+            user = session_store.get(session_id) or {'credits': 0}
+            activity_tracker.touch(session_id)
+            db_credits = user['credits']
+            user_version = user.get('version') or 0
+        
+            # Get the latest uploaded file for this session
+            db = get_db()
+            cursor = db.cursor()
+        
+            if file_id:
+                # The ESP32 sends the file_id it got from the upload
+                cursor.execute('SELECT * FROM files WHERE id = ? AND session_id = ?',
+                               (file_id, session_id))
+            elif filename:
+                # Use the specific filename if provided
+                cursor.execute('''
+                    SELECT * FROM files 
+                    WHERE session_id = ? AND filename = ?
+                    ORDER BY uploaded_at DESC, id DESC
+                    LIMIT 1
+                ''', (session_id, filename))
+            else:
+                # Fall back to latest file
+                cursor.execute('''
+                    SELECT * FROM files 
+                    WHERE session_id = ? 
+                    ORDER BY uploaded_at DESC, id DESC
+                    LIMIT 1
+                ''', (session_id,))
+        
+            file_record = cursor.fetchone()
+        
+        if (file_record and file_record['file_type'] in ('doc', 'docx') and not file_record['print_path']
+                and file_record['artifact_status'] != STATUS_FAILED):
+            # Word files print from their PDF: give the background conversion
+            # a few seconds, but never convert or render on this thread
+            if not artifact_pipeline.queued(file_record['id']):
+                # Queue lost in a restart, or uploaded before the pipeline existed
+                artifact_pipeline.submit(file_record['id'], file_record['file_path'],
+                                         file_record['file_type'], session_id)
+            with tracer.span('wait_conversion'):
+                converted = artifact_pipeline.wait_converted(file_record['id'], timeout=CONVERSION_WAIT_SECONDS)
+            if not converted:
+                db.close()
+                return api_response({
+                    'success': False,
+                    'error': 'not_ready',
+                    'message': 'Document is still being converted, try again in a moment'
+                }, PRINT_FIELDS, 503)
+            cursor.execute('SELECT * FROM files WHERE id = ?', (file_record['id'],))
+            file_record = cursor.fetchone()
         
         if not file_record:
             db.close()
-            logger.warning(f"No file found for session {session_id}")
-            return jsonify({
+            logger.warning("No file found for session %s", session_id)
+            return api_response({
                 'success': False,
+                'error': 'no_file',
                 'message': 'No file uploaded yet'
-            }), 400
+            }, PRINT_FIELDS, 400)
         
         file_record = dict(file_record)
-        pages = file_record['pages']
-        cost = pages * PRICE_PER_PAGE
-        
-        logger.info(f"File found: {file_record['filename']} - {pages} pages - ₱{cost}")
         
-        # Check if user has enough credits (use ESP32's credit count)
-        if user_credits < cost:
+        # Page range, copies, duplex and number-up decide the real cost
+        try:
+            cups_options, summary, selected_pages = build_print_options(data, file_record['pages'])
+            if max_cost is not None:
+                max_cost = int(max_cost)
+        except (TypeError, ValueError) as option_error:
             db.close()
-            logger.warning(f"Insufficient credits: has ₱{user_credits}, needs ₱{cost}")
-            return jsonify({
+            logger.warning("Invalid print options: %s", option_error)
+            return api_response({
                 'success': False,
-                'message': f'Insufficient credits. Need ₱{cost}, have ₱{user_credits}'
-            }), 400
+                'error': 'bad_options',
+                'message': f'Invalid print options: {option_error}'
+            }, PRINT_FIELDS, 400)
+        
+        pages = summary['sides']
+        cost = summary['cost']
+        
+        logger.debug("File found: %s - %d side(s) on %d sheet(s) - cost %d",
+                     file_record['filename'], pages, summary['sheets'], cost)
+        
+        quote = {
+            'file_id': file_record['id'],
+            'pages': pages,
+            'sheets': summary['sheets'],
+            'cost': cost,
+            'remaining_credits': db_credits
+        }
+        
+        if quote_only:
+            db.close()
+            return api_response(dict(quote, success=True, enough_credits=db_credits >= cost,
+                                     message=f'{pages} page(s) = ₱{cost}'), PRINT_FIELDS)
+        
+        if max_cost is not None and cost > max_cost:
+            # The price changed since the client's quote (e.g. the page count was corrected)
+            db.close()
+            return api_response(dict(quote, success=False, error='quote_changed',
+                                     message=f'Price is now ₱{cost}'), PRINT_FIELDS, 409)
+        
+        # The server's balance is authoritative (reserved atomically below)
+        if db_credits < cost:
+            db.close()
+            logger.warning("Insufficient credits: has %s, needs %d", db_credits, cost)
+            return api_response(dict(quote, success=False, error='insufficient_credits',
+                                     message=f'Insufficient credits. Need ₱{cost}, have ₱{db_credits}'),
+                                PRINT_FIELDS, 400)
         
         # Get printer
-        printer_name = get_printer_name()
+        with tracer.span('get_printer_name'):
+            printer_name = get_printer_name()
         if not printer_name:
             db.close()
-            return jsonify({
+            return api_response({
                 'success': False,
+                'error': 'no_printer',
                 'message': 'No printer available'
-            }), 500
+            }, PRINT_FIELDS, 500)
         
-        # Print the file using CUPS
+        # Queue the file for printing
+        reserved_job_id = None
         try:
-            filepath = file_record['file_path']
+            filepath = file_record['print_path'] or file_record['file_path']
             file_ext = file_record['file_type'].lower()
+            chunk_pages = None  # Scheduler default
+            artifact_path = file_record['artifact_path']
             
-            # Convert DOCX to PDF if needed
-            if file_ext in ['doc', 'docx']:
-                logger.info(f"Converting DOCX to PDF: {filepath}")
-                pdf_path = convert_docx_to_pdf(filepath)
-                
-                if pdf_path and os.path.exists(pdf_path):
-                    filepath = pdf_path
-                    logger.info(f"Using converted PDF: {filepath}")
-                else:
-                    logger.warning("DOCX conversion failed, attempting to print original file")
+            if (artifact_path and is_default_layout(summary, file_record['pages'])
+                    and os.path.exists(artifact_path)):
+                # Pre-rendered for this printer: send it raw, in one piece
+                filepath = artifact_path
+                cups_options = {'raw': 'true'}
+                if summary['copies'] > 1:
+                    cups_options['copies'] = str(summary['copies'])
+                chunk_pages = 0
+                logger.debug("Using pre-rendered artifact: %s", filepath)
             
-            if conn_cups:
-                job_id = conn_cups.printFile(
-                    printer_name,
-                    filepath,
-                    f"PisoPrint_{session_id}",
-                    {}
-                )
-                logger.info(f"Print job created: ID={job_id}, Printer={printer_name}, File={filepath}")
-            else:
-                # Fallback: use command line
-                subprocess.run(['lp', '-d', printer_name, filepath], check=True)
-                job_id = 0
-                logger.info(f"Print job sent via lp command: {filepath}")
+            elif not file_record['print_path'] and file_ext in ['doc', 'docx']:
+                logger.warning("DOCX conversion failed, attempting to print original file")
             
-            # Record print job
-            cursor.execute('''
-                INSERT INTO print_jobs (session_id, file_id, pages, cost, status)
-                VALUES (?, ?, ?, ?, 'printing')
-            ''', (session_id, file_record['id'], pages, cost))
+            with tracer.span('db_insert'):
+                # Record print job (the scheduler releases it to the printer)
+                cursor.execute('''
+                    INSERT INTO print_jobs (session_id, file_id, pages, cost, status, options)
+                    VALUES (?, ?, ?, ?, 'queued', ?)
+                ''', (session_id, file_record['id'], pages, cost, json.dumps(summary)))
+                job_id = cursor.lastrowid
             
-            # Deduct credits from database
-            cursor.execute('''
-                UPDATE users 
-                SET credits = credits - ? 
-                WHERE session_id = ?
-            ''', (cost, session_id))
+                # Reserve the cost (balance + version guarded); settled when CUPS finishes
+                cache_token = session_cache.begin_load()
+                try:
+                    balance = credit_ledger.reserve(db, session_id, job_id, cost, user_version,
+                                                    f'Print {pages} page(s)')
+                except InsufficientCredits as credit_error:
+                    db.rollback()
+                    db.close()
+                    session_cache.invalidate(session_id)
+                    logger.warning("Insufficient credits: has %s, needs %d", credit_error.balance, cost)
+                    return api_response(dict(quote, success=False, error='insufficient_credits',
+                                             remaining_credits=credit_error.balance,
+                                             message=str(credit_error)), PRINT_FIELDS, 400)
             
-            # Log transaction
-            cursor.execute('''
-                INSERT INTO transactions (session_id, type, amount, description)
-                VALUES (?, 'deduct', ?, ?)
-            ''', (session_id, cost, f'Print {pages} page(s)'))
+                db.commit()
+                db.close()
+                reserved_job_id = job_id
+                new_balance = balance['credits']
+                session_cache.update(session_id, cache_token, credits=new_balance, version=balance['version'])
             
-            db.commit()
-            db.close()
+            pages_per_sheet = summary['number_up'] * (2 if summary['duplex'] != 'none' else 1)
+            position = print_scheduler.enqueue(
+                job_id,
+                session_id,
+                filepath,
+                f"PisoPrint_{session_id}",
+                cups_options,
+                selected_pages,
+                file_record['pages'],
+                pages_per_sheet,
+                context=tracer.current(),
+                chunk_pages=chunk_pages
+            )
             
-            logger.info(f"Print successful: {session_id} - {pages} pages - ₱{cost} deducted")
+            logger.info("Print queued: %d pages - %d deducted - position %d", pages, cost, position,
+                        extra={'job_id': job_id, 'duration_ms': elapsed_ms(g.request_start)})
+            event_bus.publish(session_id, 'credits', {'credits': new_balance, 'change': -cost})
+            event_bus.publish(session_id, 'print', {'job_id': job_id, 'status': 'queued', 'position': position})
             
-            return jsonify({
+            return api_response({
                 'success': True,
                 'job_id': job_id,
+                'file_id': file_record['id'],
                 'pages': pages,
+                'sheets': summary['sheets'],
                 'cost': cost,
-                'remaining_credits': user_credits - cost,
-                'message': 'Printing...'
-            })
+                'remaining_credits': new_balance,
+                'queue_position': position,
+                'message': 'Printing...' if position == 1 else f'Queued (position {position})'
+            }, PRINT_FIELDS)
             
         except Exception as print_error:
             db.close()
-            logger.error(f"Print error: {print_error}")
-            return jsonify({
+            logger.error("Print error: %s", print_error)
+            if reserved_job_id:
+                # Job never reached the queue: give the credits back
+                credit_ledger.settle(reserved_job_id, 0, 1)
+                session_cache.invalidate(session_id)
+            return api_response({
                 'success': False,
+                'error': 'print_failed',
                 'message': f'Print failed: {str(print_error)}'
-            }), 500
+            }, PRINT_FIELDS, 500)
         
     except Exception as e:
-        logger.error(f"Print request error: {e}")
-        return jsonify({
+        logger.error("Print request error: %s", e)
+        return api_response({
             'success': False,
+            'error': 'server_error',
             'message': str(e)
-        }), 500
+        }, PRINT_FIELDS, 500)
+
+SESSION_FIELDS = ('session_id', 'credits')
+
+@app.route('/api/session', methods=['POST'])
+def create_session():
+    """Start a session with a server-generated ID (or register the client's own)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        requested_id = data.get('session_id')
+        
+        if requested_id is not None and not SESSION_ID_PATTERN.match(str(requested_id)):
+            return api_response({
+                'success': False,
+                'error': 'bad_session',
+                'message': 'Session IDs are 1-64 letters, digits, _ or -'
+            }, SESSION_FIELDS, 400)
+        
+        user, created = session_store.create(requested_id)
+        g.session_id = user['session_id']
+        
+        return api_response({
+            'success': True,
+            'session_id': user['session_id'],
+            'credits': user['credits'],
+            'created': created
+        }, SESSION_FIELDS, 201 if created else 200)
+        
+    except Exception as e:
+        logger.error("Create session error: %s", e)
+        return api_response({
+            'success': False,
+            'error': 'server_error',
+            'message': str(e)
+        }, SESSION_FIELDS, 500)
+
+CREDIT_FIELDS = ('new_balance', 'amount')
 
 @app.route('/api/credits', methods=['POST'])
 def add_credits():
@@ -712,78 +1491,191 @@ def add_credits():
     try:
         data = request.get_json()
         session_id = data.get('session_id')
+        g.session_id = session_id
         amount = data.get('amount', 0)
         
         if not session_id or amount <= 0:
-            return jsonify({
+            return api_response({
                 'success': False,
+                'error': 'invalid_amount',
                 'message': 'Invalid session or amount'
-            }), 400
-        
-        # Ensure user exists
-        get_or_create_user(session_id)
+            }, CREDIT_FIELDS, 400)
         
         # Add credits
         db = get_db()
         cursor = db.cursor()
+        cache_token = session_cache.begin_load()
+        session_store.ensure(db, session_id)
         cursor.execute('''
             UPDATE users 
-            SET credits = credits + ?, last_activity = CURRENT_TIMESTAMP 
+            SET credits = credits + ?, version = version + 1
             WHERE session_id = ?
         ''', (amount, session_id))
         
         # Get new balance
-        cursor.execute('SELECT credits FROM users WHERE session_id = ?', (session_id,))
-        new_balance = cursor.fetchone()['credits']
+        cursor.execute('SELECT credits, version FROM users WHERE session_id = ?', (session_id,))
+        balance = cursor.fetchone()
+        new_balance = balance['credits']
         
         db.commit()
         db.close()
+        session_cache.update(session_id, cache_token, credits=new_balance, version=balance['version'])
         
         # Log transaction
         log_transaction(session_id, 'add', amount, f'Coin inserted: ₱{amount}')
         
-        logger.info(f"Credits added: {session_id} +₱{amount} = ₱{new_balance}")
+        logger.info("Credits added: +%s = %s", amount, new_balance)
+        event_bus.publish(session_id, 'credits', {'credits': new_balance, 'change': amount})
         
-        return jsonify({
+        return api_response({
             'success': True,
             'amount': amount,
             'new_balance': new_balance,
             'message': f'₱{amount} added'
-        })
+        }, CREDIT_FIELDS)
         
     except Exception as e:
-        logger.error(f"Add credits error: {e}")
-        return jsonify({
+        logger.error("Add credits error: %s", e)
+        return api_response({
             'success': False,
+            'error': 'server_error',
             'message': str(e)
-        }), 500
+        }, CREDIT_FIELDS, 500)
+
+BATCH_FIELDS = ('applied',)
+
+@app.route('/api/credits/batch', methods=['POST'])
+def add_credits_batch():
+    """Apply a batch of sequence-numbered coin events from one device, idempotently"""
+    try:
+        data = request.get_json()
+        device_id = str(data.get('device_id') or '').strip()
+        events = data.get('events')
+        
+        if not device_id or not isinstance(events, list) or not events:
+            return api_response({
+                'success': False,
+                'error': 'invalid_batch',
+                'message': 'device_id and a non-empty events list are required'
+            }, BATCH_FIELDS, 400)
+        
+        if len(events) > MAX_COIN_BATCH:
+            return api_response({
+                'success': False,
+                'error': 'batch_too_large',
+                'message': f'At most {MAX_COIN_BATCH} events per batch'
+            }, BATCH_FIELDS, 400)
+        
+        results = []
+        totals = {}  # session_id -> [amount, coin count]
+        
+        db = get_db()
+        cursor = db.cursor()
+        cache_token = session_cache.begin_load()
+        
+        # One transaction: either every new event is applied or none is
+        for event in events:
+            try:
+                seq = int(event['seq'])
+                amount = int(event['amount'])
+                session_id = str(event['session_id'])
+            except (KeyError, TypeError, ValueError):
+                results.append({'seq': event.get('seq') if isinstance(event, dict) else None,
+                                'status': 'invalid'})
+                continue
+            
+            if amount <= 0 or not session_id:
+                results.append({'seq': seq, 'status': 'invalid'})
+                continue
+            
+            cursor.execute('''
+                INSERT OR IGNORE INTO coin_events (device_id, seq, session_id, amount)
+                VALUES (?, ?, ?, ?)
+            ''', (device_id, seq, session_id, amount))
+            
+            if cursor.rowcount == 0:
+                # Already applied (the device is retrying after a timeout)
+                results.append({'seq': seq, 'status': 'duplicate'})
+                continue
+            
+            total = totals.setdefault(session_id, [0, 0])
+            total[0] += amount
+            total[1] += 1
+            results.append({'seq': seq, 'status': 'applied'})
+        
+        balances = {}
+        for session_id, (amount, coins) in totals.items():
+            session_store.ensure(db, session_id)
+            cursor.execute('''
+                UPDATE users 
+                SET credits = credits + ?, version = version + 1
+                WHERE session_id = ?
+            ''', (amount, session_id))
+            cursor.execute('''
+                INSERT INTO transactions (session_id, type, amount, description)
+                VALUES (?, 'add', ?, ?)
+            ''', (session_id, amount, f'Coins inserted: ₱{amount} ({coins} event(s) from {device_id})'))
+            cursor.execute('SELECT credits, version FROM users WHERE session_id = ?', (session_id,))
+            balances[session_id] = dict(cursor.fetchone())
+        
+        db.commit()
+        db.close()
+        
+        for session_id, balance in balances.items():
+            session_cache.update(session_id, cache_token, credits=balance['credits'], version=balance['version'])
+            event_bus.publish(session_id, 'credits', {'credits': balance['credits'], 'change': totals[session_id][0]})
+        
+        applied = sum(1 for result in results if result['status'] == 'applied')
+        logger.info("Coin batch from %s: %d event(s), %d applied", device_id, len(events), applied)
+        
+        return api_response({
+            'success': True,
+            'applied': applied,
+            'results': results,
+            'balances': {session_id: balance['credits'] for session_id, balance in balances.items()}
+        }, BATCH_FIELDS)
+        
+    except Exception as e:
+        logger.error("Coin batch error: %s", e)
+        return api_response({
+            'success': False,
+            'error': 'server_error',
+            'message': str(e)
+        }, BATCH_FIELDS, 500)
 
 @app.route('/api/check_credits', methods=['GET'])
 def check_credits():
     """Check user credits"""
     try:
         session_id = request.args.get('session_id')
+        g.session_id = session_id
         
         if not session_id:
-            return jsonify({
+            return api_response({
                 'success': False,
+                'error': 'no_session',
                 'message': 'No session ID provided'
-            }), 400
+            }, ('credits',), 400)
         
-        user = get_or_create_user(session_id)
+        # Read-only: polling an unknown session doesn't create it
+        user = session_store.get(session_id)
+        if user:
+            activity_tracker.touch(session_id)
         
-        return jsonify({
+        return api_response({
             'success': True,
             'session_id': session_id,
-            'credits': user['credits']
-        })
+            'exists': user is not None,
+            'credits': user['credits'] if user else 0
+        }, ('credits',))
         
     except Exception as e:
-        logger.error(f"Check credits error: {e}")
-        return jsonify({
+        logger.error("Check credits error: %s", e)
+        return api_response({
             'success': False,
+            'error': 'server_error',
             'message': str(e)
-        }), 500
+        }, ('credits',), 500)
 
 @app.route('/api/check_pages', methods=['POST'])
 def check_pages():
@@ -792,14 +1684,15 @@ def check_pages():
         data = request.get_json()
         filename = data.get('filename', '')
         session_id = data.get('session_id', '')
+        g.session_id = session_id
         
         if not filename:
-            return jsonify({
+            return api_response({
                 'success': False,
                 'error': 'No filename provided'
-            }), 400
+            }, ('pages',), 400)
         
-        logger.info(f"Page count request: {filename} (Session: {session_id})")
+        logger.debug("Page count request: %s", filename)
         
         # Estimate pages based on file extension
         # Since we don't have the actual file content, we'll estimate
@@ -820,21 +1713,21 @@ def check_pages():
             # Unknown type, assume 1 page
             estimated_pages = 1
         
-        logger.info(f"Estimated {estimated_pages} page(s) for {filename}")
+        logger.debug("Estimated %d page(s) for %s", estimated_pages, filename)
         
-        return jsonify({
+        return api_response({
             'success': True,
             'pages': estimated_pages,
             'filename': filename,
             'message': f'{estimated_pages} page(s) estimated'
-        })
+        }, ('pages',))
         
     except Exception as e:
-        logger.error(f"Page check error: {e}")
-        return jsonify({
+        logger.error("Page check error: %s", e)
+        return api_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, ('pages',), 500)
 
 @app.route('/api/status', methods=['GET'])
 def system_status():
@@ -845,25 +1738,14 @@ def system_status():
         printer_name = None
         
         if conn_cups:
-            printers = conn_cups.getPrinters()
+            with cups_lock:
+                printers = conn_cups.getPrinters()
             if printers:
                 printer_name = get_printer_name()
                 printer_status = 'online'
         
-        # Get database stats
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cursor.fetchone()['count']
-        
-        cursor.execute('SELECT COUNT(*) as count FROM print_jobs')
-        total_prints = cursor.fetchone()['count']
-        
-        cursor.execute('SELECT SUM(cost) as total FROM print_jobs')
-        total_revenue = cursor.fetchone()['total'] or 0
-        
-        db.close()
+        # Database totals (shared with the admin dashboard, cached briefly)
+        stats = stats_cache.get()
         
         return jsonify({
             'status': 'online',
@@ -872,20 +1754,71 @@ def system_status():
                 'name': printer_name
             },
             'stats': {
-                'total_users': total_users,
-                'total_prints': total_prints,
-                'total_revenue': total_revenue
+                'total_users': stats['total_users'],
+                'total_prints': stats['total_prints'],
+                'total_revenue': stats['total_revenue']
             },
             'timestamp': datetime.now().isoformat()
         })
         
     except Exception as e:
-        logger.error(f"Status error: {e}")
+        logger.error("Status error: %s", e)
         return jsonify({
             'status': 'error',
             'message': str(e)
         }), 500
 
+@app.route('/api/queue', methods=['GET'])
+def get_queue():
+    """Get print jobs waiting in the scheduler queue"""
+    try:
+        return jsonify({
+            'success': True,
+            'policy': print_scheduler.policy,
+            'queue': print_scheduler.snapshot()
+        })
+        
+    except Exception as e:
+        logger.error("Queue error: %s", e)
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """Server-sent events for one session: upload, conversion, print and credits"""
+    session_id = request.args.get('session_id')
+    g.session_id = session_id
+    
+    if not session_id:
+        return jsonify({
+            'success': False,
+            'message': 'No session ID provided'
+        }), 400
+    
+    last_event_id = parse_last_event_id(
+        request.headers.get('Last-Event-ID', request.args.get('last_event_id')))
+    
+    try:
+        subscription = event_bus.subscribe(session_id, last_event_id)
+    except TooManySubscribers as e:
+        # Each stream holds a server thread: keep the rest for /print and coins
+        logger.warning("Refused event stream for %s: %s", session_id, e)
+        response = jsonify({
+            'success': False,
+            'error': 'too_many_streams',
+            'message': 'Live updates are busy, try again later'
+        })
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    return Response(
+        event_bus.stream(subscription),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/history', methods=['GET'])
 def get_history():
     """Get print history"""
@@ -893,7 +1826,7 @@ def get_history():
         session_id = request.args.get('session_id')
         limit = request.args.get('limit', 10)
         
-        db = get_db()
+        db = get_report_db()
         cursor = db.cursor()
         
         if session_id:
@@ -926,12 +1859,37 @@ def get_history():
         })
         
     except Exception as e:
-        logger.error(f"History error: {e}")
+        logger.error("History error: %s", e)
         return jsonify({
             'success': False,
             'message': str(e)
         }), 500
 
+@app.route('/api/traces', methods=['GET'])
+def get_traces():
+    """Slowest recent upload/print traces and p50/p95 per pipeline stage"""
+    try:
+        limit = int(request.args.get('limit', 20))
+        name = request.args.get('name')
+        
+        return jsonify({
+            'success': True,
+            'stages': tracer.stage_stats(),
+            'slowest': tracer.slowest(limit, name)
+        })
+        
+    except Exception as e:
+        logger.error("Traces error: %s", e)
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Counters and latency histograms in Prometheus text format"""
+    return Response(metrics.registry.expose(), mimetype='text/plain; version=0.0.4')
+
 # ============================================
 # Error Handlers
 # ============================================
@@ -955,16 +1913,41 @@ def not_found(error):
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
-    logger.error(f"Internal error: {error}")
+    logger.error("Internal error: %s", error)
     return jsonify({
         'success': False,
         'error': 'Internal server error'
     }), 500
 
+# ============================================
+# Background Tasks
+# ============================================
+def start_background_tasks():
+    """Prepare the database, recover from the last shutdown and start the worker threads.
+
+    Called once by the serving process (main() or the gunicorn worker),
+    before it serves requests and never on import: scripts and benchmarks
+    that import app must not refund reservations, print, or rotate backups.
+    """
+    db = get_db()
+    try:
+        # One-time full VACUUM on upgraded databases; blocks writes, so not while serving
+        maintenance.enable_incremental_vacuum(db)
+    finally:
+        db.close()
+    settle_open_reservations()
+    rollup_backfill.start()
+    activity_tracker.start()
+    atexit.register(activity_tracker.stop)
+    artifact_pipeline.start()
+    print_scheduler.start()
+    maintenance_scheduler.start()
+
 # ============================================
 # Run Server
 # ============================================
-if __name__ == '__main__':
+def main():
+    """Run the kiosk API and admin dashboard in one server"""
     print("\n" + "="*50)
     print("🖨️  PISO PRINT SERVER v2.0")
     print("="*50)
@@ -974,7 +1957,17 @@ if __name__ == '__main__':
     print(f"💰 Price: ₱{PRICE_PER_PAGE} per page")
     print("="*50)
     print("🌐 Starting server on http://0.0.0.0:5000")
+    print("🔧 Admin dashboard on http://0.0.0.0:5000/admin")
     print("="*50 + "\n")
     
-    # Run Flask server
+    # systemctl stop sends SIGTERM; exit normally so atexit handlers
+    # (pending last_activity updates) still run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_background_tasks()
+    
+    # Flask's server closes the connection after every response; production
+    # runs under gunicorn instead (gunicorn.conf.py), which keeps it open
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+
+if __name__ == '__main__':
+    main()
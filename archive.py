@@ -0,0 +1,220 @@
+"""
+Piso Print Archive
+Moves closed months of print_jobs, transactions, settled credit
+reservations and coin events out of the live database into one gzipped
+SQLite file per month (the maintenance scheduler then gives the freed
+pages back with incremental VACUUM)
+
+    <archive_dir>/pisoprint-2026-08.db.gz
+
+Revenue and usage reports keep working for archived months: they read
+usage_rollups, which stays in the live database. To look inside an
+archive, extract it outside the archive folder (uncompressed files found
+there are treated as interrupted runs and compressed again):
+
+    gunzip -c pisoprint-2026-08.db.gz > /tmp/2026-08.db
+"""
+
+import glob
+import gzip
+import logging
+import os
+import re
+import shutil
+import threading
+from datetime import date
+
+from db import ROLLUP_SOURCES, table_columns
+
+logger = logging.getLogger('pisoprint.archive')
+
+MONTH_PATTERN = re.compile(r'^\d{4}-\d{2}$')
+
+# Tables moved to the archive: table -> (timestamp column, extra condition)
+# Jobs still queued/printing and reservations not yet settled stay live.
+ARCHIVED_TABLES = {
+    'print_jobs': ('printed_at', "status IN ('completed', 'partial', 'failed') AND id NOT IN "
+                                 "(SELECT job_id FROM credit_reservations WHERE status = 'reserved')"),
+    'credit_reservations': ('created_at', "status != 'reserved'"),
+    'transactions': ('created_at', None),
+    'coin_events': ('received_at', None),
+}
+
+# WHERE clause selecting one month (:month) of each table's archivable rows
+MONTH_FILTERS = {
+    table: f"substr({column}, 1, 7) = :month" + (f' AND {condition}' if condition else '')
+    for table, (column, condition) in ARCHIVED_TABLES.items()
+}
+
+
+def month_start(months_ago, today=None):
+    """'YYYY-MM' of the month `months_ago` months before today's"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - months_ago
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+class Archiver:
+    """Archives closed months and compacts the live database.
+
+    keep_months full months are kept live on top of the current one, so
+    with keep_months=2 on 2026-10-19 everything before 2026-08 is archived.
+    Each month is copied into its archive and committed before the rows
+    are deleted live; if power fails in between, the next run copies the
+    same rows again (by primary key, no duplicates) and then deletes them.
+    """
+
+    def __init__(self, get_db, archive_dir, keep_months=2):
+        self.get_db = get_db
+        self.archive_dir = archive_dir
+        self.keep_months = keep_months
+        self._lock = threading.Lock()
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def archive_path(self, month):
+        return os.path.join(self.archive_dir, f'pisoprint-{month}.db')
+
+    def list_archives(self):
+        """Archived months with their compressed size"""
+        archives = []
+        for path in sorted(glob.glob(os.path.join(self.archive_dir, 'pisoprint-*.db.gz'))):
+            month = os.path.basename(path)[len('pisoprint-'):-len('.db.gz')]
+            archives.append({'month': month, 'bytes': os.path.getsize(path)})
+        return archives
+
+    def backfill_pending(self):
+        """Archived tables whose older rows aren't in usage_rollups yet.
+
+        Until reports.RollupBackfill has counted them, archiving would
+        delete those rows uncounted and their revenue would drop out of
+        every report.
+        """
+        db = self.get_db()
+        try:
+            state = dict(db.execute('SELECT name, value FROM rollup_state').fetchall())
+        finally:
+            db.close()
+        return [table for table in ROLLUP_SOURCES if table in ARCHIVED_TABLES
+                and state.get(f'{table}_backfilled', 0) < state.get(f'{table}_backfill_until', 0)]
+
+    def run(self, should_stop=None):
+        """Archive every closed month. Returns {month: rows moved}
+
+        Nothing is archived while the rollup backfill is still running.
+        should_stop() is checked between months and may raise to end the
+        run early (see maintenance.py).
+        """
+        if not self._lock.acquire(blocking=False):
+            return {}  # Already running
+        try:
+            pending = self.backfill_pending()
+            if pending:
+                logger.info("Not archiving yet: rollup backfill of %s is unfinished", ', '.join(pending))
+                return {}
+            self._compress_leftovers()
+            cutoff = month_start(self.keep_months)
+            moved = {}
+            for month in self._months_before(cutoff):
+                if should_stop:
+                    should_stop()
+                moved[month] = self.archive_month(month)
+            return moved
+        finally:
+            self._lock.release()
+
+    def archive_month(self, month):
+        """Move one month's closed rows to its archive file; returns rows moved"""
+        pending = self.backfill_pending()
+        if pending:
+            logger.info("Not archiving %s yet: rollup backfill of %s is unfinished", month, ', '.join(pending))
+            return 0
+
+        path = self.archive_path(month)
+        if os.path.exists(path + '.gz') and not os.path.exists(path):
+            # Late rows for an already archived month: append to it
+            self._decompress(path)
+
+        db = self.get_db()
+        moved = 0
+        try:
+            db.execute('ATTACH DATABASE ? AS archive', (path,))
+            try:
+                # Archive first, committed on its own: a multi-database
+                # transaction isn't atomic across files when main uses WAL
+                params = {'month': month}
+                for table, where in MONTH_FILTERS.items():
+                    columns = ', '.join(self._create_archive_table(db, table))
+                    db.execute(f'''
+                        INSERT OR REPLACE INTO archive.{table} ({columns})
+                        SELECT {columns} FROM main.{table} WHERE {where}
+                    ''', params)
+                db.commit()
+
+                for table, where in MONTH_FILTERS.items():
+                    moved += db.execute(f'''
+                        DELETE FROM main.{table}
+                        WHERE {where} AND id IN (SELECT id FROM archive.{table})
+                    ''', params).rowcount
+                db.commit()
+            finally:
+                if db.in_transaction:
+                    db.rollback()
+                db.execute('DETACH DATABASE archive')
+        finally:
+            db.close()
+
+        self._compress(path)
+        if moved:
+            logger.info("Archived %d row(s) from %s", moved, month)
+        return moved
+
+    def _months_before(self, cutoff):
+        months = set()
+        db = self.get_db()
+        try:
+            for table, (column, condition) in ARCHIVED_TABLES.items():
+                where = f'{column} < ?' + (f' AND {condition}' if condition else '')
+                months.update(row[0] for row in db.execute(
+                    f'SELECT DISTINCT substr({column}, 1, 7) FROM {table} WHERE {where}',
+                    (f'{cutoff}-01',)))
+        finally:
+            db.close()
+        return sorted(month for month in months if month and MONTH_PATTERN.match(month))
+
+    @staticmethod
+    def _create_archive_table(db, table):
+        """Create or update the archive copy of a table; returns the live column names.
+
+        Rows are copied by name, never by position: an archive file made
+        before a migration gets the new columns added (older rows keep
+        NULL), so values can't shift into the wrong column.
+        """
+        # Same columns and primary key as the live table (SQLite stores the
+        # CREATE statement normalized to "CREATE TABLE <name>")
+        sql = db.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                         (table,)).fetchone()[0]
+        db.execute(re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE IF NOT EXISTS archive.{table}', sql, count=1))
+
+        cursor = db.cursor()
+        live = table_columns(cursor, table)
+        archived = table_columns(cursor, table, schema='archive')
+        for column, declared_type in live.items():
+            if column not in archived:
+                db.execute(f'ALTER TABLE archive.{table} ADD COLUMN {column} {declared_type}')
+        return list(live)
+
+    def _compress(self, path):
+        with open(path, 'rb') as source, gzip.open(path + '.gz.part', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(path + '.gz.part', path + '.gz')
+        os.remove(path)
+
+    def _decompress(self, path):
+        with gzip.open(path + '.gz', 'rb') as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+
+    def _compress_leftovers(self):
+        """Compress archives left uncompressed by an interrupted run"""
+        for path in glob.glob(os.path.join(self.archive_dir, 'pisoprint-*.db')):
+            self._compress(path)
+
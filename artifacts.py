@@ -0,0 +1,141 @@
+"""
+Piso Print Artifact Pipeline
+Prepares print-ready files in the background right after upload, so /print
+only has to hand a finished file to the printer
+"""
+
+import itertools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger('pisoprint.artifacts')
+
+# Artifact states (files.artifact_status)
+STATUS_PENDING = 'pending'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+
+class ArtifactJob:
+    """One uploaded file waiting to be prepared"""
+
+    def __init__(self, file_id, filepath, file_type, session_id=None):
+        self.file_id = file_id
+        self.session_id = session_id
+        self.filepath = filepath
+        self.file_type = file_type
+        self.result = {}
+        self.converted = threading.Event()  # Printable (or failed): /print may go ahead
+        self.done = threading.Event()
+
+
+class ArtifactPipeline:
+    """Prepares uploaded files on background worker threads, in two stages.
+
+    convert_fn(job) makes the file printable (DOCX to PDF) and returns a
+    dict of results; on_converted(job, result) stores it. render_fn(job)
+    then does the optional, slow part (CUPS filter rendering) and
+    on_done(job, result) stores the combined result. Queued conversions
+    run before queued renders, and nothing runs on the caller's thread:
+    /print only waits, briefly, for the conversion.
+    """
+
+    CONVERT = 0
+    RENDER = 1
+
+    def __init__(self, convert_fn, render_fn, on_converted, on_done, workers=1):
+        self.convert_fn = convert_fn
+        self.render_fn = render_fn
+        self.on_converted = on_converted
+        self.on_done = on_done
+        self.workers = workers
+
+        self._queue = queue.PriorityQueue()  # (stage, order, job)
+        self._order = itertools.count()
+        self._jobs = {}  # file_id -> ArtifactJob (queued or running)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'artifact-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Artifact pipeline started (%d worker(s))", self.workers)
+
+    def submit(self, file_id, filepath, file_type, session_id=None):
+        """Queue a file for background preparation"""
+        job = ArtifactJob(file_id, filepath, file_type, session_id)
+        with self._lock:
+            self._jobs[file_id] = job
+        self._queue.put((self.CONVERT, next(self._order), job))
+        return job
+
+    def queued(self, file_id):
+        """True while a file is queued or being prepared"""
+        with self._lock:
+            return file_id in self._jobs
+
+    def wait_converted(self, file_id, timeout=None):
+        """Wait until a file is printable; False if it still isn't after timeout.
+
+        Files that were never queued (or finished long ago) return True.
+        Only the conversion is waited for, never the rendering.
+        """
+        with self._lock:
+            job = self._jobs.get(file_id)
+        if job is None:
+            return True
+        return job.converted.wait(timeout)
+
+    def pending(self):
+        """Number of files queued or being prepared"""
+        with self._lock:
+            return len(self._jobs)
+
+    def _run(self):
+        while True:
+            stage, _, job = self._queue.get()
+            if stage == self.CONVERT:
+                self._convert(job)
+            else:
+                self._render(job)
+
+    def _convert(self, job):
+        try:
+            job.result = self.convert_fn(job)
+        except Exception as e:
+            logger.error("Converting file %s failed: %s", job.file_id, e)
+            job.result = {'status': STATUS_FAILED}
+
+        if job.result['status'] == STATUS_FAILED:
+            self._finish(job)
+            return
+        try:
+            self.on_converted(job, job.result)
+        except Exception as e:
+            logger.error("Saving converted file %s failed: %s", job.file_id, e)
+        job.converted.set()
+        self._queue.put((self.RENDER, next(self._order), job))
+
+    def _render(self, job):
+        try:
+            job.result.update(self.render_fn(job))
+        except Exception as e:
+            logger.error("Pre-rendering file %s failed: %s", job.file_id, e)
+        self._finish(job)
+
+    def _finish(self, job):
+        try:
+            self.on_done(job, job.result)
+        except Exception as e:
+            logger.error("Saving artifacts for file %s failed: %s", job.file_id, e)
+        finally:
+            with self._lock:
+                self._jobs.pop(job.file_id, None)
+            job.converted.set()
+            job.done.set()
@@ -0,0 +1,110 @@
+"""
+Piso Print Benchmark Corpus
+Generates test documents (PDF, DOCX, TXT) without any third-party packages
+"""
+
+import io
+import zipfile
+
+
+def make_pdf(pages, image_bytes=0):
+    """Build a valid PDF with the given number of pages.
+
+    image_bytes > 0 embeds an uncompressed grayscale image of about that
+    size on every page (for heavy-image benchmarks).
+    """
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    pages_obj = add(None)
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    image = None
+    if image_bytes:
+        side = max(1, int(image_bytes ** 0.5))
+        pixels = bytes((i * 7) % 256 for i in range(side)) * side
+        image = add(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                    b"/ColorSpace /DeviceGray /BitsPerComponent 8 /Length %d >>\nstream\n"
+                    % (side, side, len(pixels)) + pixels + b"\nendstream")
+
+    page_ids = []
+    for number in range(1, pages + 1):
+        text = b"BT /F1 24 Tf 72 720 Td (Piso Print benchmark page %d) Tj ET" % number
+        if image:
+            text += b"\nq 400 0 0 400 100 200 cm /Im1 Do Q"
+        content = add(b"<< /Length %d >>\nstream\n" % len(text) + text + b"\nendstream")
+        resources = b"<< /Font << /F1 %d 0 R >>" % font
+        if image:
+            resources += b" /XObject << /Im1 %d 0 R >>" % image
+        resources += b" >>"
+        page_ids.append(add(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] "
+                            b"/Resources %s /Contents %d 0 R >>" % (pages_obj, resources, content)))
+
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_obj
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[pages_obj - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+              % (len(objects) + 1, catalog, xref))
+    return out.getvalue()
+
+
+def make_txt(lines, width=72):
+    """Plain text file with the given number of lines"""
+    line = ("Piso Print benchmark text " * 4)[:width] + "\n"
+    return (line * lines).encode('utf-8')
+
+
+_CONTENT_TYPES = b"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+
+_RELS = b"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+
+def make_docx(paragraphs, tables=0, rows=10, cols=4):
+    """Minimal DOCX with word-filled paragraphs and optional tables"""
+    body = []
+    words = " ".join(["benchmark"] * 50)
+    for _ in range(paragraphs):
+        body.append(f"<w:p><w:r><w:t>{words}</w:t></w:r></w:p>")
+
+    for _ in range(tables):
+        table_rows = []
+        for row in range(rows):
+            cells = "".join(
+                f"<w:tc><w:p><w:r><w:t>r{row}c{col}</w:t></w:r></w:p></w:tc>" for col in range(cols))
+            table_rows.append(f"<w:tr>{cells}</w:tr>")
+        body.append("<w:tbl>" + "".join(table_rows) + "</w:tbl><w:p/>")
+
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                '<w:body>' + "".join(body) + '</w:body></w:document>')
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        docx.writestr('_rels/.rels', _RELS)
+        docx.writestr('word/document.xml', document)
+    return out.getvalue()
@@ -0,0 +1,71 @@
+"""
+Fake pycups module for benchmarks
+Accepts print jobs and "prints" each one for a fixed time, so the server's
+scheduler sees realistic queue behaviour without a real printer
+"""
+
+import itertools
+import os
+import sys
+import threading
+import time
+import types
+
+SECONDS_PER_JOB = float(os.environ.get('FAKE_CUPS_SECONDS_PER_JOB', '0.5'))
+
+IPP_JOB_PROCESSING = 5
+IPP_JOB_CANCELED = 7
+IPP_JOB_COMPLETED = 9
+
+
+class Connection:
+    """Subset of cups.Connection used by app.py"""
+
+    _job_ids = itertools.count(1)
+    _jobs = {}  # job ID -> finish time (shared, like the real CUPS daemon)
+    _canceled = set()
+    _lock = threading.Lock()
+
+    def getPrinters(self):
+        return {'PisoPrinter': {'printer-state': 3, 'printer-info': 'Fake benchmark printer'}}
+
+    def printFile(self, printer, filename, title, options):
+        if not os.path.exists(filename):
+            raise RuntimeError(f'client-error-not-found: {filename}')
+        with self._lock:
+            job_id = next(self._job_ids)
+            # Jobs print one after another, like a single physical printer
+            start = max([time.time()] + list(self._jobs.values()))
+            self._jobs[job_id] = start + SECONDS_PER_JOB
+        return job_id
+
+    def getJobs(self, which_jobs='not-completed', **kwargs):
+        now = time.time()
+        with self._lock:
+            if which_jobs == 'not-completed':
+                return {job_id: {} for job_id, finish in self._jobs.items() if finish > now}
+            return {job_id: {} for job_id in self._jobs}
+
+    def getJobAttributes(self, job_id, **kwargs):
+        with self._lock:
+            if job_id in self._canceled:
+                return {'job-id': job_id, 'job-state': IPP_JOB_CANCELED}
+            finish = self._jobs.get(job_id, 0)
+        state = IPP_JOB_PROCESSING if finish > time.time() else IPP_JOB_COMPLETED
+        return {'job-id': job_id, 'job-state': state}
+
+    def cancelJob(self, job_id, purge_job=False):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._canceled.add(job_id)
+
+
+def install():
+    """Register this fake as the 'cups' module before app.py is imported"""
+    module = types.ModuleType('cups')
+    module.Connection = Connection
+    module.IPP_JOB_PROCESSING = IPP_JOB_PROCESSING
+    module.IPP_JOB_CANCELED = IPP_JOB_CANCELED
+    module.IPP_JOB_COMPLETED = IPP_JOB_COMPLETED
+    sys.modules['cups'] = module
+    return module
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Piso Print Benchmark Server
+Runs app.py with a fake CUPS backend and a stub soffice in a scratch
+directory, so load tests never touch a real printer or database
+
+Usage: python benchmarks/fake_server.py --port 5050 --workdir /tmp/pisobench
+"""
+
+import argparse
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run app.py against fake CUPS/soffice')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--workdir', required=True, help='Scratch directory for uploads and DB')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    os.environ['PISOPRINT_UPLOAD_FOLDER'] = os.path.join(args.workdir, 'uploads')
+    os.environ['PISOPRINT_DATABASE'] = os.path.join(args.workdir, 'pisoprint.db')
+    os.environ['PISOPRINT_ARCHIVE_FOLDER'] = os.path.join(args.workdir, 'archive')
+    os.environ['PISOPRINT_BACKUP_FOLDER'] = os.path.join(args.workdir, 'backups')
+    os.environ['PISOPRINT_STAGING_FOLDER'] = os.path.join(args.workdir, 'staging')
+    os.environ['PATH'] = os.path.join(BENCH_DIR, 'stub_bin') + os.pathsep + os.environ.get('PATH', '')
+
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, REPO_DIR)
+
+    import fake_cups
+    fake_cups.install()
+
+    import app as pisoprint
+    pisoprint.start_background_tasks()
+    pisoprint.app.run(host='127.0.0.1', port=args.port, debug=False, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Piso Print Load & Soak Test
+Replays a realistic kiosk traffic mix (coin bursts, chunked uploads, print
+requests, status polling) at a configurable concurrency and reports
+throughput, tail latency and server memory over time
+
+By default it starts benchmarks/fake_server.py (fake CUPS + stub soffice)
+in a scratch directory; use --target to load an already running server.
+
+Examples:
+    python benchmarks/loadtest.py --concurrency 8 --duration 60
+    python benchmarks/loadtest.py --duration 1800 --save-baseline soak_opi
+    python benchmarks/loadtest.py --compare soak_opi --threshold 0.2
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+
+sys.path.insert(0, BENCH_DIR)
+from corpus import make_docx, make_pdf
+
+DEFAULT_MIX = 'coin=40,status=35,upload=15,print=10'
+STREAM_CHUNK_SIZE = 8192  # Same chunk size the ESP32 proxy uses
+
+
+# ============================================
+# Results
+# ============================================
+class Results:
+    """Thread-safe latency samples and error counts per operation"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, op, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(op, []).append(seconds)
+            if not ok:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+
+def percentile(samples, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    rank = max(1, -(-len(samples) * percent // 100))
+    return samples[int(rank) - 1]
+
+
+def read_rss_kb(pid):
+    """Resident memory of a process in KB (Linux /proc)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# ============================================
+# Kiosk client
+# ============================================
+class KioskClient:
+    """One simulated kiosk session talking to the server like the ESP32 does"""
+
+    def __init__(self, host, port, session_id, results, documents, timeout=30):
+        self.host = host
+        self.port = port
+        self.session_id = session_id
+        self.results = results
+        self.documents = documents
+        self.timeout = timeout
+        self.uploaded = False
+
+    def _request(self, op, method, path, body=None, headers=None, chunked=False):
+        # New connection per request, like the ESP32 HTTPClient
+        start = time.perf_counter()
+        ok = False
+        try:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            conn.request(method, path, body=body, headers=headers or {}, encode_chunked=chunked)
+            response = conn.getresponse()
+            payload = response.read()
+            conn.close()
+            ok = response.status < 500
+            return response.status, payload
+        except (OSError, http.client.HTTPException):
+            return None, b''
+        finally:
+            self.results.record(op, time.perf_counter() - start, ok)
+
+    def _post_json(self, op, path, data):
+        return self._request(op, 'POST', path, json.dumps(data).encode(),
+                             {'Content-Type': 'application/json'})
+
+    def coin_burst(self):
+        """A user feeding several coins in a row, one POST per coin pulse"""
+        for _ in range(random.randint(1, 5)):
+            self._post_json('coin', '/api/credits',
+                            {'session_id': self.session_id, 'amount': random.choice((1, 1, 5, 10))})
+
+    def status(self):
+        self._request('status', 'GET', '/api/status')
+        self._request('check_credits', 'GET', f'/api/check_credits?session_id={self.session_id}')
+
+    def upload(self):
+        """Chunked streaming upload, like the ESP32 /upload_proxy"""
+        filename, data = random.choice(self.documents)
+
+        def chunks():
+            for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+                yield data[offset:offset + STREAM_CHUNK_SIZE]
+
+        status, _ = self._request('upload', 'POST', '/upload_stream', chunks(), {
+            'X-Filename': filename,
+            'X-Session-ID': self.session_id,
+            'Content-Type': 'application/octet-stream'
+        }, chunked=True)
+        self.uploaded = status == 200
+
+    def print_job(self):
+        if not self.uploaded:
+            self.upload()
+        self._post_json('coin', '/api/credits', {'session_id': self.session_id, 'amount': 20})
+        self._post_json('print', '/print', {'session_id': self.session_id, 'credits': 20})
+
+
+def parse_mix(spec):
+    weights = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    unknown = set(weights) - {'coin', 'status', 'upload', 'print'}
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def worker(worker_id, host, port, deadline, results, documents, mix, think_time):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    sessions = 0
+
+    while time.time() < deadline:
+        # Each kiosk user does a handful of actions, then the next one walks up
+        sessions += 1
+        client = KioskClient(host, port, f'BENCH_{worker_id}_{sessions}', results, documents)
+        for _ in range(random.randint(3, 10)):
+            if time.time() >= deadline:
+                break
+            action = random.choices(names, weights)[0]
+            getattr(client, {'coin': 'coin_burst', 'print': 'print_job'}.get(action, action))()
+            if think_time:
+                time.sleep(random.uniform(0, think_time))
+
+
+# ============================================
+# Report & baselines
+# ============================================
+def build_report(args, results, elapsed, memory):
+    report = {
+        'config': {
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'mix': args.mix,
+            'upload_kb': args.upload_kb
+        },
+        'elapsed_seconds': round(elapsed, 1),
+        'operations': {},
+        'memory': None
+    }
+
+    total = 0
+    for op, samples in sorted(results.latencies.items()):
+        samples.sort()
+        total += len(samples)
+        report['operations'][op] = {
+            'count': len(samples),
+            'errors': results.errors.get(op, 0),
+            'throughput_rps': round(len(samples) / elapsed, 2),
+            'p50_ms': round(percentile(samples, 50) * 1000, 1),
+            'p95_ms': round(percentile(samples, 95) * 1000, 1),
+            'p99_ms': round(percentile(samples, 99) * 1000, 1),
+            'max_ms': round(samples[-1] * 1000, 1)
+        }
+    report['throughput_rps'] = round(total / elapsed, 2)
+
+    if memory:
+        rss = [kb for _, kb in memory]
+        minutes = max(memory[-1][0] - memory[0][0], 1) / 60
+        report['memory'] = {
+            'start_kb': rss[0],
+            'end_kb': rss[-1],
+            'peak_kb': max(rss),
+            'growth_kb_per_min': round((rss[-1] - rss[0]) / minutes, 1),
+            'timeline': [[round(t, 1), kb] for t, kb in memory]
+        }
+
+    return report
+
+
+def print_report(report):
+    print(f"\n{'Operation':<15}{'Count':>8}{'Errors':>8}{'RPS':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    print('-' * 80)
+    for op, stats in report['operations'].items():
+        print(f"{op:<15}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    print('-' * 80)
+    print(f"Total throughput: {report['throughput_rps']} req/s over {report['elapsed_seconds']}s")
+
+    memory = report['memory']
+    if memory:
+        print(f"Server RSS: start {memory['start_kb'] // 1024} MB, peak {memory['peak_kb'] // 1024} MB, "
+              f"end {memory['end_kb'] // 1024} MB ({memory['growth_kb_per_min']} KB/min)")
+
+
+def compare(report, baseline, threshold):
+    """List regressions of more than threshold (fraction) against a baseline"""
+    regressions = []
+
+    for op, base in baseline['operations'].items():
+        current = report['operations'].get(op)
+        if not current:
+            continue
+        if base['p95_ms'] and current['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append(f"{op}: p95 {base['p95_ms']} ms -> {current['p95_ms']} ms")
+        if base['throughput_rps'] and current['throughput_rps'] < base['throughput_rps'] * (1 - threshold):
+            regressions.append(f"{op}: throughput {base['throughput_rps']} -> {current['throughput_rps']} req/s")
+        if current['errors'] > base['errors']:
+            regressions.append(f"{op}: errors {base['errors']} -> {current['errors']}")
+
+    if baseline.get('memory') and report.get('memory'):
+        base_peak = baseline['memory']['peak_kb']
+        if report['memory']['peak_kb'] > base_peak * (1 + threshold):
+            regressions.append(f"memory: peak {base_peak} KB -> {report['memory']['peak_kb']} KB")
+
+    return regressions
+
+
+# ============================================
+# Main
+# ============================================
+def start_fake_server(port, workdir):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'fake_server.py'), '--port', str(port), '--workdir', workdir],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise SystemExit('Fake server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Piso Print load and soak test')
+    parser.add_argument('--target', help='URL of a running server (default: start a fake-CUPS server)')
+    parser.add_argument('--pid', type=int, help='Server PID for memory sampling with --target')
+    parser.add_argument('--port', type=int, default=5050, help='Port for the fake server')
+    parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous kiosk sessions')
+    parser.add_argument('--duration', type=float, default=30, help='Test length in seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Operation weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--upload-kb', type=int, default=200, help='Approximate size of uploaded PDFs')
+    parser.add_argument('--think-time', type=float, default=0.5, help='Max pause between user actions (s)')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Memory sampling interval (s)')
+    parser.add_argument('--report', help='Write the full JSON report to this file')
+    parser.add_argument('--save-baseline', metavar='NAME', help='Save the report as a named baseline')
+    parser.add_argument('--compare', metavar='NAME', help='Compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed regression (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    documents = [
+        ('bench_small.pdf', make_pdf(2)),
+        ('bench_large.pdf', make_pdf(10, image_bytes=args.upload_kb * 1024)),
+        ('bench_letter.docx', make_docx(40, tables=2)),
+        ('bench_notes.txt', b'Piso Print benchmark\n' * 500),
+    ]
+
+    server = None
+    workdir = None
+    if args.target:
+        target = urlparse(args.target)
+        host, port, pid = target.hostname, target.port or 80, args.pid
+    else:
+        workdir = tempfile.mkdtemp(prefix='pisobench_')
+        server = start_fake_server(args.port, workdir)
+        host, port, pid = '127.0.0.1', args.port, server.pid
+
+    print(f"Load test: {args.concurrency} sessions for {args.duration}s against {host}:{port} (mix: {args.mix})")
+
+    results = Results()
+    memory = []
+    started = time.time()
+    deadline = started + args.duration
+    stop_sampling = threading.Event()
+
+    def sample_memory():
+        while not stop_sampling.is_set():
+            rss = read_rss_kb(pid) if pid else None
+            if rss is not None:
+                memory.append((time.time() - started, rss))
+            stop_sampling.wait(args.sample_interval)
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+
+    threads = [
+        threading.Thread(target=worker, args=(i, host, port, deadline, results, documents, mix, args.think_time))
+        for i in range(args.concurrency)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop_sampling.set()
+        sampler.join()
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = build_report(args, results, time.time() - started, memory)
+    print_report(report)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'{args.save_baseline}.json')
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved: {path}")
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json')) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ Regressions vs '{args.compare}' (threshold {args.threshold:.0%}):")
+            for line in regressions:
+                print(f"   {line}")
+            sys.exit(1)
+        print(f"\n✅ No regressions vs '{args.compare}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Piso Print Micro-benchmarks
+Times the page counters and the DOCX converter from app.py in isolation
+against a generated corpus, and records peak memory for each case
+
+Each case runs in its own forked process so peak RSS belongs to that
+function alone. Results can be saved as a baseline and compared later;
+the run fails (exit 1) when a case gets slower or bigger than allowed.
+
+Examples:
+    python benchmarks/microbench.py
+    python benchmarks/microbench.py --save-baseline pypdf2_3.0.1
+    python benchmarks/microbench.py --compare pypdf2_3.0.1 --threshold 0.15
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+
+sys.path.insert(0, BENCH_DIR)
+from corpus import make_docx, make_pdf, make_txt
+
+# name -> (builder, file extension); "quick" cases run with --quick
+CORPUS = {
+    'pdf_1_page': (lambda: make_pdf(1), 'pdf', True),
+    'pdf_10_pages': (lambda: make_pdf(10), 'pdf', True),
+    'pdf_100_pages': (lambda: make_pdf(100), 'pdf', True),
+    'pdf_1000_pages': (lambda: make_pdf(1000), 'pdf', False),
+    'pdf_heavy_images': (lambda: make_pdf(20, image_bytes=512 * 1024), 'pdf', False),
+    'docx_text': (lambda: make_docx(200), 'docx', True),
+    'docx_tables': (lambda: make_docx(100, tables=50, rows=20, cols=6), 'docx', False),
+    'txt_small': (lambda: make_txt(500), 'txt', True),
+    'txt_huge': (lambda: make_txt(500000), 'txt', False),
+}
+
+# (function name in app.py, corpus entries it runs on)
+CASES = [
+    ('count_pdf_pages', ['pdf_1_page', 'pdf_10_pages', 'pdf_100_pages', 'pdf_1000_pages', 'pdf_heavy_images']),
+    ('count_docx_pages', ['docx_text', 'docx_tables']),
+    ('count_txt_pages', ['txt_small', 'txt_huge']),
+    ('count_file_pages', ['pdf_100_pages', 'docx_text', 'txt_small']),
+    ('convert_docx_to_pdf', ['docx_text', 'docx_tables']),
+]
+
+# Functions whose result means nothing without an optional dependency
+REQUIRES = {
+    'count_pdf_pages': 'PYPDF2_AVAILABLE',
+    'count_docx_pages': 'DOCX_AVAILABLE',
+}
+
+
+def load_app(workdir, stub_soffice):
+    """Import app.py against a scratch directory and a fake CUPS module"""
+    os.environ['PISOPRINT_UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ['PISOPRINT_DATABASE'] = os.path.join(workdir, 'pisoprint.db')
+    os.environ['PISOPRINT_ARCHIVE_FOLDER'] = os.path.join(workdir, 'archive')
+    os.environ['PISOPRINT_BACKUP_FOLDER'] = os.path.join(workdir, 'backups')
+    os.environ['PISOPRINT_STAGING_FOLDER'] = os.path.join(workdir, 'staging')
+    if stub_soffice:
+        os.environ['PATH'] = os.path.join(BENCH_DIR, 'stub_bin') + os.pathsep + os.environ.get('PATH', '')
+
+    sys.path.insert(0, REPO_DIR)
+    import fake_cups
+    fake_cups.install()
+
+    import logging
+    import app as pisoprint
+    logging.getLogger().setLevel(logging.WARNING)
+    return pisoprint
+
+
+def read_rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _run_case(pisoprint, function_name, path, extension, iterations, queue):
+    """Child process: time the function and report peak memory"""
+    function = getattr(pisoprint, function_name)
+    if function_name == 'count_file_pages':
+        call = lambda: function(path, extension)
+    elif function_name == 'convert_docx_to_pdf':
+        def call():
+            # Convert a fresh copy each time so output never already exists
+            source = path + f'.{time.perf_counter_ns()}.docx'
+            shutil.copyfile(path, source)
+            result = function(source)
+            for leftover in (source, result):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+            return result
+    else:
+        call = lambda: function(path)
+
+    rss_before = read_rss_kb()
+    call()  # Warm-up (imports, caches)
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = call()
+        timings.append(time.perf_counter() - start)
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        'result': result if isinstance(result, (int, float)) else str(result),
+        'min_ms': round(min(timings) * 1000, 3),
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+        'peak_rss_kb': peak_kb,
+        'rss_growth_kb': max(0, peak_kb - rss_before)
+    })
+
+
+def run_case(pisoprint, function_name, path, extension, iterations):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    child = context.Process(target=_run_case,
+                            args=(pisoprint, function_name, path, extension, iterations, queue))
+    child.start()
+    child.join()
+    if child.exitcode != 0:
+        return {'error': f'exit code {child.exitcode}'}
+    return queue.get()
+
+
+def compare(results, baseline, threshold, memory_threshold):
+    """List cases that got slower or use more memory than allowed"""
+    regressions = []
+
+    for key, base in baseline['cases'].items():
+        current = results.get(key)
+        if not current or 'median_ms' not in current or 'median_ms' not in base:
+            continue
+        if current['median_ms'] > base['median_ms'] * (1 + threshold):
+            regressions.append(f"{key}: median {base['median_ms']} ms -> {current['median_ms']} ms")
+        if current['rss_growth_kb'] > max(base['rss_growth_kb'], 1024) * (1 + memory_threshold):
+            regressions.append(f"{key}: RSS growth {base['rss_growth_kb']} KB -> {current['rss_growth_kb']} KB")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Piso Print page counter / converter micro-benchmarks')
+    parser.add_argument('--iterations', type=int, default=5, help='Timed runs per case')
+    parser.add_argument('--quick', action='store_true', help='Skip the large corpus entries')
+    parser.add_argument('--filter', help='Only run functions whose name contains this text')
+    parser.add_argument('--stub-soffice', action='store_true',
+                        help='Use the stub soffice even if LibreOffice is installed')
+    parser.add_argument('--save-baseline', metavar='NAME', help='Save results as a named baseline')
+    parser.add_argument('--compare', metavar='NAME', help='Compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown (0.2 = 20%%)')
+    parser.add_argument('--memory-threshold', type=float, default=0.25, help='Allowed RSS growth increase')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pisomicro_')
+    try:
+        stub_soffice = args.stub_soffice or shutil.which('soffice') is None
+        pisoprint = load_app(workdir, stub_soffice)
+
+        print("Generating corpus...")
+        corpus_dir = os.path.join(workdir, 'corpus')
+        os.makedirs(corpus_dir)
+        paths = {}
+        for name, (builder, extension, quick) in CORPUS.items():
+            if args.quick and not quick:
+                continue
+            paths[name] = os.path.join(corpus_dir, f'{name}.{extension}')
+            with open(paths[name], 'wb') as f:
+                f.write(builder())
+
+        results = {}
+        print(f"\n{'Case':<48}{'median ms':>11}{'min ms':>10}{'peak RSS':>11}{'growth':>10}")
+        print('-' * 90)
+        for function_name, entries in CASES:
+            if args.filter and args.filter not in function_name:
+                continue
+
+            flag = REQUIRES.get(function_name)
+            for entry in entries:
+                if entry not in paths:
+                    continue
+                key = f'{function_name}[{entry}]'
+
+                if flag and not getattr(pisoprint, flag):
+                    results[key] = {'skipped': f'{flag} is False'}
+                    print(f"{key:<48}  skipped ({flag} is False)")
+                    continue
+
+                extension = CORPUS[entry][1]
+                stats = run_case(pisoprint, function_name, paths[entry], extension, args.iterations)
+                if function_name == 'convert_docx_to_pdf':
+                    stats['stub_soffice'] = stub_soffice
+                results[key] = stats
+
+                if 'error' in stats:
+                    print(f"{key:<48}  failed ({stats['error']})")
+                else:
+                    print(f"{key:<48}{stats['median_ms']:>11}{stats['min_ms']:>10}"
+                          f"{stats['peak_rss_kb'] // 1024:>8} MB{stats['rss_growth_kb'] // 1024:>7} MB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'iterations': args.iterations, 'python': sys.version.split()[0], 'cases': results}
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'micro_{args.save_baseline}.json')
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved: {path}")
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'micro_{args.compare}.json')) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.memory_threshold)
+        if regressions:
+            print(f"\n❌ Regressions vs '{args.compare}':")
+            for line in regressions:
+                print(f"   {line}")
+            sys.exit(1)
+        print(f"\n✅ No regressions vs '{args.compare}'")
+
+
+if __name__ == '__main__':
+    main()
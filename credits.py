@@ -0,0 +1,148 @@
+"""
+Piso Print Credit Ledger
+Reserve / commit / release protocol for paying for print jobs
+
+/print reserves the cost with a conditional UPDATE guarded by the balance
+and the user's version number, so two simultaneous prints can never both
+spend the same credits and the balance never goes negative. When the job
+finishes, the reservation is committed; if CUPS cancels or aborts it, the
+unprinted share is refunded automatically.
+"""
+
+import logging
+import math
+
+logger = logging.getLogger('pisoprint.credits')
+
+# credit_reservations.status
+RESERVED = 'reserved'
+COMMITTED = 'committed'
+RELEASED = 'released'
+
+
+class InsufficientCredits(Exception):
+    """The balance doesn't cover the cost"""
+
+    def __init__(self, balance, needed):
+        super().__init__(f'Insufficient credits. Need ₱{needed}, have ₱{balance}')
+        self.balance = balance
+        self.needed = needed
+
+
+class CreditLedger:
+    """Credit reservations stored in SQLite.
+
+    Methods that take a db connection run inside the caller's transaction
+    (the caller commits); the others open and commit their own.
+    """
+
+    def __init__(self, get_db, max_attempts=3):
+        self.get_db = get_db
+        self.max_attempts = max_attempts
+
+    def reserve(self, db, session_id, job_id, amount, expected_version, description):
+        """Take amount from the balance and hold it for job_id.
+
+        expected_version is the users.version the caller's balance check was
+        based on. If another request changed the balance since, the current
+        row is re-read and the reservation retried. Returns the new
+        {'credits', 'version'}; raises InsufficientCredits if the balance is
+        too low.
+        """
+        version = expected_version
+        for _ in range(self.max_attempts):
+            cursor = db.execute('''
+                UPDATE users
+                SET credits = credits - ?, version = version + 1
+                WHERE session_id = ? AND credits >= ? AND version = ?
+            ''', (amount, session_id, amount, version))
+            if cursor.rowcount == 1:
+                break
+
+            row = db.execute('SELECT credits, version FROM users WHERE session_id = ?',
+                             (session_id,)).fetchone()
+            if row is None or row['credits'] < amount:
+                raise InsufficientCredits(row['credits'] if row else 0, amount)
+            logger.debug("Version conflict for %s (expected %s, now %s), retrying",
+                         session_id, version, row['version'])
+            version = row['version']
+        else:
+            raise RuntimeError(f'Could not reserve credits for {session_id} (too many concurrent updates)')
+
+        db.execute('''
+            INSERT INTO credit_reservations (session_id, job_id, amount, status)
+            VALUES (?, ?, ?, ?)
+        ''', (session_id, job_id, amount, RESERVED))
+        db.execute('''
+            INSERT INTO transactions (session_id, type, amount, description)
+            VALUES (?, 'deduct', ?, ?)
+        ''', (session_id, amount, description))
+
+        row = db.execute('SELECT credits, version FROM users WHERE session_id = ?',
+                         (session_id,)).fetchone()
+        return {'credits': row['credits'], 'version': row['version']}
+
+    def settle(self, job_id, printed_units, planned_units):
+        """Close a job's reservation once its outcome is known.
+
+        The share of the amount for units (pages) that were not printed is
+        refunded, rounded in the customer's favour. Returns (session_id,
+        refund, new_balance), or None if there was nothing to settle.
+        """
+        db = self.get_db()
+        try:
+            reservation = db.execute('''
+                SELECT id, session_id, amount FROM credit_reservations
+                WHERE job_id = ? AND status = ?
+            ''', (job_id, RESERVED)).fetchone()
+            if reservation is None:
+                return None
+
+            amount = reservation['amount']
+            unprinted = max(0, planned_units - printed_units)
+            refund = amount if planned_units <= 0 else min(amount, math.ceil(amount * unprinted / planned_units))
+            status = RELEASED if refund == amount else COMMITTED
+
+            # Status guard makes settling idempotent if two threads race
+            cursor = db.execute('''
+                UPDATE credit_reservations
+                SET status = ?, refunded = ?, settled_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = ?
+            ''', (status, refund, reservation['id'], RESERVED))
+            if cursor.rowcount != 1:
+                db.rollback()
+                return None
+
+            session_id = reservation['session_id']
+            if refund:
+                db.execute('''
+                    UPDATE users SET credits = credits + ?, version = version + 1
+                    WHERE session_id = ?
+                ''', (refund, session_id))
+                db.execute('''
+                    INSERT INTO transactions (session_id, type, amount, description)
+                    VALUES (?, 'refund', ?, ?)
+                ''', (session_id, refund, f'Refund for print job {job_id} ({unprinted} unprinted)'))
+
+            balance = db.execute('SELECT credits FROM users WHERE session_id = ?',
+                                 (session_id,)).fetchone()
+            db.commit()
+        finally:
+            db.close()
+
+        if refund:
+            logger.info("Refunded %d credit(s) for print job %s", refund, job_id)
+        return session_id, refund, balance['credits'] if balance else None
+
+    def open_reservations(self):
+        """Reservations that were never settled, with their job status"""
+        db = self.get_db()
+        try:
+            return [dict(row) for row in db.execute('''
+                SELECT r.job_id, r.session_id, r.amount, j.status AS job_status
+                FROM credit_reservations r
+                LEFT JOIN print_jobs j ON j.id = r.job_id
+                WHERE r.status = ?
+            ''', (RESERVED,)).fetchall()]
+        finally:
+            db.close()
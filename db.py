@@ -0,0 +1,385 @@
+"""
+Piso Print Data Layer
+One schema definition, a pool of SQLite connections and a cache of
+dashboard totals, shared by the kiosk API (app.py) and the admin
+dashboard (admin.py) running in the same process
+
+The database runs in WAL (write-ahead log) mode. Reports and dashboard
+queries use a separate read-only pool: each of their queries reads a
+consistent snapshot and never holds a lock that a coin credit or print
+reservation has to wait for.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('pisoprint.db')
+
+
+# ============================================
+# Schema
+# ============================================
+def table_columns(cursor, table, schema='main'):
+    """Columns of a table as {name: declared type}, in table order (migrations included)"""
+    cursor.execute(f'PRAGMA {schema}.table_info({table})')
+    return {row[1]: row[2] for row in cursor.fetchall()}
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to an existing table (CREATE TABLE IF NOT EXISTS won't)"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        logger.info("Added column %s.%s", table, column)
+
+def init_schema(conn):
+    """Create the tables and indexes, and migrate older databases"""
+    cursor = conn.cursor()
+
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT UNIQUE NOT NULL,
+            credits INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Files table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_size INTEGER,
+            pages INTEGER,
+            file_type TEXT,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES users(session_id)
+        )
+    ''')
+
+    # Transactions table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES users(session_id)
+        )
+    ''')
+
+    # Print jobs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS print_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            file_id INTEGER NOT NULL,
+            pages INTEGER NOT NULL,
+            cost INTEGER NOT NULL,
+            status TEXT DEFAULT 'printing',
+            options TEXT,
+            printed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES users(session_id),
+            FOREIGN KEY (file_id) REFERENCES files(id)
+        )
+    ''')
+
+    # Credits held for print jobs until CUPS finishes them (see credits.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS credit_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            job_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            refunded INTEGER DEFAULT 0,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            settled_at TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES users(session_id),
+            FOREIGN KEY (job_id) REFERENCES print_jobs(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reservations_job ON credit_reservations(job_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reservations_status ON credit_reservations(status)')
+
+    # Coin events from /api/credits/batch; (device_id, seq) makes retries idempotent
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS coin_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (device_id, seq)
+        )
+    ''')
+
+    # Columns added after the first release (older databases lack them)
+    add_column_if_missing(cursor, 'print_jobs', 'options', 'TEXT')
+    add_column_if_missing(cursor, 'users', 'version', 'INTEGER DEFAULT 0')
+    add_column_if_missing(cursor, 'files', 'storage_id', 'TEXT')
+    add_column_if_missing(cursor, 'files', 'print_path', 'TEXT')
+    add_column_if_missing(cursor, 'files', 'artifact_path', 'TEXT')
+    add_column_if_missing(cursor, 'files', 'artifact_status', 'TEXT')
+
+    # Index of the file store: uploads are found by ID, never by listing folders
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_files_storage_id ON files(storage_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_session ON files(session_id, uploaded_at)')
+    # Idle zero-balance sessions, found by the purge without scanning users (see sessions.py)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_idle ON users(last_activity) WHERE credits = 0')
+
+    # Last completed run of each maintenance task (see maintenance.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            task TEXT PRIMARY KEY,
+            last_run INTEGER NOT NULL,
+            duration_ms REAL,
+            status TEXT
+        )
+    ''')
+
+    init_rollups(cursor)
+
+    conn.commit()
+
+# Rollup buckets by period, in local time (peak hours are the shop's hours)
+ROLLUP_BUCKETS = {
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+}
+
+# Sources feeding usage_rollups: table -> (timestamp column, rows counted, column values)
+ROLLUP_SOURCES = {
+    'print_jobs': ('printed_at', None, {
+        'jobs': '1',
+        'pages': '{row}pages',
+        'revenue': '{row}cost',
+    }),
+    'transactions': ('created_at', "{row}type IN ('add', 'refund')", {
+        'refunds': "CASE WHEN {row}type = 'refund' THEN {row}amount ELSE 0 END",
+        'coins': "CASE WHEN {row}type = 'add' THEN {row}amount ELSE 0 END",
+    }),
+}
+
+def rollup_upsert_sql(table, backfill=False):
+    """INSERT ... ON CONFLICT adding a source table's rows to usage_rollups.
+
+    The trigger version adds the NEW row; the backfill version adds the
+    rows with :start < id <= :end, grouped by bucket.
+    """
+    time_column, condition, values = ROLLUP_SOURCES[table]
+    row = '' if backfill else 'NEW.'
+    timestamp = f"COALESCE({row}{time_column}, CURRENT_TIMESTAMP)"
+    columns = ', '.join(values)
+    updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in values)
+
+    selects = []
+    for period, bucket_format in ROLLUP_BUCKETS.items():
+        bucket = f"strftime('{bucket_format}', {timestamp}, 'localtime')"
+        if backfill:
+            where = 'id > :start AND id <= :end'
+            if condition:
+                where += f' AND {condition.format(row=row)}'
+            sums = ', '.join(f'SUM({expr.format(row=row)})' for expr in values.values())
+            selects.append(f"SELECT '{period}', {bucket}, {sums} FROM {table} WHERE {where} GROUP BY 2")
+        else:
+            exprs = ', '.join(expr.format(row=row) for expr in values.values())
+            selects.append(f"SELECT '{period}', {bucket}, {exprs}")
+
+    return f'''
+        INSERT INTO usage_rollups (period, bucket, {columns})
+        SELECT * FROM ({' UNION ALL '.join(selects)}) WHERE true
+        ON CONFLICT (period, bucket) DO UPDATE SET {updates}
+    '''
+
+def init_rollups(cursor):
+    """Revenue and usage totals per hour/day/month, kept current by triggers.
+
+    When a trigger is first created, rows already in its source table are
+    left to reports.RollupBackfill: rollup_state records the highest ID
+    the trigger does not cover.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            jobs INTEGER DEFAULT 0,
+            pages INTEGER DEFAULT 0,
+            revenue INTEGER DEFAULT 0,
+            refunds INTEGER DEFAULT 0,
+            coins INTEGER DEFAULT 0,
+            PRIMARY KEY (period, bucket)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+
+    for table in ROLLUP_SOURCES:
+        trigger = f'rollup_{table}'
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (trigger,))
+        if cursor.fetchone():
+            continue
+
+        # Same transaction as the trigger: no row is counted twice or missed
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO rollup_state (name, value)
+            VALUES (?, (SELECT COALESCE(MAX(id), 0) FROM {table}))
+        ''', (f'{table}_backfill_until',))
+        cursor.execute('INSERT OR IGNORE INTO rollup_state (name, value) VALUES (?, 0)',
+                       (f'{table}_backfilled',))
+        condition = ROLLUP_SOURCES[table][1]
+        when = f'WHEN {condition.format(row="NEW.")}' if condition else ''
+        cursor.execute(f'''
+            CREATE TRIGGER {trigger} AFTER INSERT ON {table} {when}
+            BEGIN
+                {rollup_upsert_sql(table)};
+            END
+        ''')
+        logger.info("Created rollup trigger for %s", table)
+
+def enable_wal(conn):
+    """Switch the database file to write-ahead logging (the setting persists).
+
+    synchronous stays FULL, so every committed credit is on disk before
+    the request returns.
+    """
+    mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    if mode.lower() != 'wal':
+        logger.warning("Could not enable WAL (journal_mode=%s); reads may block writes", mode)
+    return mode
+
+
+# ============================================
+# Connection Pool
+# ============================================
+class PooledConnection(sqlite3.Connection):
+    """Connection whose close() hands it back to its pool"""
+
+    pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+
+class ConnectionPool:
+    """Reuses SQLite connections instead of opening one per request.
+
+    connect() returns an idle connection, or opens a new one if none is
+    free, so callers never wait. close() on a pooled connection rolls back
+    anything left uncommitted and keeps it for the next caller; connections
+    beyond `size` are really closed. factory is an sqlite3.Connection
+    subclass (e.g. metrics.InstrumentedConnection) to build on.
+
+    A read_only pool sets query_only on its connections, for reports that
+    must never write.
+    """
+
+    def __init__(self, path, size=4, factory=sqlite3.Connection, timeout=5.0, read_only=False):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.read_only = read_only
+        self._factory = type(f'Pooled{factory.__name__}', (PooledConnection, factory), {})
+        self._idle = queue.LifoQueue(maxsize=size)  # Most recently used first (warm page cache)
+
+    def connect(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.pool = None
+            conn.close()
+
+    def close_all(self):
+        """Close the idle connections (those in use close when released)"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.pool = None
+            conn.close()
+
+    def _open(self):
+        # Connections move between request and worker threads, but only
+        # one thread uses a connection between connect() and close()
+        conn = sqlite3.connect(self.path, timeout=self.timeout, factory=self._factory,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if self.read_only:
+            conn.execute('PRAGMA query_only = ON')
+        conn.pool = self
+        return conn
+
+
+# ============================================
+# Dashboard Totals
+# ============================================
+def collect_stats(db):
+    """Totals shown by /api/status and the admin dashboard"""
+    row = db.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM users) AS total_users,
+            (SELECT COUNT(*) FROM files) AS total_files,
+            (SELECT COALESCE(SUM(file_size), 0) FROM files) AS disk_usage,
+            -- From the rollups: they still count jobs that were archived
+            (SELECT COALESCE(SUM(jobs), 0) FROM usage_rollups WHERE period = 'month') AS total_prints,
+            (SELECT COALESCE(SUM(revenue), 0) FROM usage_rollups WHERE period = 'month') AS total_revenue
+    ''').fetchone()
+    stats = dict(row)
+    # Disk usage comes from the files index (no directory scan)
+    stats['disk_usage_mb'] = round(stats.pop('disk_usage') / 1024 / 1024, 2)
+    return stats
+
+
+class StatsCache:
+    """Dashboard totals recomputed at most every ttl_seconds.
+
+    load_fn() returns the stats dict. Writers that change the totals
+    noticeably (admin cleanup) call invalidate().
+    """
+
+    def __init__(self, load_fn, ttl_seconds=10):
+        self.load_fn = load_fn
+        self.ttl_seconds = ttl_seconds
+        self._value = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._value is None or time.monotonic() >= self._expires_at:
+                self._value = self.load_fn()
+                self._expires_at = time.monotonic() + self.ttl_seconds
+            return dict(self._value)
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
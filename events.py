@@ -0,0 +1,131 @@
+"""
+Piso Print Event Bus
+Pushes upload, conversion, print and credit updates to clients as
+server-sent events (SSE), one channel per session_id
+"""
+
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('pisoprint.events')
+
+
+class TooManySubscribers(Exception):
+    """All stream slots are taken; the client should retry later or poll"""
+
+
+class Subscription:
+    """One connected client: a bounded queue of pending events"""
+
+    def __init__(self, session_id, max_queue):
+        self.session_id = session_id
+        self.queue = queue.Queue(maxsize=max_queue)
+
+    def put(self, event):
+        """Queue an event, dropping the oldest one if the client is too slow"""
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class EventBus:
+    """Fan-out of per-session events to any number of SSE subscribers.
+
+    Every event gets an increasing ID. The last few events per session are
+    kept so a client that reconnects with Last-Event-ID doesn't miss any.
+    Each open stream holds a server thread, so at most max_subscribers
+    are accepted (None for no limit).
+    """
+
+    def __init__(self, history=20, max_queue=100, keepalive_seconds=15, max_sessions=500,
+                 max_subscribers=None):
+        self.history = history
+        self.max_queue = max_queue
+        self.keepalive_seconds = keepalive_seconds
+        self.max_sessions = max_sessions
+        self.max_subscribers = max_subscribers
+
+        self._ids = itertools.count(1)
+        self._subscribers = {}  # session_id -> set of Subscription
+        self._recent = {}       # session_id -> deque of recent events (oldest session first)
+        self._lock = threading.Lock()
+
+    def publish(self, session_id, event, data):
+        """Send an event to every subscriber of session_id"""
+        if not session_id:
+            return
+        item = (next(self._ids), event, json.dumps(data, default=str))
+
+        with self._lock:
+            recent = self._recent.pop(session_id, None) or deque(maxlen=self.history)
+            recent.append(item)
+            self._recent[session_id] = recent  # Most recently active last
+            while len(self._recent) > self.max_sessions:
+                del self._recent[next(iter(self._recent))]
+            subscribers = list(self._subscribers.get(session_id, ()))
+
+        for subscription in subscribers:
+            subscription.put(item)
+
+    def subscribe(self, session_id, last_event_id=None):
+        """Register a client; events after last_event_id are replayed.
+
+        Raises TooManySubscribers when max_subscribers streams are open.
+        """
+        subscription = Subscription(session_id, self.max_queue)
+        with self._lock:
+            if (self.max_subscribers is not None
+                    and sum(len(subscribers) for subscribers in self._subscribers.values()) >= self.max_subscribers):
+                raise TooManySubscribers(f'{self.max_subscribers} event streams already open')
+            self._subscribers.setdefault(session_id, set()).add(subscription)
+            if last_event_id is not None:
+                for item in self._recent.get(session_id, ()):
+                    if item[0] > last_event_id:
+                        subscription.put(item)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.session_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.session_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def stream(self, subscription):
+        """Generator of SSE-formatted text for a streaming response (unsubscribes when closed)"""
+        try:
+            yield f"retry: 3000\n: connected {time.strftime('%H:%M:%S')}\n\n"
+            while True:
+                try:
+                    event_id, event, data = subscription.queue.get(timeout=self.keepalive_seconds)
+                except queue.Empty:
+                    # Comment line keeps proxies and the client from timing out
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+
+def parse_last_event_id(value):
+    """Last-Event-ID header/query value as an int, or None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,137 @@
+"""
+Piso Print File Types
+Detects what an upload really is from its first bytes, so a mislabelled
+or corrupt file is rejected after a few KB instead of being stored in full
+and failing at print time
+
+detect() returns the type used for storage, page counting and conversion:
+'pdf', 'docx', 'doc', 'jpg', 'png' or 'txt'.
+"""
+
+import logging
+
+logger = logging.getLogger('pisoprint.filetypes')
+
+SNIFF_BYTES = 4096  # Bytes inspected before an upload is accepted
+
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'doc'),  # OLE2 compound file (Word 97-2003)
+    (b'PK\x03\x04', 'zip'),
+)
+
+# Member names that mark a ZIP as an Office Open XML document
+OOXML_MARKERS = (b'[Content_Types].xml', b'_rels/', b'docProps/', b'word/')
+
+# Control bytes allowed in plain text: tab, newline, carriage return, form feed, backspace, DOS EOF
+TEXT_CONTROLS = frozenset(b'\t\n\r\f\b\x1a')
+
+DESCRIPTION = 'PDF, Word, JPEG, PNG or plain text'
+
+
+class UnsupportedContent(ValueError):
+    """The upload's content isn't a printable type (or doesn't match its name)"""
+
+
+def detect(head):
+    """Type of a file from its first bytes, or None if it isn't printable"""
+    if b'%PDF-' in head[:1024]:  # Readers accept a little junk before the header
+        return 'pdf'
+    for signature, file_type in SIGNATURES:
+        if head.startswith(signature):
+            if file_type == 'zip':
+                return 'docx' if any(marker in head for marker in OOXML_MARKERS) else None
+            return file_type
+    if head and is_text(head):
+        return 'txt'
+    return None
+
+
+def is_text(head):
+    """True if head has no control bytes besides whitespace (UTF-8 and 8-bit text both pass)"""
+    return all(byte >= 0x20 or byte in TEXT_CONTROLS for byte in head)
+
+
+def check(head, extension):
+    """Detected type of an upload named *.extension; raises UnsupportedContent.
+
+    Binary types win over the extension (a PNG named .jpg is a PNG). Text
+    is only accepted for .txt: a "PDF" that decodes as text is usually an
+    error page or a truncated download.
+    """
+    file_type = detect(head)
+    if file_type is None:
+        raise UnsupportedContent(f'File content is not a supported document ({DESCRIPTION})')
+    if file_type == 'txt' and extension != 'txt':
+        raise UnsupportedContent(f'File content does not match its .{extension} extension')
+    if file_type != extension and not (file_type == 'jpg' and extension == 'jpeg'):
+        logger.info("Upload named .%s is %s, handling it as %s", extension, file_type, file_type)
+    return file_type
+
+
+def read_head(read, size=SNIFF_BYTES):
+    """Read up to size bytes from a stream (fewer only at end of stream)"""
+    head = b''
+    while len(head) < size:
+        chunk = read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+
+def prepend(head, read):
+    """read() that returns head first and then continues with the stream"""
+    pending = [head] if head else []
+
+    def read_with_head(size=-1):
+        if pending:
+            return pending.pop()
+        return read(size)
+    return read_with_head
+
+
+class SniffingFile:
+    """Wraps a multipart temp file and checks the part's first bytes as they arrive.
+
+    Once rejected, further writes are dropped, so a bad upload costs at
+    most SNIFF_BYTES of storage. `file_type` / `error` are set after
+    SNIFF_BYTES or when the part ends (see finish()).
+    """
+
+    def __init__(self, file, extension):
+        self._file = file
+        self.extension = extension
+        self.file_type = None
+        self.error = None
+        self._head = b''
+
+    def write(self, data):
+        if self.error is not None:
+            return len(data)
+        if self.file_type is None:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self._decide()
+                if self.error is not None:
+                    return len(data)
+        return self._file.write(data)
+
+    def finish(self):
+        """Decide for parts shorter than SNIFF_BYTES; returns the detected type"""
+        if self.file_type is None and self.error is None:
+            self._decide()
+        if self.error is not None:
+            raise UnsupportedContent(self.error)
+        return self.file_type
+
+    def _decide(self):
+        try:
+            self.file_type = check(self._head, self.extension)
+        except UnsupportedContent as e:
+            self.error = str(e)
+            self._file.truncate(0)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
@@ -0,0 +1,25 @@
+"""
+Piso Print Gunicorn Settings
+Production server for app.py: gunicorn -c gunicorn.conf.py app:app
+
+One worker process, because print queue, caches and event streams live
+in memory; threads serve requests concurrently. Connections are kept
+open between requests, so the ESP32 reuses one TCP connection for its
+/print, /api/check_pages and coin sync calls. Request bodies are read
+as the app consumes them, so uploads still stream into staging. After a
+rejected upload gunicorn discards at most 64 KB of the unread body and
+then closes the connection.
+"""
+
+bind = '0.0.0.0:5000'
+workers = 1  # State is per process: never raise this
+worker_class = 'gthread'
+threads = 16  # Each open /api/events stream holds one; EVENT_STREAM_LIMIT in app.py leaves 6 for API calls
+keepalive = 30  # Seconds an idle connection stays open (ESP32 calls come seconds apart)
+graceful_timeout = 10
+
+
+def post_worker_init(worker):
+    """Start the print scheduler, maintenance etc. once app is imported in the worker"""
+    import app
+    app.start_background_tasks()
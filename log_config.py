@@ -0,0 +1,153 @@
+"""
+Piso Print Logging
+Non-blocking structured logging: request threads only put records on a
+queue, and a background listener formats them as JSON and writes them out
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+try:
+    from flask import g, has_request_context
+except ImportError:
+    g = None
+
+    def has_request_context():
+        return False
+
+# Attributes every LogRecord has; anything else was passed via extra={...}
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach request_id / session_id / trace_id from the Flask request to each record"""
+
+    def filter(self, record):
+        if has_request_context():
+            for key in ('request_id', 'session_id', 'trace_id'):
+                if not hasattr(record, key):
+                    value = g.get(key)
+                    if value:
+                        setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only 1 in N records below WARNING for chosen loggers.
+
+    rates maps logger name -> N; child loggers inherit their parent's rate.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _rate_for(self, name):
+        while name:
+            if name in self.rates:
+                return name, self.rates[name]
+            name = name.rpartition('.')[0]
+        return None, 1
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key, rate = self._rate_for(record.name)
+        if rate <= 1:
+            return True
+
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = itertools.count()
+            return next(counter) % rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message and any structured fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                  + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and value is not None:
+                entry[key] = value
+
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level='INFO', json_output=True, module_levels=None, sample_rates=None,
+                  stream=None):
+    """Route all logging through a queue to a background writer thread.
+
+    module_levels maps logger name -> level, sample_rates maps logger name
+    -> N (keep 1 in N records below WARNING). Returns the QueueListener.
+    """
+    global _listener
+
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if json_output:
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RequestContextFilter())
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    return _listener
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
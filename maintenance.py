@@ -0,0 +1,262 @@
+"""
+Piso Print Maintenance
+Keeps the SQLite database healthy without getting in the kiosk's way:
+WAL checkpoints, planner statistics, incremental vacuum, archiving and
+online backups run on a background thread, and only while the server is
+idle (few requests in the last minute)
+
+Long tasks work in small steps and stop as soon as requests pick up
+again; they continue in the next idle period.
+"""
+
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('pisoprint.maintenance')
+
+
+class MaintenanceInterrupted(Exception):
+    """The server got busy; the task stops and runs again later"""
+
+
+class RequestRateMeter:
+    """Counts requests over a sliding window to tell when the kiosk is idle"""
+
+    def __init__(self, window_seconds=60):
+        self.window_seconds = window_seconds
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def hit(self):
+        now = time.monotonic()
+        with self._lock:
+            self._times.append(now)
+            self._trim(now)
+
+    def count(self):
+        """Requests in the last window_seconds"""
+        with self._lock:
+            self._trim(time.monotonic())
+            return len(self._times)
+
+    def _trim(self, now):
+        while self._times and now - self._times[0] > self.window_seconds:
+            self._times.popleft()
+
+
+class MaintenanceTask:
+    """A job run every interval_seconds; fn(should_stop) does the work"""
+
+    def __init__(self, name, interval_seconds, fn):
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.fn = fn
+        self.last_run = 0          # Unix time of the last completed run
+        self.last_duration_ms = None
+        self.last_status = None
+
+
+class MaintenanceScheduler:
+    """Runs due tasks, in the order they were added, while the server is idle.
+
+    Idle means at most idle_max_requests requests in the meter's window.
+    Completed runs are recorded in the maintenance_runs table, so daily
+    tasks don't repeat after every restart.
+    """
+
+    def __init__(self, get_db, meter, idle_max_requests=5, check_seconds=15):
+        self.get_db = get_db
+        self.meter = meter
+        self.idle_max_requests = idle_max_requests
+        self.check_seconds = check_seconds
+        self.tasks = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, name, interval_seconds, fn):
+        self.tasks.append(MaintenanceTask(name, interval_seconds, fn))
+
+    def is_idle(self):
+        return self.meter.count() <= self.idle_max_requests
+
+    def should_stop(self):
+        """Passed to tasks: raise MaintenanceInterrupted when requests pick up"""
+        if not self.is_idle():
+            raise MaintenanceInterrupted()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._load_last_runs()
+        self._thread = threading.Thread(target=self._loop, name='maintenance', daemon=True)
+        self._thread.start()
+        logger.info("Maintenance scheduler started (%d task(s))", len(self.tasks))
+
+    def run_due(self, force=False):
+        """Run every due task (all of them if force); returns {name: status}"""
+        if not self._lock.acquire(blocking=False):
+            return {}
+        try:
+            results = {}
+            for task in self.tasks:
+                if not force and time.time() - task.last_run < task.interval_seconds:
+                    continue
+                if not force and not self.is_idle():
+                    break
+                results[task.name] = self._run(task, force)
+            return results
+        finally:
+            self._lock.release()
+
+    def status(self):
+        return [{
+            'task': task.name,
+            'interval_seconds': task.interval_seconds,
+            'last_run': task.last_run or None,
+            'last_duration_ms': task.last_duration_ms,
+            'last_status': task.last_status
+        } for task in self.tasks]
+
+    def _loop(self):
+        while True:
+            time.sleep(self.check_seconds)
+            try:
+                self.run_due()
+            except Exception as e:
+                logger.error("Maintenance loop error: %s", e)
+
+    def _run(self, task, force):
+        started = time.perf_counter()
+        should_stop = (lambda: None) if force else self.should_stop
+        try:
+            task.fn(should_stop)
+            status = 'ok'
+        except MaintenanceInterrupted:
+            status = 'interrupted'
+        except Exception as e:
+            logger.error("Maintenance task %s failed: %s", task.name, e)
+            status = 'error'
+
+        task.last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        task.last_status = status
+        if status == 'interrupted':
+            logger.info("Maintenance task %s interrupted (server busy)", task.name)
+            return status
+
+        # Failed tasks also wait a full interval instead of retrying every check
+        task.last_run = time.time()
+        self._save_run(task)
+        logger.info("Maintenance task %s: %s in %.1f ms", task.name, status, task.last_duration_ms)
+        return status
+
+    def _load_last_runs(self):
+        db = self.get_db()
+        try:
+            runs = {row['task']: row['last_run'] for row in db.execute('SELECT task, last_run FROM maintenance_runs')}
+        finally:
+            db.close()
+        for task in self.tasks:
+            task.last_run = runs.get(task.name, 0)
+
+    def _save_run(self, task):
+        db = self.get_db()
+        try:
+            db.execute('''
+                INSERT INTO maintenance_runs (task, last_run, duration_ms, status)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (task) DO UPDATE SET
+                    last_run = excluded.last_run, duration_ms = excluded.duration_ms, status = excluded.status
+            ''', (task.name, int(task.last_run), task.last_duration_ms, task.last_status))
+            db.commit()
+        finally:
+            db.close()
+
+
+# ============================================
+# Tasks
+# ============================================
+def checkpoint(db):
+    """Copy the WAL into the database and truncate it to zero bytes"""
+    busy, wal_pages, moved = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    if busy:
+        logger.info("WAL checkpoint incomplete (%d of %d pages, readers active)", moved, wal_pages)
+    return wal_pages
+
+def refresh_statistics(db, full=False):
+    """Update the query planner's statistics.
+
+    PRAGMA optimize only analyzes tables that need it; full runs ANALYZE
+    with analysis_limit so even big tables take a bounded time.
+    """
+    if full:
+        db.execute('PRAGMA analysis_limit = 1000')
+        db.execute('ANALYZE')
+    else:
+        db.execute('PRAGMA optimize')
+
+def enable_incremental_vacuum(db):
+    """Switch the database to incremental auto-vacuum; True if it was converted.
+
+    Converting takes one full VACUUM, which rewrites the file under the
+    write lock and can't be interrupted, so call this at startup before
+    any request is served. Later calls return False at once.
+    """
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    started = time.monotonic()
+    logger.info("Switching the database to incremental auto-vacuum (one-time VACUUM)...")
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('VACUUM')
+    logger.info("Database switched to incremental auto-vacuum in %.1fs", time.monotonic() - started)
+    return True
+
+def incremental_vacuum(db, should_stop, pages=200):
+    """Return free pages to the file system a few at a time.
+
+    Needs incremental auto-vacuum (see enable_incremental_vacuum); without
+    it this does nothing. Returns the pages freed.
+    """
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+
+    freed = 0
+    while True:
+        free = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if free == 0:
+            return freed
+        should_stop()
+        db.execute(f'PRAGMA incremental_vacuum({pages})').fetchall()
+        freed += min(free, pages)
+
+def backup(db, backup_dir, should_stop, keep=3, pages=64, pause_seconds=0.02):
+    """Online copy of the database with the SQLite backup API.
+
+    Copies `pages` pages per step and pauses in between, so writers get
+    the database between steps. The copy is written to a temp file and
+    renamed into place; the newest `keep` backups are kept.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    final_path = os.path.join(backup_dir, f"pisoprint-{time.strftime('%Y%m%d-%H%M%S')}.db")
+    temp_path = final_path + '.part'
+
+    def progress(status, remaining, total):
+        should_stop()
+
+    target = sqlite3.connect(temp_path)
+    try:
+        db.backup(target, pages=pages, progress=progress, sleep=pause_seconds)
+    except BaseException:
+        target.close()
+        os.remove(temp_path)
+        raise
+    target.close()
+    os.replace(temp_path, final_path)
+
+    for old in sorted(glob.glob(os.path.join(backup_dir, 'pisoprint-*.db')))[:-keep]:
+        os.remove(old)
+    return final_path
@@ -0,0 +1,215 @@
+"""
+Piso Print Metrics
+Lightweight in-process counters and latency histograms, exported in the
+Prometheus text format at /metrics
+"""
+
+import bisect
+import functools
+import sqlite3
+import threading
+import time
+
+# Latency buckets in seconds (upper bounds, +Inf is implicit)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, optionally split by labels"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """Context manager that observes the duration of the block"""
+        return _Timer(self, labels)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+
+        for labels, series in items:
+            cumulative = 0
+            bucket_names = self.labelnames + ('le',)
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(bucket_names, labels + (bound,))} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Registry:
+    """Collection of metrics rendered together at /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+# ============================================
+# Piso Print metrics
+# ============================================
+registry = Registry()
+
+http_requests = registry.counter(
+    'pisoprint_http_requests_total', 'HTTP requests by route and status',
+    ('method', 'route', 'status'))
+http_latency = registry.histogram(
+    'pisoprint_http_request_seconds', 'HTTP request latency by route',
+    ('method', 'route'))
+function_latency = registry.histogram(
+    'pisoprint_function_seconds', 'Latency of hot-path functions',
+    ('function',))
+function_errors = registry.counter(
+    'pisoprint_function_errors_total', 'Exceptions raised by hot-path functions',
+    ('function',))
+db_latency = registry.histogram(
+    'pisoprint_db_query_seconds', 'SQLite statement latency by statement type',
+    ('operation',))
+upload_bytes = registry.counter(
+    'pisoprint_upload_bytes_total', 'Bytes received by upload routes',
+    ('route',))
+cache_lookups = registry.counter(
+    'pisoprint_cache_lookups_total', 'In-memory cache lookups by cache and result (hit/miss)',
+    ('cache', 'result'))
+
+
+def timed(name):
+    """Decorator that records a function's latency in pisoprint_function_seconds"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                function_errors.inc(name)
+                raise
+            finally:
+                function_latency.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+def _operation(sql):
+    """First keyword of a statement (SELECT, INSERT, ...) used as the label"""
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times every statement"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            db_latency.observe(time.perf_counter() - start, _operation(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            db_latency.observe(time.perf_counter() - start, _operation(sql))
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that times statements and commits.
+
+    Use as sqlite3.connect(path, factory=InstrumentedConnection).
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            db_latency.observe(time.perf_counter() - start, 'COMMIT')
@@ -0,0 +1,377 @@
+"""
+Piso Print Job Scheduler
+Holds print jobs in a server-side queue and releases them to CUPS fairly,
+so one large document doesn't block every other kiosk user
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('pisoprint.print_scheduler')
+
+# Scheduling policies
+POLICY_SJF = 'sjf'                  # Shortest job first (with aging)
+POLICY_ROUND_ROBIN = 'round_robin'  # One chunk per session in turn
+POLICIES = (POLICY_SJF, POLICY_ROUND_ROBIN)
+
+
+class PrintJob:
+    """A queued print job, split into page-range chunks"""
+
+    def __init__(self, job_id, session_id, filepath, title, options, selected_pages,
+                 total_pages, pages_per_sheet=1, chunk_pages=0, context=None):
+        self.job_id = job_id
+        self.session_id = session_id
+        self.filepath = filepath
+        self.title = title
+        self.total_pages = total_pages
+        self.context = context  # Caller data passed back to submit_fn (e.g. a trace)
+        self.enqueued_at = time.monotonic()
+        self.submitted = []  # CUPS job IDs of released chunks
+
+        # Page range and copies are handled per chunk, everything else
+        # (duplex, number-up, ...) applies to every chunk unchanged
+        options = dict(options)
+        options.pop('page-ranges', None)
+        options.pop('collate', None)
+        copies = int(options.pop('copies', 1))
+        self.options = options
+
+        self.chunks = deque()
+        chunks = split_pages(selected_pages, chunk_pages, pages_per_sheet)
+        if len(chunks) == 1:
+            # Small job: send it in one go and let CUPS handle the copies
+            if copies > 1:
+                self.options['copies'] = str(copies)
+                self.options['collate'] = 'true'
+            self.chunks.append(chunks[0])
+        else:
+            # Repeat the chunk list per copy so output stays collated
+            for _ in range(copies):
+                self.chunks.extend(chunks)
+
+        self.total_chunks = len(self.chunks)
+
+        # Outcome tracking: pages counted once per printed copy
+        self.copies_per_chunk = int(self.options.get('copies', 1))
+        self.planned_pages = self.remaining_pages * self.copies_per_chunk
+        self.failed_pages = 0
+        self.pending_cups_jobs = {}  # CUPS job ID -> pages, until CUPS reports a final state
+
+    @property
+    def remaining_pages(self):
+        """Pages still waiting to be released to the printer"""
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def chunk_options(self, chunk):
+        """CUPS options for one chunk"""
+        options = dict(self.options)
+        if len(chunk) < self.total_pages:
+            options['page-ranges'] = format_page_ranges(chunk)
+        return options
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'session_id': self.session_id,
+            'remaining_pages': self.remaining_pages,
+            'chunks_done': self.total_chunks - len(self.chunks),
+            'chunks_total': self.total_chunks,
+            'waiting_seconds': round(time.monotonic() - self.enqueued_at, 1)
+        }
+
+
+def split_pages(pages, chunk_pages, pages_per_sheet=1):
+    """Split a list of page numbers into chunks of about chunk_pages pages.
+
+    Chunks are aligned to whole sheets (number-up x sides) so splitting a
+    job never wastes paper.
+    """
+    if not chunk_pages or len(pages) <= chunk_pages:
+        return [list(pages)]
+
+    # Round the chunk size up to a whole number of sheets
+    size = -(-chunk_pages // pages_per_sheet) * pages_per_sheet
+    return [list(pages[i:i + size]) for i in range(0, len(pages), size)]
+
+
+def format_page_ranges(pages):
+    """Format a sorted list of page numbers as a compact CUPS page-ranges value"""
+    ranges = []
+    start = prev = pages[0]
+
+    for page in list(pages[1:]) + [None]:
+        if page is not None and page == prev + 1:
+            prev = page
+            continue
+        ranges.append(f"{start}-{prev}" if start != prev else str(start))
+        if page is not None:
+            start = prev = page
+
+    return ','.join(ranges)
+
+
+class PrintScheduler:
+    """Releases queued print jobs to the printer one chunk at a time.
+
+    submit_fn(job, options) sends a chunk to the printer and returns the
+    CUPS job ID. busy_fn(cups_job_ids) returns how many of the given CUPS
+    jobs are still pending; a chunk is released only when fewer than
+    max_active are. on_state_change(job, state) is called with 'printing',
+    'submitted' or 'failed'.
+
+    job_state_fn(cups_job_id) returns 'pending', 'completed', 'canceled' or
+    'aborted'. With it, released jobs are watched until CUPS finishes them.
+    on_finished(job, printed_pages, planned_pages) is called exactly once
+    per job when its outcome is known (pages that failed to submit, or that
+    CUPS canceled or aborted, don't count as printed).
+    """
+
+    def __init__(self, submit_fn, busy_fn=None, on_state_change=None,
+                 policy=POLICY_SJF, chunk_pages=20, aging_seconds=30,
+                 max_active=1, poll_interval=2.0, job_state_fn=None, on_finished=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+
+        self.submit_fn = submit_fn
+        self.busy_fn = busy_fn
+        self.on_state_change = on_state_change
+        self.policy = policy
+        self.chunk_pages = chunk_pages
+        self.aging_seconds = aging_seconds
+        self.max_active = max_active
+        self.poll_interval = poll_interval
+        self.job_state_fn = job_state_fn
+        self.on_finished = on_finished
+
+        self._jobs = []          # Queued jobs in arrival order
+        self._watching = []      # Released jobs waiting for CUPS to finish them
+        self._last_poll = 0.0
+        self._sessions = deque() # Round-robin order of session IDs
+        self._active = []        # CUPS job IDs released but not finished
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    # --------------------------------------------
+    # Public API
+    # --------------------------------------------
+    def start(self):
+        """Start the dispatcher thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='print-scheduler', daemon=True)
+        self._thread.start()
+        logger.info("Print scheduler started (policy=%s, chunk=%d pages)", self.policy, self.chunk_pages)
+
+    def stop(self):
+        """Stop the dispatcher thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def enqueue(self, job_id, session_id, filepath, title, options, selected_pages,
+                total_pages, pages_per_sheet=1, context=None, chunk_pages=None):
+        """Queue a job and return its position in the queue (1 = next).
+
+        chunk_pages overrides the scheduler default; 0 sends the job in one
+        piece (e.g. raw printer-ready files, which can't take page-ranges).
+        """
+        if chunk_pages is None:
+            chunk_pages = self.chunk_pages
+        job = PrintJob(job_id, session_id, filepath, title, options, selected_pages,
+                       total_pages, pages_per_sheet, chunk_pages, context)
+
+        with self._cond:
+            self._jobs.append(job)
+            if session_id not in self._sessions:
+                self._sessions.append(session_id)
+            position = self._position(job)
+            self._cond.notify_all()
+
+        logger.info("Queued print job %s: %d page(s) in %d chunk(s), position %d",
+                    job_id, job.remaining_pages, job.total_chunks, position)
+        return position
+
+    def snapshot(self):
+        """Current queue contents, in the order they would be released"""
+        with self._cond:
+            ordered = sorted(self._jobs, key=self._sort_key)
+            return [job.to_dict() for job in ordered]
+
+    def __len__(self):
+        with self._cond:
+            return len(self._jobs)
+
+    # --------------------------------------------
+    # Policy
+    # --------------------------------------------
+    def _sort_key(self, job):
+        if self.policy == POLICY_ROUND_ROBIN:
+            order = list(self._sessions)
+            index = order.index(job.session_id) if job.session_id in order else len(order)
+            return (index, job.enqueued_at)
+
+        # Shortest remaining work first; waiting time lowers the key so
+        # large jobs can't starve
+        waited = time.monotonic() - job.enqueued_at
+        return (job.remaining_pages - waited / self.aging_seconds, job.enqueued_at)
+
+    def _position(self, job):
+        return sorted(self._jobs, key=self._sort_key).index(job) + 1
+
+    def _next_job(self):
+        """Pick the job whose next chunk should be released"""
+        if not self._jobs:
+            return None
+
+        job = min(self._jobs, key=self._sort_key)
+        if self.policy == POLICY_ROUND_ROBIN:
+            # Move this session to the back of the rotation
+            self._sessions.remove(job.session_id)
+            self._sessions.append(job.session_id)
+        return job
+
+    def _finish(self, job):
+        self._jobs.remove(job)
+        if not any(j.session_id == job.session_id for j in self._jobs):
+            if job.session_id in self._sessions:
+                self._sessions.remove(job.session_id)
+
+    # --------------------------------------------
+    # Dispatcher
+    # --------------------------------------------
+    def _printer_busy(self):
+        if not self.busy_fn or not self._active:
+            self._active = []
+            return False
+        try:
+            pending = self.busy_fn(list(self._active))
+        except Exception as e:
+            logger.error("Scheduler busy check failed: %s", e)
+            return False
+        if pending == 0:
+            self._active = []
+        return pending >= self.max_active
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._jobs and not self._watching:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                have_jobs = bool(self._jobs)
+
+            self._poll_watched()
+
+            if not have_jobs:
+                # Only watching: wake up for the next poll or a new job
+                with self._cond:
+                    if not self._jobs:
+                        self._cond.wait(self.poll_interval)
+                continue
+
+            if self._printer_busy():
+                time.sleep(self.poll_interval)
+                continue
+
+            with self._cond:
+                job = self._next_job()
+                if job is None:
+                    continue
+                chunk = job.chunks.popleft()
+                first_chunk = len(job.chunks) == job.total_chunks - 1
+                last_chunk = not job.chunks
+                if last_chunk:
+                    self._finish(job)
+
+            self._release(job, chunk, first_chunk, last_chunk)
+
+    def _release(self, job, chunk, first_chunk, last_chunk):
+        """Send one chunk to the printer"""
+        try:
+            if first_chunk and self.on_state_change:
+                self.on_state_change(job, 'printing')
+
+            cups_job_id = self.submit_fn(job, job.chunk_options(chunk))
+            job.submitted.append(cups_job_id)
+            if cups_job_id:
+                self._active.append(cups_job_id)
+                if self.job_state_fn:
+                    job.pending_cups_jobs[cups_job_id] = len(chunk) * job.copies_per_chunk
+
+            logger.info("Released job %s chunk %d/%d (%d pages) as CUPS job %s",
+                        job.job_id, job.total_chunks - len(job.chunks), job.total_chunks,
+                        len(chunk), cups_job_id)
+
+            if last_chunk:
+                if self.on_state_change:
+                    self.on_state_change(job, 'submitted')
+                self._watch_or_complete(job)
+
+        except Exception as e:
+            logger.error("Print job %s failed: %s", job.job_id, e)
+            with self._cond:
+                if job in self._jobs:
+                    self._finish(job)
+            job.failed_pages += (len(chunk) + job.remaining_pages) * job.copies_per_chunk
+            job.chunks.clear()
+            if self.on_state_change:
+                self.on_state_change(job, 'failed')
+            self._watch_or_complete(job)
+
+    # --------------------------------------------
+    # Job outcome
+    # --------------------------------------------
+    def _watch_or_complete(self, job):
+        """Wait for CUPS to finish a fully released job, or report it now"""
+        if job.pending_cups_jobs:
+            with self._cond:
+                self._watching.append(job)
+                self._cond.notify_all()
+        else:
+            self._complete(job)
+
+    def _poll_watched(self):
+        """Ask CUPS about released jobs at most once per poll_interval"""
+        if not self._watching or time.monotonic() - self._last_poll < self.poll_interval:
+            return
+        self._last_poll = time.monotonic()
+
+        with self._cond:
+            watching = list(self._watching)
+
+        for job in watching:
+            for cups_job_id, pages in list(job.pending_cups_jobs.items()):
+                try:
+                    state = self.job_state_fn(cups_job_id)
+                except Exception as e:
+                    logger.error("Job state check for CUPS job %s failed: %s", cups_job_id, e)
+                    continue
+                if state == 'pending':
+                    continue
+                del job.pending_cups_jobs[cups_job_id]
+                if state != 'completed':
+                    logger.warning("CUPS job %s (print job %s) was %s", cups_job_id, job.job_id, state)
+                    job.failed_pages += pages
+
+            if not job.pending_cups_jobs:
+                with self._cond:
+                    self._watching.remove(job)
+                self._complete(job)
+
+    def _complete(self, job):
+        printed = job.planned_pages - job.failed_pages
+        logger.info("Print job %s finished: %d of %d page(s) printed",
+                    job.job_id, printed, job.planned_pages)
+        if self.on_finished:
+            try:
+                self.on_finished(job, printed, job.planned_pages)
+            except Exception as e:
+                logger.error("Finishing print job %s failed: %s", job.job_id, e)
@@ -0,0 +1,138 @@
+"""
+Piso Print Reports
+Revenue and usage per hour, day and month, answered from the
+usage_rollups table (see db.init_rollups) instead of scanning print_jobs
+
+Triggers keep the rollups current as jobs and transactions are inserted.
+Rows that existed before the triggers were created are added by
+RollupBackfill in small batches on a background thread, so upgrading a
+busy kiosk never stalls coin or print writes.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from db import ROLLUP_BUCKETS, ROLLUP_SOURCES, rollup_upsert_sql
+
+logger = logging.getLogger('pisoprint.reports')
+
+
+class RollupBackfill:
+    """Adds pre-existing print_jobs/transactions rows to usage_rollups.
+
+    Progress is stored in rollup_state, so a restart continues where the
+    last run stopped and no row is counted twice.
+    """
+
+    def __init__(self, get_db, batch_size=2000, pause_seconds=0.05):
+        self.get_db = get_db
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+        self._thread = None
+
+    def start(self):
+        """Run the backfill on a background thread (no-op if nothing is left)"""
+        if self._thread is not None or self.remaining() == 0:
+            return
+        self._thread = threading.Thread(target=self.run, name='rollup-backfill', daemon=True)
+        self._thread.start()
+
+    def remaining(self):
+        """Rows still to be backfilled across all sources"""
+        db = self.get_db()
+        try:
+            total = 0
+            for table in ROLLUP_SOURCES:
+                done, until = self._progress(db, table)
+                total += max(0, until - done)
+            return total
+        finally:
+            db.close()
+
+    def run(self):
+        for table in ROLLUP_SOURCES:
+            span = 0
+            while True:
+                covered = self.run_batch(table)
+                if covered is None:
+                    break
+                span += covered
+                time.sleep(self.pause_seconds)  # Let kiosk writes in between batches
+            if span:
+                logger.info("Backfilled rollups from %s (%d IDs)", table, span)
+
+    def run_batch(self, table):
+        """Backfill the next batch of IDs; returns the ID span covered, or None when done"""
+        db = self.get_db()
+        try:
+            done, until = self._progress(db, table)
+            if done >= until:
+                return None
+            end = min(done + self.batch_size, until)
+            db.execute(rollup_upsert_sql(table, backfill=True), {'start': done, 'end': end})
+            db.execute('UPDATE rollup_state SET value = ? WHERE name = ?', (end, f'{table}_backfilled'))
+            db.commit()
+            return end - done
+        finally:
+            db.close()
+
+    @staticmethod
+    def _progress(db, table):
+        state = dict(db.execute('SELECT name, value FROM rollup_state WHERE name IN (?, ?)',
+                                (f'{table}_backfilled', f'{table}_backfill_until')).fetchall())
+        return state.get(f'{table}_backfilled', 0), state.get(f'{table}_backfill_until', 0)
+
+
+def parse_report_range(period, start=None, end=None, default_days=30):
+    """Validate a report request; returns (start, end) as bucket prefixes.
+
+    start/end are dates (YYYY-MM-DD) or months (YYYY-MM), both inclusive.
+    Raises ValueError for an unknown period or malformed date.
+    """
+    if period not in ROLLUP_BUCKETS:
+        raise ValueError(f"period must be one of {', '.join(ROLLUP_BUCKETS)}")
+
+    for value in (start, end):
+        if value is not None:
+            datetime.strptime(value, '%Y-%m-%d' if len(value) > 7 else '%Y-%m')
+
+    today = datetime.now().date()
+    end = end or today.isoformat()
+    start = start or (today - timedelta(days=default_days - 1)).isoformat()
+    if start > end:
+        raise ValueError('start must not be after end')
+    return start, end
+
+
+def query_usage(db, period, start, end):
+    """Rollup rows for period with bucket in [start, end], oldest first.
+
+    end + '~' makes the end inclusive: '2026-10-31 23:00' and '2026-10-31'
+    both sort before '2026-10-31~'. Buckets without activity are absent.
+    """
+    if period == 'month':
+        start = start[:7]  # '2026-10-05' would sort after the '2026-10' bucket
+    rows = db.execute('''
+        SELECT bucket, jobs, pages, revenue, refunds, revenue - refunds AS net_revenue, coins
+        FROM usage_rollups
+        WHERE period = ? AND bucket >= ? AND bucket <= ?
+        ORDER BY bucket
+    ''', (period, start, end + '~')).fetchall()
+    return [dict(row) for row in rows]
+
+
+def peak_hours(db, start, end):
+    """Jobs, pages and revenue by hour of day (0-23) between two dates"""
+    rows = db.execute('''
+        SELECT CAST(substr(bucket, 12, 2) AS INTEGER) AS hour,
+               SUM(jobs) AS jobs, SUM(pages) AS pages, SUM(revenue - refunds) AS net_revenue
+        FROM usage_rollups
+        WHERE period = 'hour' AND bucket >= ? AND bucket <= ?
+        GROUP BY hour
+        ORDER BY hour
+    ''', (start, end + '~')).fetchall()
+    by_hour = {row['hour']: dict(row) for row in rows}
+    return [by_hour.get(hour, {'hour': hour, 'jobs': 0, 'pages': 0, 'net_revenue': 0})
+            for hour in range(24)]
@@ -0,0 +1,119 @@
+"""
+Piso Print Session Cache
+Keeps recently used user rows (session, credits) in memory so credit checks
+don't query SQLite on every ESP32 poll
+
+The cache is read-through and write-through: every credit change is still
+committed to SQLite (and logged in transactions) before the cached row is
+updated, so a power cut can never lose a coin. Only reads are served from
+memory.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """Thread-safe LRU cache of user rows with a time-to-live.
+
+    Loads are guarded against races with writers: take a token with
+    begin_load() before reading the database, and put() drops the row if
+    the session was written in the meantime.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=60, on_lookup=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.on_lookup = on_lookup  # Called with 'hit' or 'miss' (metrics)
+
+        self._entries = OrderedDict()  # session_id -> (expires_at, row)
+        self._writes = OrderedDict()   # session_id -> (write number, time) of recent writes
+        self._write_number = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Cached copy of the user row, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(session_id)
+                row = dict(entry[1])
+            else:
+                if entry:
+                    del self._entries[session_id]
+                row = None
+
+        if self.on_lookup:
+            self.on_lookup('hit' if row is not None else 'miss')
+        return row
+
+    def begin_load(self):
+        """Token to pass to put() after reading a row from the database"""
+        with self._lock:
+            return self._write_number
+
+    def put(self, session_id, row, token):
+        """Cache a row read from the database, unless it was written since token"""
+        with self._lock:
+            last_write = self._writes.get(session_id)
+            if last_write and last_write[0] > token:
+                return False
+            self._store(session_id, dict(row))
+            return True
+
+    def update(self, session_id, token, **fields):
+        """Apply a committed write to the cached row.
+
+        token comes from begin_load() before the write transaction started.
+        If another write to the same session happened since, the cached row
+        is dropped instead (the next read reloads it).
+        """
+        with self._lock:
+            last_write = self._writes.get(session_id)
+            stale = last_write is not None and last_write[0] > token
+            self._record_write(session_id)
+
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            if stale:
+                del self._entries[session_id]
+                return
+            row = dict(entry[1])
+            row.update(fields)
+            self._store(session_id, row)
+
+    def invalidate(self, session_id=None):
+        """Drop one session (or everything) from the cache"""
+        with self._lock:
+            if session_id is None:
+                self._entries.clear()
+                self._write_number += 1
+                return
+            self._entries.pop(session_id, None)
+            self._record_write(session_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _store(self, session_id, row):
+        self._entries[session_id] = (time.monotonic() + self.ttl_seconds, row)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _record_write(self, session_id):
+        now = time.monotonic()
+        self._write_number += 1
+        self._writes.pop(session_id, None)
+        self._writes[session_id] = (self._write_number, now)
+
+        # Loads take milliseconds, so old write records can't matter any more
+        while self._writes:
+            oldest = next(iter(self._writes.values()))
+            if now - oldest[1] < self.ttl_seconds:
+                break
+            self._writes.popitem(last=False)
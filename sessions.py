@@ -0,0 +1,210 @@
+"""
+Piso Print Sessions
+Lifecycle of the rows in the users table (one per customer session)
+
+Reads never create rows: a balance check or print request for an unknown
+session just sees zero credits. Rows are created explicitly (POST
+/api/session) or by the writes that need one (an upload or a coin).
+Sessions left idle with a zero balance are purged in small batches by
+the maintenance scheduler, so the table doesn't grow with every phone
+that ever connected.
+
+last_activity is not written per request: ActivityTracker collects
+touches in memory and writes them in one transaction every few seconds
+(each small commit rewrites whole flash pages on the SD card).
+"""
+
+import logging
+import re
+import secrets
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('pisoprint.sessions')
+
+# IDs clients may choose themselves (the ESP32 firmware falls back to its own)
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def new_session_id():
+    """Random session ID (64 bits), unique without coordination"""
+    return f'S{secrets.token_hex(8)}'
+
+
+class ActivityTracker:
+    """Batches users.last_activity updates.
+
+    touch() only records the time in memory; flush() writes every pending
+    touch with one executemany and one commit. Call stop() at shutdown so
+    the last few seconds aren't lost.
+    """
+
+    def __init__(self, get_db, flush_seconds=5):
+        self.get_db = get_db
+        self.flush_seconds = flush_seconds
+        self._pending = {}  # session_id -> 'YYYY-MM-DD HH:MM:SS' (UTC, like CURRENT_TIMESTAMP)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def touch(self, session_id):
+        if not session_id:
+            return
+        now = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self._lock:
+            self._pending[session_id] = now
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write pending touches; returns how many sessions were updated"""
+        with self._lock:
+            touches, self._pending = self._pending, {}
+        if not touches:
+            return 0
+
+        try:
+            db = self.get_db()
+            try:
+                db.executemany('UPDATE users SET last_activity = ? WHERE session_id = ?',
+                               [(when, session_id) for session_id, when in touches.items()])
+                db.commit()
+            finally:
+                db.close()
+        except Exception:
+            # Keep them for the next flush (newer touches win)
+            with self._lock:
+                for session_id, when in touches.items():
+                    self._pending.setdefault(session_id, when)
+            raise
+        return len(touches)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='activity-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread and write what's left"""
+        self._stopped.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("Final activity flush failed: %s", e)
+
+    def _loop(self):
+        while not self._stopped.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Activity flush failed: %s", e)
+
+
+class SessionStore:
+    """Looks up, creates and expires user rows through the session cache.
+
+    Credit changes still go straight to SQLite in app.py; they call
+    ensure() inside their own transaction so the row exists first.
+    """
+
+    def __init__(self, get_db, cache, activity):
+        self.get_db = get_db
+        self.cache = cache
+        self.activity = activity
+
+    def get(self, session_id):
+        """User row for session_id, or None if there is none (never inserts)"""
+        user = self.cache.get(session_id)
+        if user is not None:
+            return user
+
+        token = self.cache.begin_load()
+        db = self.get_db()
+        try:
+            user = db.execute('SELECT * FROM users WHERE session_id = ?', (session_id,)).fetchone()
+        finally:
+            db.close()
+        if user is None:
+            return None
+
+        user = dict(user)
+        self.cache.put(session_id, user, token)
+        return user
+
+    def create(self, session_id=None, attempts=3):
+        """Create a session; returns (user row, created).
+
+        Without session_id a new random ID is generated. A requested ID
+        that already exists is returned as is (created is False).
+        """
+        db = self.get_db()
+        try:
+            if session_id is None:
+                for _ in range(attempts):
+                    session_id = new_session_id()
+                    try:
+                        db.execute('INSERT INTO users (session_id, credits) VALUES (?, 0)', (session_id,))
+                        break
+                    except sqlite3.IntegrityError:
+                        continue  # Taken (practically never happens); draw again
+                else:
+                    raise RuntimeError('Could not generate a unique session ID')
+                created = True
+            else:
+                created = db.execute('INSERT OR IGNORE INTO users (session_id, credits) VALUES (?, 0)',
+                                     (session_id,)).rowcount == 1
+            db.commit()
+            user = dict(db.execute('SELECT * FROM users WHERE session_id = ?', (session_id,)).fetchone())
+        finally:
+            db.close()
+
+        if created:
+            logger.debug("Created session %s", session_id)
+        return user, created
+
+    def ensure(self, db, session_id):
+        """Insert the row if missing (in the caller's transaction) and mark it active"""
+        db.execute('INSERT OR IGNORE INTO users (session_id, credits) VALUES (?, 0)', (session_id,))
+        self.activity.touch(session_id)
+
+    def purge_idle(self, idle_seconds, batch_size=500, should_stop=None):
+        """Delete zero-balance sessions idle for idle_seconds; returns rows deleted.
+
+        Each batch is its own short transaction. Sessions holding a credit
+        reservation stay: a cancelled job may still refund them.
+        should_stop() is checked between batches and may raise.
+        """
+        self.activity.flush()  # Recent touches must count before judging idleness
+        purged = 0
+        while True:
+            if should_stop:
+                should_stop()
+            db = self.get_db()
+            try:
+                session_ids = [row[0] for row in db.execute('''
+                    DELETE FROM users WHERE id IN (
+                        SELECT id FROM users
+                        WHERE credits = 0 AND last_activity < datetime('now', ?)
+                          AND session_id NOT IN
+                              (SELECT session_id FROM credit_reservations WHERE status = 'reserved')
+                        LIMIT ?
+                    )
+                    RETURNING session_id
+                ''', (f'-{int(idle_seconds)} seconds', batch_size)).fetchall()]
+                db.commit()
+            finally:
+                db.close()
+
+            for session_id in session_ids:
+                self.cache.invalidate(session_id)
+            purged += len(session_ids)
+            if len(session_ids) < batch_size:
+                break
+
+        if purged:
+            logger.info("Purged %d idle session(s)", purged)
+        return purged
@@ -57,6 +57,7 @@ pip install PyPDF2==3.0.1
 pip install python-docx==1.1.0
 pip install Pillow==10.1.0
 pip install Werkzeug==3.0.1
+pip install gunicorn==26.2.0
 
 echo ""
 echo "Step 8: Configuring CUPS..."
@@ -94,7 +95,7 @@ Type=simple
 User=root
 WorkingDirectory=/home/pisoprint
 Environment="PATH=/home/pisoprint/venv/bin"
-ExecStart=/home/pisoprint/venv/bin/python /home/pisoprint/app.py
+ExecStart=/home/pisoprint/venv/bin/gunicorn -c /home/pisoprint/gunicorn.conf.py app:app
 Restart=always
 RestartSec=10
 
@@ -111,7 +112,9 @@ echo -e "${GREEN}✅ Installation Complete!${NC}"
 echo "============================================"
 echo ""
 echo "Next steps:"
-echo "1. Copy app.py to /home/pisoprint/"
+echo "1. Copy all server files to /home/pisoprint/:"
+echo "   app.py admin.py archive.py artifacts.py credits.py db.py events.py filetypes.py log_config.py maintenance.py metrics.py print_scheduler.py reports.py session_cache.py sessions.py storage.py tracing.py"
+echo "   gunicorn.conf.py requirements.txt"
 echo "2. Connect your USB printer"
 echo "3. Add printer via CUPS web interface:"
 echo "   http://$(hostname -I | awk '{print $1}'):631"
@@ -0,0 +1,294 @@
+"""
+PisoPrint Upload Storage
+Stores uploaded files under collision-free IDs in hashed shard directories
+
+Every file is written to a hidden temp name in the storage root and then
+renamed into place with os.replace(), so a reader never sees a partial file
+and two uploads can never overwrite each other. Files live at
+
+    <root>/<id[0:2]>/<id[2:4]>/<id>.<ext>
+
+which keeps every directory small. The files table in SQLite is the index:
+lookup, cleanup and disk accounting go through it, never through a full
+directory listing.
+
+With a staging root on tmpfs, new uploads and everything derived from them
+(converted PDFs, pre-rendered artifacts) are kept in RAM under the same
+layout, up to a byte budget. Only files that get printed or are kept past
+the staging age are persisted to the SD card; failed or abandoned uploads
+never touch it. Uploads that don't fit the budget go to disk directly, or
+move there mid-stream once the budget runs out.
+"""
+
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('pisoprint.storage')
+
+TEMP_PREFIX = '.upload_'
+TEMP_SUFFIX = '.part'
+STAGING_STEP = 1024 * 1024  # Budget claimed at a time by uploads of unknown size
+
+
+class FileStore:
+    """Sharded, atomic file storage rooted at one directory.
+
+    staging_root/staging_budget enable the RAM tier (see module docstring);
+    paths returned for staged files live under staging_root.
+    """
+
+    def __init__(self, root, shard_levels=2, shard_width=2, staging_root=None, staging_budget=0):
+        self.root = root
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        os.makedirs(root, exist_ok=True)
+
+        self.staging_root = staging_root if staging_root and staging_budget > 0 else None
+        self.staging_budget = staging_budget
+        self._reserved = 0  # Budget claimed by uploads still being written
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        if self.staging_root:
+            try:
+                os.makedirs(self.staging_root, exist_ok=True)
+            except OSError as e:
+                logger.warning("Staging disabled, cannot create %s: %s", self.staging_root, e)
+                self.staging_root = None
+
+    @staticmethod
+    def new_id():
+        """Random 128-bit ID as 32 hex characters"""
+        return uuid.uuid4().hex
+
+    def shard_dir(self, storage_id, staged=False):
+        """Directory a file with this ID is stored in"""
+        parts = [storage_id[i * self.shard_width:(i + 1) * self.shard_width]
+                 for i in range(self.shard_levels)]
+        return os.path.join(self.staging_root if staged else self.root, *parts)
+
+    def path_for(self, storage_id, extension, staged=False):
+        """Final path of a stored file"""
+        name = f'{storage_id}.{extension}' if extension else storage_id
+        return os.path.join(self.shard_dir(storage_id, staged), name)
+
+    def is_staged(self, path):
+        """True if path is in the RAM staging tier"""
+        return bool(self.staging_root and path
+                    and os.path.abspath(path).startswith(os.path.abspath(self.staging_root) + os.sep))
+
+    def temp_file(self, staged=False):
+        """Open a hidden temp file on the same filesystem as the store (or the staging tier)"""
+        return tempfile.NamedTemporaryFile(
+            dir=self.staging_root if staged else self.root, prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX,
+            delete=False)
+
+    def commit(self, temp_path, extension):
+        """Atomically move a finished temp file into the store.
+
+        Returns (storage_id, path), in the tier the temp file is in. Files
+        on disk are fsynced before the rename so a power cut leaves either
+        the whole file or no file.
+        """
+        staged = self.is_staged(temp_path)
+        storage_id = self.new_id()
+        path = self.path_for(storage_id, extension, staged)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if not staged:
+            fd = os.open(temp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        os.replace(temp_path, path)
+        return storage_id, path
+
+    def write_stream(self, read, extension, chunk_size=8192, progress=None, size_hint=None):
+        """Copy a readable stream into the store. Returns (storage_id, path, size).
+
+        progress(bytes_so_far) is called after every chunk if given. The
+        file is staged in RAM while the budget allows (size_hint, e.g. the
+        Content-Length, is claimed up front) and moved to disk mid-stream
+        if it outgrows it.
+        """
+        size = 0
+        reserved = size_hint or STAGING_STEP
+        if not self.reserve_staging(reserved):
+            reserved = 0
+        temp = self.temp_file(staged=bool(reserved))
+        try:
+            while True:
+                chunk = read(chunk_size)
+                if not chunk:
+                    break
+                if reserved and size + len(chunk) > reserved:
+                    if self.reserve_staging(STAGING_STEP):
+                        reserved += STAGING_STEP
+                    else:
+                        temp = self._spill(temp)
+                        self.release_staging(reserved)
+                        reserved = 0
+                temp.write(chunk)
+                size += len(chunk)
+                if progress:
+                    progress(size)
+            temp.close()
+            storage_id, path = self.commit(temp.name, extension)
+        except BaseException:
+            temp.close()
+            self.discard(temp.name)
+            raise
+        finally:
+            self.release_staging(reserved)
+        return storage_id, path, size
+
+    # ============================================
+    # RAM staging tier
+    # ============================================
+    def staged_bytes(self):
+        """Bytes held by finished files in the staging tier.
+
+        Walks the staging root: it is on tmpfs and small (bounded by the
+        budget), unlike the SD store, which is never listed. Uploads still
+        being written are counted through their reservations instead.
+        """
+        total = 0
+        if not self.staging_root:
+            return total
+        for directory, _, names in os.walk(self.staging_root):
+            for name in names:
+                if name.startswith(TEMP_PREFIX):
+                    continue
+                try:
+                    total += os.path.getsize(os.path.join(directory, name))
+                except OSError:
+                    pass  # Deleted or persisted meanwhile
+        return total
+
+    def reserve_staging(self, amount):
+        """Claim amount bytes of the staging budget; False if they don't fit"""
+        if not self.staging_root:
+            return False
+        with self._lock:
+            if self.staged_bytes() + self._reserved + amount > self.staging_budget:
+                return False
+            self._reserved += amount
+            return True
+
+    def release_staging(self, amount):
+        """Return budget claimed with reserve_staging()"""
+        if amount:
+            with self._lock:
+                self._reserved -= amount
+
+    def persist(self, path):
+        """Move a staged file and its derived files (same ID) to the SD store.
+
+        Returns the path of `path` in the store; paths already on disk are
+        returned unchanged. Safe to call again for a file that another
+        thread has just persisted.
+        """
+        if not self.is_staged(path):
+            return path
+        relative = os.path.relpath(path, self.staging_root)
+        target = os.path.join(self.root, relative)
+
+        with self._persist_lock:
+            stem = os.path.splitext(path)[0]
+            for staged in glob.glob(glob.escape(stem) + '.*'):
+                if staged.endswith(TEMP_SUFFIX):
+                    continue  # Still being written (e.g. an artifact render)
+                destination = os.path.join(self.root, os.path.relpath(staged, self.staging_root))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                temp = self.temp_file()
+                try:
+                    with temp, open(staged, 'rb') as source:
+                        shutil.copyfileobj(source, temp, 1024 * 1024)
+                        temp.flush()
+                        os.fsync(temp.fileno())
+                    os.replace(temp.name, destination)
+                except BaseException:
+                    self.discard(temp.name)
+                    raise
+                os.remove(staged)
+            self._prune_staging_dirs(path)
+        return target
+
+    def _prune_staging_dirs(self, path):
+        """Remove the now-empty ab/cd/ shard directories of a staged path"""
+        directory = os.path.dirname(os.path.abspath(path))
+        root = os.path.abspath(self.staging_root)
+        while directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return  # Not empty (or already gone)
+            directory = os.path.dirname(directory)
+
+    def _spill(self, staged_temp):
+        """Continue a staged upload on disk: copy what was written so far"""
+        disk_temp = self.temp_file()
+        try:
+            staged_temp.flush()
+            staged_temp.seek(0)
+            shutil.copyfileobj(staged_temp, disk_temp, 1024 * 1024)
+        except BaseException:
+            disk_temp.close()
+            self.discard(disk_temp.name)
+            raise
+        staged_temp.close()
+        self.discard(staged_temp.name)
+        logger.info("Staging budget exhausted, upload continues on disk")
+        return disk_temp
+
+    def delete(self, path):
+        """Delete a stored file and anything derived from it (e.g. <id>.pdf)"""
+        removed = 0
+        if not path:
+            return removed
+
+        stem = os.path.splitext(path)[0]
+        for candidate in set(glob.glob(glob.escape(stem) + '.*')) | {path}:
+            try:
+                os.remove(candidate)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not delete %s: %s", candidate, e)
+        if self.is_staged(path):
+            self._prune_staging_dirs(path)
+        return removed
+
+    @staticmethod
+    def discard(temp_path):
+        """Remove a temp file that was never committed"""
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Could not remove temp file %s: %s", temp_path, e)
+
+    def sweep_temp_files(self, max_age_seconds=3600):
+        """Remove temp files left behind by a crash (only the roots are scanned)"""
+        removed = 0
+        for root in filter(None, (self.root, self.staging_root)):
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if not (entry.name.startswith(TEMP_PREFIX) and entry.name.endswith(TEMP_SUFFIX)):
+                        continue
+                    try:
+                        if entry.stat().st_mtime < time.time() - max_age_seconds:
+                            os.remove(entry.path)
+                            removed += 1
+                    except OSError:
+                        pass
+        return removed
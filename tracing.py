@@ -0,0 +1,154 @@
+"""
+Piso Print Tracing
+Per-upload and per-print traces with timings for each pipeline stage,
+kept in an in-memory ring buffer for the /api/traces endpoint
+"""
+
+import contextvars
+import threading
+import time
+import uuid
+from collections import deque
+
+_current_trace = contextvars.ContextVar('pisoprint_trace', default=None)
+
+
+class Trace:
+    """One upload or print request and the stages it went through"""
+
+    def __init__(self, name, attrs=None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = dict(attrs or {})
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = []  # (stage, offset_ms, duration_ms)
+        self.duration_ms = None
+        self.status = 'running'
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'status': self.status,
+            'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at)),
+            'duration_ms': round(self.duration_ms if self.duration_ms is not None else self.elapsed_ms(), 1),
+            'attrs': self.attrs,
+            'spans': [
+                {'stage': stage, 'offset_ms': round(offset, 1), 'duration_ms': round(duration, 1)}
+                for stage, offset, duration in self.spans
+            ]
+        }
+
+
+class _Span:
+    __slots__ = ('tracer', 'trace', 'stage', 'start')
+
+    def __init__(self, tracer, trace, stage):
+        self.tracer = tracer
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            end = time.perf_counter()
+            self.tracer.record(self.trace, self.stage,
+                               (self.start - self.trace._start) * 1000,
+                               (end - self.start) * 1000)
+        return False
+
+
+class Tracer:
+    """Keeps the last max_traces traces and recent durations per stage"""
+
+    def __init__(self, max_traces=500, samples_per_stage=1000):
+        self._traces = deque(maxlen=max_traces)
+        self._samples_per_stage = samples_per_stage
+        self._stages = {}  # (trace name, stage) -> deque of durations in ms
+        self._lock = threading.Lock()
+
+    # --------------------------------------------
+    # Recording
+    # --------------------------------------------
+    def start_trace(self, name, **attrs):
+        """Start a trace and make it current for this request"""
+        trace = Trace(name, attrs)
+        _current_trace.set(trace)
+        with self._lock:
+            self._traces.append(trace)
+        return trace
+
+    def current(self):
+        return _current_trace.get()
+
+    def span(self, stage, trace=None):
+        """Context manager timing one stage of the current (or given) trace"""
+        return _Span(self, trace or _current_trace.get(), stage)
+
+    def record(self, trace, stage, offset_ms, duration_ms):
+        """Add a finished stage to a trace (may happen after finish())"""
+        with self._lock:
+            trace.spans.append((stage, offset_ms, duration_ms))
+            if trace.duration_ms is not None:
+                trace.duration_ms = max(trace.duration_ms, offset_ms + duration_ms)
+
+            key = (trace.name, stage)
+            samples = self._stages.get(key)
+            if samples is None:
+                samples = self._stages[key] = deque(maxlen=self._samples_per_stage)
+            samples.append(duration_ms)
+
+    def finish(self, trace, status='ok', **attrs):
+        """Mark the trace done; later stages (e.g. the CUPS submit) can still be recorded"""
+        if trace is None:
+            return
+        with self._lock:
+            trace.attrs.update(attrs)
+            trace.status = status
+            trace.duration_ms = trace.elapsed_ms()
+        if _current_trace.get() is trace:
+            _current_trace.set(None)
+
+    # --------------------------------------------
+    # Reporting
+    # --------------------------------------------
+    def slowest(self, limit=20, name=None):
+        """Slowest finished traces, optionally only one kind ('upload', 'print', ...)"""
+        with self._lock:
+            finished = [t for t in self._traces
+                        if t.duration_ms is not None and (name is None or t.name == name)]
+            finished.sort(key=lambda t: t.duration_ms, reverse=True)
+            return [t.to_dict() for t in finished[:limit]]
+
+    def stage_stats(self):
+        """p50/p95/max per stage over the recent samples"""
+        with self._lock:
+            snapshot = {key: sorted(samples) for key, samples in self._stages.items()}
+
+        stats = {}
+        for (name, stage), samples in sorted(snapshot.items()):
+            stats.setdefault(name, {})[stage] = {
+                'count': len(samples),
+                'p50_ms': round(_percentile(samples, 50), 1),
+                'p95_ms': round(_percentile(samples, 95), 1),
+                'max_ms': round(samples[-1], 1)
+            }
+        return stats
+
+
+def _percentile(sorted_samples, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, -(-len(sorted_samples) * percent // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+tracer = Tracer()